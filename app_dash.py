@@ -1,9 +1,18 @@
 import dash
 from dash import dcc, html, Input, Output, State, ALL, ctx
 import dash_bootstrap_components as dbc
-from flask import request, jsonify
+from flask import request, jsonify, g, session, redirect
 import database as db
+import utils
+import telemetry
+from ingest_queue import get_queue, KEY_FIELDS
+import json
 import logging
+import os
+import secrets
+import sys
+import threading
+import time
 from datetime import datetime
 
 # Configure logging for webhook
@@ -32,6 +41,143 @@ app = dash.Dash(
 app.title = "Fitness Tracker"
 server = app.server # Expose Flask server for Render deployment and Webhook
 
+# Signs the session cookie that remembers which user a browser belongs to.
+# Set SECRET_KEY in production so sessions survive restarts and span workers:
+# a generated key is per process, so with several gunicorn workers (and no
+# --preload) a cookie from one worker is rejected by the next.
+def _worker_count():
+    """gunicorn workers this server runs under, from -w/--workers, GUNICORN_CMD_ARGS or WEB_CONCURRENCY."""
+    args = sys.argv[1:] + os.getenv("GUNICORN_CMD_ARGS", "").split()
+    for i, arg in enumerate(args):
+        if arg in ("-w", "--workers") and i + 1 < len(args):
+            return int(args[i + 1])
+        if arg.startswith("--workers="):
+            return int(arg.split("=", 1)[1])
+        if arg.startswith("-w") and arg[2:].isdigit():
+            return int(arg[2:])
+    return int(os.getenv("WEB_CONCURRENCY", "1"))
+
+if os.getenv("SECRET_KEY"):
+    server.secret_key = os.getenv("SECRET_KEY")
+elif _worker_count() > 1:
+    raise RuntimeError(f"SECRET_KEY must be set when running {_worker_count()} workers; "
+                       "each would otherwise sign sessions with its own random key")
+else:
+    logger.warning("SECRET_KEY is not set; using a random key, so sessions end when this process restarts")
+    server.secret_key = secrets.token_hex(32)
+
+# --- WORKER WARM-UP ---
+# pandas, plotly.express and metrics are imported on first use so workers boot
+# (and --preload forks) without them. The first request a worker serves starts
+# importing them in the background, so the first dashboard render rarely waits.
+WARM_UP_MODULES = ["pandas", "plotly.express", "metrics"]
+_warm_up_pid = None
+
+def _import_heavy_modules():
+    for name in WARM_UP_MODULES:
+        try:
+            __import__(name)
+        except Exception as e:
+            logger.warning(f"Warm-up import of {name} failed: {e}")
+
+@server.before_request
+def start_warm_up():
+    global _warm_up_pid
+    if _warm_up_pid != os.getpid():
+        _warm_up_pid = os.getpid()
+        threading.Thread(target=_import_heavy_modules, name="warm-up", daemon=True).start()
+
+# --- CURRENT USER ---
+# Only a single-user install (the local SQLite/dev setup) serves visitors
+# without a session as user 1; otherwise the UI requires signing in.
+SINGLE_USER = os.getenv("SINGLE_USER", "").lower() in ("1", "true", "yes")
+# Reachable without a session: webhooks (token-authenticated), sign-in, metrics and Dash's static assets
+PUBLIC_PREFIXES = ("/api/", "/login", "/logout", "/metrics", "/assets/", "/_dash-component-suites/",
+                   "/_dash-dependencies", "/_favicon", "/_reload-hash", "/favicon.ico")
+
+@server.before_request
+def bind_current_user():
+    user_id = session.get("user_id")
+    if user_id is None and not SINGLE_USER:
+        if request.path.startswith(PUBLIC_PREFIXES):
+            return None
+        if request.path.startswith("/_dash-"):
+            return jsonify({"status": "error", "message": "Not signed in"}), 401
+        return redirect("/login")
+    g.user_token = db.set_current_user(user_id if user_id is not None else db.DEFAULT_USER_ID)
+
+@server.teardown_request
+def unbind_current_user(exc=None):
+    if 'user_token' in g:
+        db.reset_current_user(g.user_token)
+
+@server.route('/login', methods=['GET'])
+def login():
+    """Link this browser to the user owning ?token= (the same token the Shortcut uses)."""
+    token = request.args.get('token', '')
+    if not token:
+        return jsonify({"status": "error", "message": "Open /login?token=<your webhook token> to sign in"}), 401
+    user_id = db.get_user_id_for_token(token)
+    if user_id is None:
+        return jsonify({"status": "error", "message": "Invalid token"}), 401
+    session["user_id"] = user_id
+    return redirect("/")
+
+@server.route('/logout', methods=['GET'])
+def logout():
+    session.pop("user_id", None)
+    return redirect("/")
+
+def webhook_user():
+    """User for a webhook call, from `Authorization: Bearer <token>` or ?token=; None if invalid."""
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:].strip() if auth.startswith('Bearer ') else request.args.get('token', '')
+    return db.get_user_id_for_token(token)
+
+# --- INSTRUMENTATION ---
+@server.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.round_trips_token = telemetry.begin_request()
+
+@server.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    telemetry.HTTP_REQUESTS.observe(elapsed, route, request.method, str(response.status_code))
+    telemetry.REQUEST_ROUND_TRIPS.observe(telemetry.end_request(g.round_trips_token), route)
+    if request.path.endswith('_dash-update-component'):
+        # Dash posts the callback's output spec; its first output names the callback
+        output = (request.get_json(silent=True) or {}).get('output', 'unknown')
+        telemetry.DASH_CALLBACKS.observe(elapsed, output.strip('.').split('...')[0].split('@')[0])
+    return response
+
+telemetry.register_collector(
+    "query_cache_events_total", "counter", "Read-through cache hits, misses, coalesced misses and invalidations.",
+    ("table", "event"),
+    lambda: {(table, event): stats[event] for table, stats in db.cache_stats().items()
+             for event in ("hits", "misses", "coalesced", "invalidations")}
+)
+telemetry.register_collector(
+    "food_search_events_total", "counter", "Food search cache outcomes.", ("event",),
+    lambda: {(event,): value for event, value in utils.food_search_stats().items() if not event.endswith("size")}
+)
+telemetry.register_collector(
+    "webhook_records_total", "counter", "Apple Watch day records written vs skipped as unchanged.", ("outcome",),
+    lambda: {(outcome,): value for outcome, value in get_queue().change_counts.items()}
+)
+telemetry.register_collector(
+    "ingest_queue", "gauge", "Write-behind queue depth, oldest payload age and retries.", ("stat",),
+    lambda: {(stat,): value for stat, value in get_queue().stats().items()}
+)
+
+@server.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint (per worker process)."""
+    return telemetry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # --- WEBHOOK API FOR IOS SHORTCUTS ---
 @server.route('/api/apple-health-sync', methods=['POST'])
 def apple_health_sync():
@@ -45,33 +191,158 @@ def apple_health_sync():
         "exercise_minutes": 45,
         "avg_heart_rate": 65
     }
+    The payload is validated and appended to the durable ingest queue; a
+    background worker writes it to the database, so the Shortcut gets a 202
+    without waiting on (or failing with) the database. A resend of totals that
+    were already sent for that date is answered 200 "unchanged" and never
+    queued; otherwise only the fields that changed are queued.
+    Requires the user's webhook token (python database.py issue-token <user id>).
     """
     try:
+        user_id = webhook_user()
+        if user_id is None:
+            return jsonify({"status": "error", "message": "Missing or invalid webhook token"}), 401
+
         data = request.json
-        logger.info(f"Received Apple Health Sync Payload: {data}")
+        logger.debug(f"Received Apple Health Sync Payload: {data}")
         
         # Validate required fields
         required = ['date', 'steps', 'active_calories', 'exercise_minutes']
-        if not all(k in data for k in required):
+        if not isinstance(data, dict) or not all(k in data for k in required):
             return jsonify({"status": "error", "message": "Missing required fields"}), 400
-            
-        date_str = data['date']
-        
-        # Insert into Supabase
-        db.upsert_apple_watch_data(
-            date=date_str,
-            steps=int(data['steps']),
-            active_calories=int(data['active_calories']),
-            exercise_minutes=int(data['exercise_minutes']),
-            avg_heart_rate=float(data.get('avg_heart_rate', 0.0))
-        )
-        
-        return jsonify({"status": "success", "message": f"Successfully synced data for {date_str}"}), 200
+
+        rows, errors = utils.validate_apple_watch_records([data])
+        if errors:
+            return jsonify({"status": "error", "message": errors[0]}), 400
+        record = dict(rows[0][1], user_id=user_id)
+
+        queue = get_queue()
+        changed, skipped = queue.enqueue_changes([record])
+        queue.start_worker(db.upsert_apple_watch_data_bulk)
+
+        if not changed:
+            return jsonify({"status": "unchanged", "message": f"No changes for {record['date']}",
+                            "written": 0, "skipped": skipped}), 200
+        fields = sorted(k for k in changed[0] if k not in KEY_FIELDS)
+        return jsonify({"status": "accepted", "message": f"Queued data for {record['date']}",
+                        "written": 1, "skipped": 0, "fields": fields}), 202
         
     except Exception as e:
         logger.error(f"Webhook Error: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@server.route('/api/apple-health-sync/bulk', methods=['POST'])
+def apple_health_sync_bulk():
+    """
+    Backfill endpoint: many days per request.
+    Accepts a JSON array of day records (same shape as /api/apple-health-sync)
+    or an NDJSON body (Content-Type: application/x-ndjson), one record per line.
+    Responds with per-record results; valid records are written even if others fail.
+    Records identical to what was last sent for their date are reported
+    "unchanged" and skipped; changed ones only write their changed fields.
+    Requires the same webhook token as /api/apple-health-sync.
+    """
+    try:
+        user_id = webhook_user()
+        if user_id is None:
+            return jsonify({"status": "error", "message": "Missing or invalid webhook token"}), 401
+
+        if request.mimetype == 'application/x-ndjson':
+            records = []
+            for line in request.get_data(as_text=True).splitlines():
+                if line.strip():
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        records.append(None)
+        else:
+            records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            return jsonify({"status": "error", "message": "Expected a JSON array or NDJSON body"}), 400
+
+        logger.info(f"Received Apple Health bulk sync with {len(records)} records")
+        rows, errors = utils.validate_apple_watch_records(records)
+        queue = get_queue()
+        changes = queue.changes([dict(row, user_id=user_id) for _, row in rows])
+        changed = [c for c in changes if c is not None]
+        db.upsert_apple_watch_data_bulk(changed, user_id=user_id)
+        queue.remember(changed, skipped=len(rows) - len(changed))
+
+        results = [
+            {"index": i, "date": row['date'], "status": "success" if change is not None else "unchanged"}
+            for (i, row), change in zip(rows, changes)
+        ]
+        results += [{"index": i, "status": "error", "message": msg} for i, msg in errors.items()]
+        results.sort(key=lambda r: r["index"])
+        return jsonify({
+            "status": "success" if not errors else "partial",
+            "written": len(changed),
+            "skipped": len(rows) - len(changed),
+            "failed": len(errors),
+            "results": results
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Bulk Webhook Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@server.route('/api/apple-health-samples', methods=['POST'])
+def apple_health_samples():
+    """
+    Intraday samples (heart_rate, steps, active_energy), e.g. from a Shortcut
+    exporting Health samples. JSON body, one of:
+      {"metric": "heart_rate", "timestamps": [...], "values": [...]}
+      [ {same shape}, ... ]
+      {"samples": [{"metric": "heart_rate", "timestamp": "...", "value": 72}, ...]}
+    Timestamps are ISO local times (any offset is ignored) or Unix seconds.
+    Samples are merged into per-day blocks and the minute/hour/day rollups they
+    touch are rewritten before responding; a resent sample replaces the stored one.
+    Requires the same webhook token as /api/apple-health-sync.
+    """
+    try:
+        user_id = webhook_user()
+        if user_id is None:
+            return jsonify({"status": "error", "message": "Missing or invalid webhook token"}), 401
+
+        samples, error = utils.parse_sample_batches(request.get_json(silent=True))
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+        try:
+            written = db.ingest_samples(samples, user_id=user_id)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify(dict(written, status="success")), 200
+
+    except Exception as e:
+        logger.error(f"Samples Webhook Error: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@server.route('/api/apple-health-samples', methods=['GET'])
+def apple_health_samples_rollups():
+    """
+    Rollups for charts: ?metric=heart_rate&start=2026-10-01&end=2026-11-01
+    [&resolution=minute|hour|day]. Reads only the rollup table; without a
+    resolution the finest one that keeps the range to a few thousand points is used.
+    """
+    user_id = webhook_user()
+    if user_id is None:
+        return jsonify({"status": "error", "message": "Missing or invalid webhook token"}), 401
+    metric, start, end = (request.args.get(k) for k in ('metric', 'start', 'end'))
+    if not (metric and start and end):
+        return jsonify({"status": "error", "message": "metric, start and end are required"}), 400
+    try:
+        import intraday
+        resolution = request.args.get('resolution') or intraday.pick_resolution(start, end)
+        rows = db.get_intraday_rollups(metric, start, end, resolution, user_id=user_id)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"metric": metric, "resolution": resolution, "rollups": rows}), 200
+
+@server.route('/api/ingest-status', methods=['GET'])
+def ingest_status():
+    """Depth and lag of the write-behind queue behind /api/apple-health-sync."""
+    return jsonify(get_queue().stats()), 200
+
 # --- MOBILE NAVIGATION ---
 def create_bottom_nav():
     return html.Div(
@@ -0,0 +1,253 @@
+import os
+import re
+import sqlite3
+import threading
+
+# ------------- Storage Backends -------------
+#
+# database.py talks to storage only through the small table-level interface
+# below, so the same handlers run against Supabase (PostgreSQL) or a local
+# embedded SQLite file built from database.sql.
+#
+# Filters are a list of (column, op, value) tuples where op is one of
+# eq, neq, gt, gte, lt, lte or in. Ordering is a list of (column, desc) tuples.
+# For keyset pagination, column and value may both be tuples with op lt/gt,
+# e.g. (("date", "id"), "lt", ("2024-01-01", 42)) compares row values.
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.sql")
+
+FILTER_OPS = {
+    "eq": "=",
+    "neq": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+    "in": "IN",
+}
+
+
+class Backend:
+    name = "base"
+
+    def select(self, table, columns="*", filters=None, order=None, limit=None):
+        raise NotImplementedError
+
+    def insert(self, table, rows):
+        raise NotImplementedError
+
+    def upsert(self, table, rows, on_conflict=None):
+        raise NotImplementedError
+
+    def update(self, table, values, filters):
+        raise NotImplementedError
+
+    def delete(self, table, filters):
+        raise NotImplementedError
+
+
+class SupabaseBackend(Backend):
+    name = "supabase"
+
+    def __init__(self, url, key):
+        from supabase import create_client
+        self.client = create_client(url, key)
+
+    def _apply(self, query, filters):
+        for column, op, value in filters or []:
+            if op not in FILTER_OPS:
+                raise ValueError(f"Unsupported filter op: {op}")
+            if isinstance(column, tuple):
+                query = query.or_(self._row_compare(column, op, value))
+                continue
+            # postgrest-py names the IN operator `in_`
+            query = getattr(query, "in_" if op == "in" else op)(column, value)
+        return query
+
+    @staticmethod
+    def _row_compare(columns, op, values):
+        # (a, b) < (x, y)  ->  a < x OR (a = x AND b < y), in PostgREST or() syntax
+        if op not in ("lt", "gt"):
+            raise ValueError(f"Row comparison only supports lt/gt, got: {op}")
+        # Values are double-quoted so commas, dots and parentheses in them
+        # (timestamps, food names) are not read as or() syntax
+        quoted = ['"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for v in values]
+        terms = []
+        for i, (column, value) in enumerate(zip(columns, quoted)):
+            equal = [f"{c}.eq.{v}" for c, v in zip(columns[:i], quoted[:i])]
+            term = f"{column}.{op}.{value}"
+            terms.append(f"and({','.join(equal + [term])})" if equal else term)
+        return ",".join(terms)
+
+    def select(self, table, columns="*", filters=None, order=None, limit=None):
+        cols = [columns] if isinstance(columns, str) else list(columns)
+        query = self._apply(self.client.table(table).select(*cols), filters)
+        for column, desc in order or []:
+            query = query.order(column, desc=desc)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.execute().data
+
+    def insert(self, table, rows):
+        return self.client.table(table).insert(rows).execute().data
+
+    def upsert(self, table, rows, on_conflict=None):
+        if on_conflict:
+            return self.client.table(table).upsert(rows, on_conflict=on_conflict).execute().data
+        return self.client.table(table).upsert(rows).execute().data
+
+    def update(self, table, values, filters):
+        return self._apply(self.client.table(table).update(values), filters).execute().data
+
+    def delete(self, table, filters):
+        return self._apply(self.client.table(table).delete(), filters).execute().data
+
+
+def sqlite_schema(sql):
+    """
+    Translate the Postgres DDL in database.sql into SQLite.
+    The schema only uses SERIAL keys (and the setval that follows the seed
+    row, which AUTOINCREMENT makes unnecessary) beyond the common subset.
+    """
+    sql = re.sub(r"^SELECT setval\(.*?\);$", "", sql, flags=re.MULTILINE)
+    return re.sub(r"\bSERIAL PRIMARY KEY\b", "INTEGER PRIMARY KEY AUTOINCREMENT", sql)
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded backend for single-node deployments and offline tests.
+    One shared connection in WAL mode; reads are in-process and take microseconds.
+    """
+    name = "sqlite"
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self._primary_keys = {}
+        with open(SCHEMA_PATH) as f:
+            self.conn.executescript(sqlite_schema(f.read()))
+
+    def _primary_key(self, table):
+        if table not in self._primary_keys:
+            info = self.conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            pk = [row["name"] for row in sorted(info, key=lambda r: r["pk"]) if row["pk"]]
+            self._primary_keys[table] = pk
+        return self._primary_keys[table]
+
+    def _where(self, filters):
+        clauses, params = [], []
+        for column, op, value in filters or []:
+            if op not in FILTER_OPS:
+                raise ValueError(f"Unsupported filter op: {op}")
+            if isinstance(column, tuple):
+                if op not in ("lt", "gt"):
+                    raise ValueError(f"Row comparison only supports lt/gt, got: {op}")
+                col_sql = ", ".join(f'"{c}"' for c in column)
+                clauses.append(f"({col_sql}) {FILTER_OPS[op]} ({', '.join('?' * len(value))})")
+                params.extend(value)
+            elif op == "in":
+                values = list(value)
+                if not values:
+                    clauses.append("0")
+                    continue
+                clauses.append(f'"{column}" IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+            else:
+                clauses.append(f'"{column}" {FILTER_OPS[op]} ?')
+                params.append(value)
+        sql = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return sql, params
+
+    def _run(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def _run_many(self, sql, param_rows):
+        # One transaction per batch, RETURNING rows collected in order
+        with self.lock:
+            out = []
+            self.conn.execute("BEGIN")
+            try:
+                for params in param_rows:
+                    out.extend(dict(row) for row in self.conn.execute(sql, params).fetchall())
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return out
+
+    def select(self, table, columns="*", filters=None, order=None, limit=None):
+        cols = "*" if columns == "*" else ", ".join(f'"{c}"' for c in ([columns] if isinstance(columns, str) else columns))
+        where, params = self._where(filters)
+        sql = f'SELECT {cols} FROM "{table}"{where}'
+        if order:
+            sql += " ORDER BY " + ", ".join(f'"{c}" {"DESC" if desc else "ASC"}' for c, desc in order)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return self._run(sql, params)
+
+    def _write(self, table, rows, conflict_clause):
+        rows = [rows] if isinstance(rows, dict) else list(rows)
+        if not rows:
+            return []
+        # Rows with differing key sets are grouped so each shares one statement
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+        out = []
+        for cols, group in groups.items():
+            col_sql = ", ".join(f'"{c}"' for c in cols)
+            sql = (f'INSERT INTO "{table}" ({col_sql}) VALUES ({", ".join("?" * len(cols))})'
+                   f"{conflict_clause(cols)} RETURNING *")
+            out.extend(self._run_many(sql, [tuple(r[c] for c in cols) for r in group]))
+        return out
+
+    def insert(self, table, rows):
+        return self._write(table, rows, lambda cols: "")
+
+    def upsert(self, table, rows, on_conflict=None):
+        target = [c.strip() for c in on_conflict.split(",")] if on_conflict else self._primary_key(table)
+
+        def conflict_clause(cols):
+            updates = [c for c in cols if c not in target]
+            target_sql = ", ".join(f'"{c}"' for c in target)
+            if not updates:
+                return f" ON CONFLICT ({target_sql}) DO NOTHING"
+            set_sql = ", ".join(f'"{c}" = excluded."{c}"' for c in updates)
+            return f" ON CONFLICT ({target_sql}) DO UPDATE SET {set_sql}"
+
+        return self._write(table, rows, conflict_clause)
+
+    def update(self, table, values, filters):
+        where, params = self._where(filters)
+        set_sql = ", ".join(f'"{c}" = ?' for c in values)
+        return self._run(f'UPDATE "{table}" SET {set_sql}{where} RETURNING *', list(values.values()) + params)
+
+    def delete(self, table, filters):
+        where, params = self._where(filters)
+        return self._run(f'DELETE FROM "{table}"{where} RETURNING *', params)
+
+
+def create_backend():
+    """
+    Pick the storage backend from configuration:
+      DB_BACKEND=supabase|sqlite  (default: supabase when SUPABASE_URL is set, else sqlite)
+      SQLITE_PATH                  (default: fitness.db, use :memory: for throwaway runs)
+    """
+    kind = (os.getenv("DB_BACKEND") or ("supabase" if os.getenv("SUPABASE_URL") else "sqlite")).lower()
+    if kind == "supabase":
+        url = os.getenv("SUPABASE_URL")
+        key = os.getenv("SUPABASE_KEY")
+        if not url or not key:
+            raise ValueError("Missing Supabase credentials. Ensure SUPABASE_URL and SUPABASE_KEY are set in .env")
+        return SupabaseBackend(url, key)
+    if kind == "sqlite":
+        return SQLiteBackend(os.getenv("SQLITE_PATH", "fitness.db"))
+    raise ValueError(f"Unknown DB_BACKEND: {kind}")
@@ -0,0 +1,162 @@
+import os
+import re
+import sys
+from datetime import date, datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+from backends import SCHEMA_PATH
+from cache import query_cache
+from database import DEFAULT_USER_ID, get_backend
+from ingest_queue import get_queue
+
+# ------------- Parquet Backup / Restore -------------
+#
+# Streams every table declared in database.sql to one Parquet file per table
+# and loads them back with batched upserts. Both directions work in fixed-size
+# batches (keyset pagination on the primary key out, Parquet record batches in),
+# so memory stays bounded no matter how many years of data there are.
+#
+# Backups taken before user_id existed restore onto user 1 (the column default).
+#
+# Column types come from database.sql: INTEGER/SERIAL -> int64, REAL -> float64,
+# TEXT -> string, except `date` (date32) and `updated_at` (UTC timestamp) so the
+# files are directly usable for analytics.
+
+BATCH_SIZE = 5000
+COMPRESSION = "zstd"
+
+SQL_TYPES = {
+    "SERIAL": pa.int64(),
+    "INTEGER": pa.int64(),
+    "REAL": pa.float64(),
+    "TEXT": pa.string(),
+}
+NAMED_TYPES = {
+    "date": pa.date32(),
+    "updated_at": pa.timestamp("us", tz="UTC"),
+}
+
+
+def schema_tables(path=SCHEMA_PATH):
+    """
+    Tables in database.sql, in declaration order (parents before children).
+    Returns {table: (primary key column tuple, pyarrow.Schema)}.
+    """
+    with open(path) as f:
+        sql = re.sub(r"--[^\n]*", "", f.read())
+    tables = {}
+    for name, body in re.findall(r"CREATE TABLE IF NOT EXISTS (\w+) \((.*?)\n\);", sql, re.S):
+        fields, primary_key = [], ()
+        for line in re.split(r",\s*\n", body.strip()):
+            line = line.strip()
+            if line.startswith("PRIMARY KEY"):
+                primary_key = tuple(c.strip() for c in re.search(r"\((.*)\)", line).group(1).split(","))
+                continue
+            column, sql_type = line.split()[:2]
+            if "PRIMARY KEY" in line:
+                primary_key = (column,)
+            fields.append(pa.field(column, NAMED_TYPES.get(column, SQL_TYPES[sql_type])))
+        tables[name] = (primary_key, pa.schema(fields))
+    return tables
+
+
+def _to_arrow(rows, schema):
+    columns = {field.name: [row.get(field.name) for row in rows] for field in schema}
+    for name in columns:
+        if name == "date":
+            columns[name] = [date.fromisoformat(v[:10]) if v else None for v in columns[name]]
+        elif name == "updated_at":
+            columns[name] = [datetime.fromisoformat(v) if v else None for v in columns[name]]
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def _from_arrow(batch):
+    rows = batch.to_pylist()
+    for row in rows:
+        if isinstance(row.get("date"), date):
+            row["date"] = row["date"].isoformat()
+        if isinstance(row.get("updated_at"), datetime):
+            row["updated_at"] = row["updated_at"].isoformat(timespec="microseconds")
+    return rows
+
+
+def export_table(table, out_dir, batch_size=BATCH_SIZE):
+    """Stream one table to <out_dir>/<table>.parquet. Returns the row count."""
+    primary_key, schema = schema_tables()[table]
+    path = os.path.join(out_dir, f"{table}.parquet")
+    tmp_path = path + ".tmp"
+    count, last = 0, None
+    with pq.ParquetWriter(tmp_path, schema, compression=COMPRESSION) as writer:
+        while True:
+            # Composite keys page with a row-value comparison, e.g. (user_id, date) > (3, '2024-01-01')
+            key = primary_key if len(primary_key) > 1 else primary_key[0]
+            filters = [(key, "gt", last)] if last is not None else []
+            rows = get_backend().select(table, filters=filters, order=[(c, False) for c in primary_key], limit=batch_size)
+            if not rows:
+                break
+            # One row group per batch
+            writer.write_batch(_to_arrow(rows, schema))
+            count += len(rows)
+            # No short-page exit: PostgREST caps a response at its max-rows
+            # (1000 by default), so a short page is not necessarily the last
+            last = tuple(rows[-1][c] for c in primary_key) if len(primary_key) > 1 else rows[-1][key]
+    os.replace(tmp_path, path)
+    return count
+
+
+def import_table(table, in_dir, batch_size=BATCH_SIZE):
+    """Upsert <in_dir>/<table>.parquet back into the table in batches. Returns the row count."""
+    primary_key, schema = schema_tables()[table]
+    parquet = pq.ParquetFile(os.path.join(in_dir, f"{table}.parquet"))
+    # Columns missing from older backups are skipped rather than nulled
+    columns = [name for name in parquet.schema_arrow.names if name in schema.names]
+    count = 0
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        rows = _from_arrow(batch)
+        get_backend().upsert(table, rows, on_conflict=",".join(primary_key))
+        if table == "apple_watch_data":
+            # Otherwise a resend of what was sent before the restore is skipped as unchanged
+            get_queue().forget_days({(r.get("user_id", DEFAULT_USER_ID), r["date"]) for r in rows})
+        count += len(rows)
+    query_cache.invalidate(table)
+    return count
+
+
+def export_all(out_dir, tables=None, progress=None):
+    """Export every table (or the given ones). Returns {table: row count}."""
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for table in tables or schema_tables():
+        counts[table] = export_table(table, out_dir)
+        if progress:
+            progress(table, counts[table])
+    return counts
+
+
+def import_all(in_dir, tables=None, progress=None):
+    """
+    Restore every table file found in in_dir, parents first so foreign keys hold.
+    Explicit ids are kept; on PostgreSQL reset SERIAL sequences afterwards
+    (SELECT setval(pg_get_serial_sequence('<table>', 'id'), MAX(id)) FROM <table>).
+    """
+    counts = {}
+    for table in schema_tables():
+        if tables and table not in tables:
+            continue
+        if not os.path.exists(os.path.join(in_dir, f"{table}.parquet")):
+            continue
+        counts[table] = import_table(table, in_dir)
+        if progress:
+            progress(table, counts[table])
+    query_cache.clear()
+    return counts
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] in ("export", "import"):
+        run = export_all if sys.argv[1] == "export" else import_all
+        verb = "Exported" if sys.argv[1] == "export" else "Imported"
+        run(sys.argv[2], sys.argv[3:] or None, progress=lambda table, n: print(f"{verb} {n} rows: {table}", flush=True))
+    else:
+        print("Usage: python backup.py export <dir> [table ...]")
+        print("       python backup.py import <dir> [table ...]")
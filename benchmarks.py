@@ -0,0 +1,483 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+
+# ------------- Benchmarks -------------
+#
+# Seeds a fresh SQLite database per data size with create_mock_data.generate
+# and times the hot paths: dashboard layout and first/warm render, webhook
+# requests per second (new and resent totals), per-second heart rate samples
+# (a day per request for a month, then the month's rollup read),
+# get_recent_workouts, logging a saved five-item meal, local food search, the
+# dashboard's daily-series load (columnar DailySeries vs the former pd.merge
+# path, time and peak traced memory), plus the cold import of app_dash in a fresh interpreter (what a
+# gunicorn worker pays on boot). Results are JSON so two runs (e.g.
+# before/after a commit) can be diffed with --compare.
+#
+#   python benchmarks.py --sizes 1,3,10 --out bench.json
+#   python benchmarks.py --compare before.json after.json
+#   python benchmarks.py --check-startup
+#   python benchmarks.py --load-test 500      # concurrent device syncs against ingest_asgi
+
+DEFAULT_SIZES = "1,3,10"
+REPEAT = 30
+WEBHOOK_REQUESTS = 500
+# Synthetic catalogue products per year of history
+PRODUCTS_PER_YEAR = 20000
+FOOD_QUERIES = ["chick", "chiken brest", "greek yog", "banana", "oat", "salmon fil", "protien bar"]
+REGRESSION_THRESHOLD = 0.10
+STARTUP_REPEAT = 5
+STARTUP_BUDGET_S = 0.8
+# Concurrent devices and days each one syncs in --load-test
+LOAD_TEST_DEVICES = 500
+LOAD_TEST_SYNCS = 10
+# Days of per-second heart rate posted to /api/apple-health-samples
+INTRADAY_DAYS = 30
+SECONDS_PER_DAY = 86400
+# Must not be imported by `import app_dash`; each is loaded on first use
+LAZY_MODULES = ["pandas", "numpy", "requests", "plotly.express", "pyarrow", "supabase", "metrics"]
+
+FOOD_WORDS = [
+    "chicken", "breast", "greek", "yogurt", "banana", "oat", "oatmeal", "salmon", "fillet", "protein",
+    "bar", "rice", "brown", "whole", "milk", "almond", "butter", "peanut", "bread", "wheat", "cheddar",
+    "cheese", "apple", "juice", "orange", "beef", "mince", "pasta", "tomato", "sauce", "granola",
+]
+BRANDS = ["Acme", "Fresh Farm", "Nordic", "Golden", "Kitchen Co", ""]
+# A typical five-item breakfast for the saved-meal benchmark
+MEAL_ITEMS = [
+    {"food_name": name, "weight_g": grams, "calories_100g": kcal, "protein_100g": p, "carbs_100g": c, "fats_100g": f}
+    for name, grams, kcal, p, c, f in [
+        ("Oats", 60, 389, 17, 66, 7), ("Milk", 200, 64, 3.4, 4.8, 3.6), ("Banana", 120, 89, 1.1, 23, 0.3),
+        ("Honey", 15, 304, 0.3, 82, 0), ("Almonds", 20, 579, 21, 22, 50),
+    ]
+]
+
+
+def timed(fn, repeat=REPEAT, setup=None):
+    """Run fn `repeat` times; returns latency percentiles in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return _percentiles(samples)
+
+
+def _percentiles(samples):
+    samples = np.array(samples)
+    return {
+        "n": len(samples),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "mean_ms": round(float(samples.mean()), 3),
+    }
+
+
+def peak_kb(fn, setup=None):
+    """Peak memory traced by tracemalloc while fn runs, in KiB."""
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def merged_frame(start_date=None):
+    """The dashboard's former load path: three DataFrames outer-merged on string dates."""
+    import pandas as pd
+    import database as db
+    master_df = pd.DataFrame(columns=['date', 'weight_kg', 'bmi'])
+    for df in (db.get_daily_logs_df(start_date), db.get_daily_calories_df(start_date), db.get_apple_watch_df(start_date)):
+        if not df.empty:
+            master_df = df if master_df.empty else pd.merge(master_df, df, on='date', how='outer')
+    master_df['date'] = pd.to_datetime(master_df['date'])
+    return master_df.sort_values('date')
+
+
+def columnar_series(start_date=None):
+    """The dashboard's load path: typed day arrays aligned on one axis."""
+    import database as db
+    from series import DailySeries
+    return DailySeries.from_columns({
+        "weight_kg": db.get_weight_arrays(start_date),
+        "consumed": db.get_calorie_arrays(start_date),
+        "steps": db.get_steps_arrays(start_date),
+    })
+
+
+def write_food_dump(path, products, seed):
+    rng = np.random.default_rng(seed)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for _ in range(products):
+            words = rng.choice(FOOD_WORDS, int(rng.integers(1, 4)), replace=False)
+            f.write(json.dumps({
+                "product_name": " ".join(words).capitalize(),
+                "brands": str(rng.choice(BRANDS)),
+                "unique_scans_n": int(rng.pareto(1.5) * 10),
+                "nutriments": {"energy-kcal_100g": round(float(rng.uniform(20, 600)), 1)},
+            }) + "\n")
+
+
+def bench_size(years, workdir, repeat, seed, users=1):
+    import database as db
+    import create_mock_data
+    from backends import SQLiteBackend
+    from food_index import FoodIndex, build_food_index
+    from app_dash import server
+    from ingest_queue import get_queue
+    import pages.dashboard as dashboard
+    import telemetry
+
+    db.set_backend(SQLiteBackend(os.path.join(workdir, f"bench_{years}y.db")))
+    # Fingerprints describe the previous size's database
+    get_queue().forget()
+    start = time.perf_counter()
+    counts = create_mock_data.generate(years, seed, users=users)
+    results = {"rows": counts, "generate_s": round(time.perf_counter() - start, 3)}
+
+    def cold():
+        db.query_cache.clear()
+        dashboard._figure_cache.clear()
+
+    results["dashboard_layout"] = timed(dashboard.layout, repeat)
+    results["dashboard_render_cold"] = timed(lambda: dashboard.sync_dashboard_cb("all", None), repeat, setup=cold)
+    dashboard.sync_dashboard_cb("all", None)
+    results["dashboard_render_warm"] = timed(lambda: dashboard.sync_dashboard_cb("all", None), repeat)
+
+    for name, load in (("merge", merged_frame), ("columnar", columnar_series)):
+        results[f"daily_series_{name}_cold"] = timed(load, repeat, setup=db.query_cache.clear)
+        results[f"daily_series_{name}_warm"] = timed(load, repeat)
+        results[f"daily_series_{name}_warm"]["peak_kb"] = peak_kb(load)
+        results[f"daily_series_{name}_cold"]["peak_kb"] = peak_kb(load, setup=db.query_cache.clear)
+
+    meal_id = db.save_meal("Benchmark breakfast", MEAL_ITEMS)
+    results["log_meal"] = timed(lambda: db.log_meal(meal_id, "1999-01-01", "Breakfast"), repeat)
+    token = telemetry.begin_request()
+    db.log_meal(meal_id, "1999-01-02", "Breakfast")
+    results["log_meal"]["round_trips"] = telemetry.end_request(token)
+
+    results["recent_workouts_cold"] = timed(lambda: db.get_recent_workouts(10), repeat, setup=db.query_cache.clear)
+    results["recent_workouts_warm"] = timed(lambda: db.get_recent_workouts(10), repeat)
+
+    # Timings are for user 1; the other users only add rows sharing the tables and indexes
+    client = server.test_client()
+    headers = {"Authorization": f"Bearer {db.issue_webhook_token(1)}"}
+    payloads = [
+        {"date": f"{2000 + i % 20}-01-{1 + i % 28:02d}", "steps": 8000 + i, "active_calories": 400,
+         "exercise_minutes": 30, "avg_heart_rate": 70}
+        for i in range(WEBHOOK_REQUESTS)
+    ]
+    start = time.perf_counter()
+    for payload in payloads:
+        response = client.post("/api/apple-health-sync", json=payload, headers=headers)
+        assert response.status_code == 202, response.get_data(as_text=True)
+    elapsed = time.perf_counter() - start
+    # Let the background worker finish before the next size swaps the backend
+    while get_queue().stats()["depth"]:
+        time.sleep(0.01)
+    results["webhook"] = {
+        "n": WEBHOOK_REQUESTS,
+        "requests_per_s": round(WEBHOOK_REQUESTS / elapsed, 1),
+        "drained_s": round(time.perf_counter() - start, 3),
+    }
+
+    # Shortcuts resend identical totals; these are acknowledged from the fingerprints
+    latest = list({payload["date"]: payload for payload in payloads}.values())
+    writes_before = sum(s[2] for (op, _, _), s in list(telemetry.DB_CALLS.series.items()) if op != "select")
+    start = time.perf_counter()
+    for i in range(WEBHOOK_REQUESTS):
+        payload = latest[i % len(latest)]
+        response = client.post("/api/apple-health-sync", json=payload, headers=headers)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    elapsed = time.perf_counter() - start
+    results["webhook_unchanged"] = {
+        "n": WEBHOOK_REQUESTS,
+        "requests_per_s": round(WEBHOOK_REQUESTS / elapsed, 1),
+        "db_writes": sum(s[2] for (op, _, _), s in list(telemetry.DB_CALLS.series.items()) if op != "select") - writes_before,
+    }
+
+    # A month of per-second heart rate, one day per request, then chart reads of the month
+    rng = np.random.default_rng(seed)
+    month = np.datetime64("2001-01-01", "s")
+    bodies = (
+        {"metric": "heart_rate",
+         "timestamps": (month + np.timedelta64(day * SECONDS_PER_DAY, "s") + np.arange(SECONDS_PER_DAY)).astype(np.int64).tolist(),
+         "values": (70 + np.cumsum(rng.integers(-1, 2, SECONDS_PER_DAY)) % 40).tolist()}
+        for day in range(INTRADAY_DAYS)
+    )
+
+    def post_samples():
+        response = client.post("/api/apple-health-samples", json=next(bodies), headers=headers)
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    results["intraday_ingest_day"] = timed(post_samples, INTRADAY_DAYS)
+    results["intraday_ingest_day"]["samples"] = SECONDS_PER_DAY
+    # A late sample for a stored day: one block read, then rewrites of just its minute, hour and day
+    token = telemetry.begin_request()
+    db.ingest_samples({"heart_rate": ([int(month.astype(np.int64))], [72])}, user_id=1)
+    results["intraday_ingest_day"]["round_trips_late_sample"] = telemetry.end_request(token)
+    month_rollups = lambda: db.get_intraday_rollups("heart_rate", "2001-01-01", "2001-02-01", user_id=1)
+    results["intraday_month_cold"] = timed(month_rollups, repeat, setup=db.query_cache.clear)
+    results["intraday_month_cold"]["rows"] = len(month_rollups())
+
+    products = int(years * PRODUCTS_PER_YEAR)
+    dump = os.path.join(workdir, f"foods_{years}y.jsonl.gz")
+    index_path = os.path.join(workdir, f"foods_{years}y.db")
+    write_food_dump(dump, products, seed)
+    start = time.perf_counter()
+    build_food_index(dump, index_path)
+    results["food_index_build_s"] = round(time.perf_counter() - start, 3)
+    index = FoodIndex(index_path)
+    queries = iter(FOOD_QUERIES * repeat)
+    results["food_search"] = timed(lambda: index.search(next(queries)), repeat)
+    results["food_search"]["products"] = products
+    return results
+
+
+def bench_startup(repeat=STARTUP_REPEAT):
+    """Time `import app_dash` in fresh interpreters and list any LAZY_MODULES it loaded."""
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import app_dash\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))\n"
+    )
+    root = os.path.dirname(os.path.abspath(__file__))
+    samples, eager = [], set()
+    with tempfile.TemporaryDirectory() as workdir:
+        # Never touch real credentials or data: a throwaway SQLite backend and journal
+        env = dict(os.environ, DB_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "startup.db"),
+                   INGEST_QUEUE_PATH=os.path.join(workdir, "ingest_queue.db"))
+        env.pop("SUPABASE_URL", None)
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                 check=True, cwd=root, env=env).stdout.split("\n")
+            samples.append(float(out[0]) * 1000)
+            eager.update(m for m in out[1].split(",") if m)
+    return dict(_percentiles(samples), eager_modules=sorted(eager))
+
+
+def check_startup(budget=STARTUP_BUDGET_S, repeat=STARTUP_REPEAT):
+    """Print the startup timing; returns False if it is over budget or a lazy module was imported."""
+    result = bench_startup(repeat)
+    print(json.dumps(result, indent=2))
+    ok = True
+    if result["p50_ms"] > budget * 1000:
+        print(f"FAIL: import app_dash p50 {result['p50_ms']} ms exceeds budget {budget * 1000:g} ms")
+        ok = False
+    if result["eager_modules"]:
+        print(f"FAIL: imported at startup: {', '.join(result['eager_modules'])}")
+        ok = False
+    return ok
+
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _Connection:
+    """
+    Minimal keep-alive HTTP/1.1 client for the load test. A full client
+    (httpx, requests) costs more CPU per request than the service under
+    test, which on a small machine measures the client instead.
+    """
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def post(self, path, payload, token):
+        import asyncio
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode()
+        self.writer.write(f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\nAuthorization: Bearer {token}\r\n"
+                          f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await self.writer.drain()
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        length = next(int(line.split(b":", 1)[1]) for line in head.lower().split(b"\r\n")
+                      if line.startswith(b"content-length:"))
+        return status, json.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def _device_syncs(connection, bodies, token):
+    """Post one device's syncs in order over its own connection; returns (latencies ms, status codes)."""
+    latencies, statuses = [], []
+    for body in bodies:
+        start = time.perf_counter()
+        status, _ = await connection.post("/api/apple-health-sync", body, token)
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses.append(status)
+    return latencies, statuses
+
+
+def load_test(devices=LOAD_TEST_DEVICES, syncs=LOAD_TEST_SYNCS, seed=42):
+    """
+    `devices` devices (one user, webhook token and connection each) syncing at
+    the same time against a single `uvicorn ingest_asgi:app` process: every
+    device posts `syncs` days in sequence, then resends them (answered as
+    unchanged). Needs uvicorn.
+    """
+    import asyncio
+    import urllib.request
+    import database as db
+    from backends import SQLiteBackend
+
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, DB_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "load.db"),
+                   INGEST_QUEUE_PATH=os.path.join(workdir, "ingest_queue.db"))
+        db.set_backend(SQLiteBackend(env["SQLITE_PATH"]))
+        tokens = [db.issue_webhook_token(db.create_user()["id"]) for _ in range(devices)]
+        days = [str(np.datetime64("2020-01-01") + np.timedelta64(i, "D")) for i in range(syncs)]
+        bodies = [[{"date": day, "steps": int(rng.integers(2000, 20000)), "active_calories": int(rng.integers(100, 900)),
+                    "exercise_minutes": int(rng.integers(0, 90)), "avg_heart_rate": float(rng.integers(55, 90))}
+                   for day in days] for _ in range(devices)]
+
+        port = _free_port()
+        status_url = f"http://127.0.0.1:{port}/api/ingest-status"
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "ingest_asgi:app", "--port", str(port),
+                                   "--log-level", "warning", "--backlog", str(max(2048, devices))],
+                                  env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            for _ in range(200):
+                try:
+                    urllib.request.urlopen(status_url, timeout=1).read()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+
+            async def run_rounds():
+                connections = [_Connection("127.0.0.1", port) for _ in range(devices)]
+                rounds = {}
+                try:
+                    for name in ("new", "resend"):
+                        start = time.perf_counter()
+                        per_device = await asyncio.gather(*[
+                            _device_syncs(connection, device_bodies, token)
+                            for connection, device_bodies, token in zip(connections, bodies, tokens)
+                        ])
+                        elapsed = time.perf_counter() - start
+                        statuses = [code for _, codes in per_device for code in codes]
+                        rounds[name] = dict(_percentiles([ms for latencies, _ in per_device for ms in latencies]),
+                                            requests_per_s=round(len(statuses) / elapsed, 1),
+                                            statuses={str(code): statuses.count(code) for code in sorted(set(statuses))})
+                finally:
+                    for connection in connections:
+                        connection.close()
+                return rounds
+
+            rounds = asyncio.run(run_rounds())
+            rounds["writer"] = json.loads(urllib.request.urlopen(status_url, timeout=5).read())
+        finally:
+            server.terminate()
+            server.wait()
+        stored = len(db.get_backend().select("apple_watch_data", columns="user_id"))
+    return dict(rounds, devices=devices, syncs_per_device=syncs, rows_stored=stored)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, repeat=REPEAT, seed=42, users=1):
+    with tempfile.TemporaryDirectory() as workdir:
+        # Webhook payloads go to a throwaway journal, never the real one
+        os.environ["INGEST_QUEUE_PATH"] = os.path.join(workdir, "ingest_queue.db")
+        results = {f"{years:g}": bench_size(years, workdir, repeat, seed, users) for years in sizes}
+    return {
+        "startup": {"import_app_dash": bench_startup()},
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "users": users,
+        "results": results,
+    }
+
+
+def compare(before, after, threshold=REGRESSION_THRESHOLD):
+    """Print per-metric changes between two result files; returns the regressions."""
+    regressions = []
+    sections = [(f"{size}y", metrics, before["results"].get(size, {})) for size, metrics in after["results"].items()]
+    if "startup" in after:
+        sections.append(("boot", after["startup"], before.get("startup", {})))
+    for size, metrics, old_metrics in sections:
+        for name, value in metrics.items():
+            old = old_metrics.get(name)
+            if not isinstance(value, dict) or not isinstance(old, dict):
+                continue
+            # Latencies regress upwards, throughput downwards
+            key, worse = ("requests_per_s", -1) if "requests_per_s" in value else ("p50_ms", 1)
+            if not old.get(key):
+                continue
+            change = (value[key] - old[key]) / old[key]
+            flag = "REGRESSION" if change * worse > threshold else ""
+            print(f"{size:>5} {name:<24} {key:<15} {old[key]:>10} -> {value[key]:>10} {change:+7.1%} {flag}")
+            if flag:
+                regressions.append((size, name, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark dashboard, webhook, journal and food search.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated years of history (default 1,3,10)")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, default=1, help="users sharing the database (default 1)")
+    parser.add_argument("--out", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="diff two result files")
+    parser.add_argument("--check-startup", action="store_true",
+                        help="only time `import app_dash`; exit non-zero if over --startup-budget or a heavy module loads")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET_S, help="seconds (default 0.8)")
+    parser.add_argument("--load-test", type=int, nargs="?", const=LOAD_TEST_DEVICES, metavar="DEVICES",
+                        help=f"only load-test ingest_asgi with concurrent devices (default {LOAD_TEST_DEVICES})")
+    parser.add_argument("--syncs", type=int, default=LOAD_TEST_SYNCS, help="days each device syncs in --load-test")
+    args = parser.parse_args()
+
+    if args.check_startup:
+        sys.exit(0 if check_startup(args.startup_budget) else 1)
+
+    if args.load_test:
+        print(json.dumps(load_test(args.load_test, args.syncs, args.seed), indent=2))
+        sys.exit(0)
+
+    if args.compare:
+        with open(args.compare[0]) as f0, open(args.compare[1]) as f1:
+            sys.exit(1 if compare(json.load(f0), json.load(f1)) else 0)
+
+    report = run([float(s) for s in args.sizes.split(",")], args.repeat, args.seed, args.users)
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,187 @@
+import copy
+import functools
+import inspect
+import threading
+from cachetools import TTLCache
+
+# ------------- Read-through Query Cache -------------
+#
+# Each table gets its own bounded TTL cache. Entries are tagged with the user
+# they were read for and an optional date scope, so a write for one user's day
+# only drops that user's whole-table reads and reads for that same day.
+#
+# The cache is per process: a write in one gunicorn worker does not reach
+# the others, so the TTL is what bounds staleness across workers.
+
+DEFAULT_TTL = 60
+DEFAULT_MAXSIZE = 1024
+
+TABLE_TTL = {
+    "users": 300,
+    # Token -> user lookups. Issuing a new token is the only way to revoke one, and
+    # other worker processes keep accepting the old token until this expires
+    "tokens": 30,
+    "daily_logs": 60,
+    "food_logs": 60,
+    "apple_watch_data": 60,
+    "workouts": 60,
+    "meals": 300,
+    "intraday_rollups": 60,
+    # A state saved by another worker is still self-consistent: its older cursor just
+    # means the delta feed hands back more rows to fold in
+    "metrics_state": 300,
+    # Delta-sync probes; short, since they are how a worker notices another worker's writes
+    "series": 15,
+}
+
+# Caches computed from another table's rows: a write to the table drops
+# the same user's entries there too (daily_nutrition writes invalidate food_logs)
+DEPENDENT_TABLES = {
+    "daily_logs": ("series",),
+    "food_logs": ("series",),
+    "apple_watch_data": ("series",),
+}
+
+
+class QueryCache:
+    def __init__(self, ttl=None, maxsize=DEFAULT_MAXSIZE):
+        self.ttl = dict(TABLE_TTL, **(ttl or {}))
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.stats = {}
+        # Bumped on every invalidation, per table and per (table, user); lets derived
+        # caches (e.g. built figures) key on data state
+        self.versions = {}
+        # (table, user, key, scope) -> waiter for loads in progress, so concurrent
+        # misses on one key share a single backend read
+        self.inflight = {}
+        # Supplies the user for reads that don't pass user_id (installed by database.py)
+        self.resolve_user = lambda: None
+
+    def _table(self, table):
+        if table not in self.tables:
+            self.tables[table] = TTLCache(maxsize=self.maxsize, ttl=self.ttl.get(table, DEFAULT_TTL))
+            self.stats[table] = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0}
+        return self.tables[table]
+
+    def get_or_load(self, table, key, scope, loader, user=None):
+        """
+        Return a copy of the cached value, calling loader() on a miss. Concurrent
+        misses on the same key wait for the first one's load instead of repeating
+        it, and a load that an invalidate() overtook is returned but not stored.
+        """
+        with self.lock:
+            entries = self._table(table)
+            full_key = (user, key, scope)
+            if full_key in entries:
+                self.stats[table]["hits"] += 1
+                return copy.deepcopy(entries[full_key])
+            waiter = self.inflight.get((table,) + full_key)
+            if waiter is None:
+                waiter = self.inflight[(table,) + full_key] = {"event": threading.Event()}
+                leader = True
+                self.stats[table]["misses"] += 1
+            else:
+                leader = False
+                self.stats[table]["coalesced"] += 1
+            version = self.version(table, user)
+
+        if not leader:
+            waiter["event"].wait()
+            if "value" in waiter:
+                return copy.deepcopy(waiter["value"])
+            # The first load failed; try again rather than share its error
+            return loader()
+
+        try:
+            value = loader()
+            with self.lock:
+                # Callers get their own copy so mutating a DataFrame never leaks back
+                waiter["value"] = copy.deepcopy(value)
+                if self.version(table, user) == version:
+                    entries[full_key] = waiter["value"]
+            return value
+        finally:
+            with self.lock:
+                if self.inflight.get((table,) + full_key) is waiter:
+                    del self.inflight[(table,) + full_key]
+            waiter["event"].set()
+
+    def invalidate(self, table, scope=None, user=None, dependents=True):
+        """
+        Drop entries affected by a write to `table`.
+        With a user, only that user's entries are considered; with a scope (a date),
+        only unscoped whole-table reads and reads for that date are dropped.
+        Without either the whole table is cleared. Entries of DEPENDENT_TABLES
+        go too unless dependents is False.
+        """
+        with self.lock:
+            entries = self._table(table)
+            if user is None:
+                self.versions[table] = self.versions.get(table, 0) + 1
+            else:
+                self.versions[(table, user)] = self.versions.get((table, user), 0) + 1
+            # Readers arriving from now on must not join a load that started before the write
+            for k in [k for k in self.inflight if k[0] == table and (user is None or k[1] == user)
+                      and (scope is None or k[3] is None or k[3] == scope)]:
+                del self.inflight[k]
+            if scope is None and user is None:
+                dropped = len(entries)
+                entries.clear()
+            else:
+                stale = [
+                    k for k in list(entries.keys())
+                    if (user is None or k[0] == user) and (scope is None or k[2] is None or k[2] == scope)
+                ]
+                for k in stale:
+                    entries.pop(k, None)
+                dropped = len(stale)
+            self.stats[table]["invalidations"] += dropped
+            for dependent in DEPENDENT_TABLES.get(table, ()) if dependents else ():
+                self.invalidate(dependent, scope, user)
+
+    def clear(self):
+        with self.lock:
+            for table, entries in self.tables.items():
+                entries.clear()
+                self.versions[table] = self.versions.get(table, 0) + 1
+            self.inflight.clear()
+
+    def version(self, table, user=None):
+        with self.lock:
+            return (self.versions.get(table, 0), self.versions.get((table, user), 0))
+
+    def get_stats(self):
+        with self.lock:
+            return {table: dict(s, size=len(self.tables[table])) for table, s in self.stats.items()}
+
+
+query_cache = QueryCache()
+
+
+def cached(table, scope_arg=None):
+    """
+    Decorator for read handlers in database.py.
+    scope_arg names the argument (e.g. 'date') that narrows the read to one day.
+    A `user_id` argument left as None is filled in from query_cache.resolve_user,
+    so every entry belongs to exactly one user.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        per_user = "user_id" in signature.parameters
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            user = None
+            if per_user:
+                if bound.arguments["user_id"] is None:
+                    bound.arguments["user_id"] = query_cache.resolve_user()
+                user = bound.arguments["user_id"]
+            key = (func.__name__, tuple(bound.arguments.items()))
+            scope = bound.arguments.get(scope_arg) if scope_arg else None
+            return query_cache.get_or_load(table, key, scope, lambda: func(*bound.args, **bound.kwargs), user)
+        return wrapper
+    return decorator
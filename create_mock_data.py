@@ -1,37 +1,146 @@
+import argparse
 import datetime
-from database import init_db, log_daily_weight, log_food, save_workout, upsert_apple_watch_data
-
-# Ensure DB exists
-init_db()
-
-today = datetime.date.today()
-
-# 1. Log past 7 days of weight
-weights = [76.5, 76.2, 76.0, 75.8, 75.5, 75.3, 75.0]
-for i in range(7):
-    d = today - datetime.timedelta(days=6-i)
-    log_daily_weight(str(d), weights[i])
-
-# 2. Log some food for today
-log_food(str(today), "Breakfast", "Oatmeal with berries", "1 bowl", 350.5, 12.0, 60.0, 5.0)
-log_food(str(today), "Lunch", "Chicken Breast & Rice", "1 plate", 600.0, 50.0, 70.0, 10.0)
-
-# 3. Log a workout
-save_workout(
-    str(today), 
-    65, 
-    "Great push session!", 
-    [
-        {"exercise_name": "Bench Press", "sets": 3, "reps": 8, "weight_kg": 80.0, "rpe": 8.0},
-        {"exercise_name": "Overhead Press", "sets": 3, "reps": 10, "weight_kg": 50.0, "rpe": 8.5}
+import numpy as np
+import database as db
+from backends import SQLiteBackend
+
+# ------------- Synthetic Data Generator -------------
+#
+# Deterministic (seeded) history of weight, food, workout and Apple Watch data
+# ending today for one or more users, written with bulk inserts so years of data load in seconds.
+# Used for local demos and as the fixture for benchmarks.py.
+
+CHUNK_SIZE = 1000
+
+FOODS = [
+    # (meal, food, portion, calories, protein, carbs, fats)
+    ("Breakfast", "Oatmeal with berries", "1 bowl", 350.5, 12.0, 60.0, 5.0),
+    ("Breakfast", "Greek yogurt & honey", "1 cup", 220.0, 18.0, 25.0, 4.0),
+    ("Breakfast", "Scrambled eggs on toast", "1 plate", 410.0, 24.0, 30.0, 20.0),
+    ("Lunch", "Chicken Breast & Rice", "1 plate", 600.0, 50.0, 70.0, 10.0),
+    ("Lunch", "Tuna salad wrap", "1 wrap", 480.0, 32.0, 45.0, 16.0),
+    ("Lunch", "Lentil soup", "1 bowl", 330.0, 18.0, 48.0, 6.0),
+    ("Dinner", "Salmon & potatoes", "1 plate", 650.0, 40.0, 50.0, 28.0),
+    ("Dinner", "Beef stir fry", "1 plate", 700.0, 45.0, 60.0, 25.0),
+    ("Dinner", "Pasta bolognese", "1 plate", 780.0, 35.0, 95.0, 22.0),
+    ("Snack", "Banana", "1 medium", 105.0, 1.3, 27.0, 0.4),
+    ("Snack", "Protein shake", "1 scoop", 120.0, 24.0, 3.0, 1.5),
+    ("Snack", "Almonds", "30 g", 174.0, 6.0, 6.0, 15.0),
+]
+
+EXERCISES = [
+    ("Bench Press", 80.0), ("Overhead Press", 50.0), ("Squat", 110.0), ("Deadlift", 140.0),
+    ("Barbell Row", 70.0), ("Pull Up", 0.0), ("Romanian Deadlift", 100.0), ("Lunge", 40.0),
+]
+
+
+def _chunks(rows):
+    for i in range(0, len(rows), CHUNK_SIZE):
+        yield rows[i:i + CHUNK_SIZE]
+
+
+def generate(years=1, seed=42, end=None, users=1):
+    """
+    Write `years` of daily history ending at `end` (default today) for users
+    1..`users` to the active backend. The same seed always produces the same rows.
+    Returns a dict of row counts per table.
+    """
+    end = end or datetime.date.today()
+    n_days = int(years * 365)
+    dates = [(end - datetime.timedelta(days=n_days - 1 - i)).isoformat() for i in range(n_days)]
+    counts = {}
+    for user_id in range(1, users + 1):
+        for table, n in _generate_user(user_id, np.random.default_rng([seed, user_id]), dates).items():
+            counts[table] = counts.get(table, 0) + n
+    db.rebuild_daily_nutrition()
+    db.query_cache.clear()
+    return counts
+
+
+def _generate_user(user_id, rng, dates):
+    n_days = len(dates)
+    backend = db.get_backend()
+    now = db._now()
+
+    backend.upsert("users", {
+        "id": user_id, "height_cm": round(float(rng.normal(175, 8)), 1), "maintenance_calories": 2500
+    })
+
+    # Weight: slow drift plus day-to-day water noise, weighed on ~85% of days
+    drift = np.cumsum(rng.normal(-0.01, 0.05, n_days))
+    weights = np.round(88.0 + drift + rng.normal(0, 0.4, n_days), 1)
+    weighed = rng.random(n_days) < 0.85
+    weight_rows = [
+        {"user_id": user_id, "date": d, "weight_kg": float(w), "updated_at": now}
+        for d, w, keep in zip(dates, weights, weighed) if keep
+    ]
+    for chunk in _chunks(weight_rows):
+        backend.upsert("daily_logs", chunk)
+
+    # Food: 2-5 entries per day with a +-20% portion variation
+    counts = rng.integers(2, 6, n_days)
+    picks = rng.integers(0, len(FOODS), int(counts.sum()))
+    scales = rng.uniform(0.8, 1.2, int(counts.sum()))
+    food_rows = []
+    for d, food, scale in zip(np.repeat(dates, counts), picks, scales):
+        meal, name, portion, kcal, protein, carbs, fats = FOODS[food]
+        food_rows.append({
+            "user_id": user_id, "date": str(d), "meal_name": meal, "food_name": name, "portion_size": portion,
+            "calories": round(kcal * scale, 1), "protein_g": round(protein * scale, 1),
+            "carbs_g": round(carbs * scale, 1), "fats_g": round(fats * scale, 1),
+        })
+    for chunk in _chunks(food_rows):
+        backend.insert("food_logs", chunk)
+
+    # Workouts on ~4 days a week with 3-5 exercises each
+    trained = [d for d, keep in zip(dates, rng.random(n_days) < 4 / 7) if keep]
+    durations = rng.integers(35, 95, len(trained))
+    workout_rows = [
+        {"user_id": user_id, "date": d, "duration_minutes": int(m), "notes": "Generated session"}
+        for d, m in zip(trained, durations)
     ]
-)
+    exercise_rows = []
+    for chunk in _chunks(workout_rows):
+        for workout in backend.insert("workouts", chunk):
+            for i in rng.choice(len(EXERCISES), int(rng.integers(3, 6)), replace=False):
+                name, base = EXERCISES[i]
+                exercise_rows.append({
+                    "user_id": user_id, "workout_id": workout["id"], "exercise_name": name,
+                    "sets": int(rng.integers(3, 6)), "reps": int(rng.integers(5, 13)),
+                    "weight_kg": round(base * rng.uniform(0.85, 1.1), 1),
+                    "rpe": float(rng.choice([7.0, 7.5, 8.0, 8.5, 9.0])),
+                })
+    for chunk in _chunks(exercise_rows):
+        backend.insert("workout_exercises", chunk)
+
+    # Apple Watch: every day
+    steps = rng.normal(9000, 2500, n_days).clip(500).astype(int)
+    watch_rows = [
+        {
+            "date": d, "steps": int(s), "active_calories": int(s * 0.045 + rng.normal(0, 40)),
+            "exercise_minutes": int(rng.integers(5, 90)), "avg_heart_rate": round(float(rng.normal(72, 4)), 1),
+        }
+        for d, s in zip(dates, steps)
+    ]
+    db.upsert_apple_watch_data_bulk(watch_rows, user_id=user_id)
+
+    return {
+        "daily_logs": len(weight_rows),
+        "food_logs": len(food_rows),
+        "workouts": len(workout_rows),
+        "workout_exercises": len(exercise_rows),
+        "apple_watch_data": len(watch_rows),
+    }
+
 
-# 4. Mock Apple Watch Data for the past 5 days
-steps = [8500, 10200, 12000, 7500, 11000]
-active_cals = [400, 500, 650, 350, 550]
-for i in range(5):
-    d = today - datetime.timedelta(days=4-i)
-    upsert_apple_watch_data(str(d), steps[i], active_cals[i], 45, 72.5)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate seeded mock data into a local SQLite database.")
+    parser.add_argument("--years", type=float, default=1, help="years of history ending today (default 1)")
+    parser.add_argument("--users", type=int, default=1, help="number of users, ids 1..N (default 1)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--sqlite", default="fitness.db", help="SQLite file to write (default fitness.db)")
+    args = parser.parse_args()
 
-print("Mock data generated successfully!")
+    db.set_backend(SQLiteBackend(args.sqlite))
+    counts = generate(args.years, args.seed, users=args.users)
+    print(f"Mock data generated successfully into {args.sqlite}: {counts}")
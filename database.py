@@ -1,142 +1,786 @@
 import os
+import json
+import time
+import contextvars
+import hashlib
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-import pandas as pd
-from supabase import create_client, Client
+from backends import create_backend
+from cache import cached, query_cache
+from telemetry import InstrumentedBackend
 
 # Load environment variables from .env
 load_dotenv()
 
-# Initialize Supabase client
-url: str = os.getenv("SUPABASE_URL")
-key: str = os.getenv("SUPABASE_KEY")
+# The storage backend (Supabase or local SQLite) is picked from configuration
+# on first use, so importing this module never needs network credentials.
+# It is created per process: a client or SQLite connection made before a
+# gunicorn --preload fork is never shared with the workers.
+# pandas is likewise imported inside the handlers that build DataFrames, so
+# workers that only serve the webhook never pay for it.
+_backend = None
+_backend_pid = None
 
-if not url or not key:
-    raise ValueError("Missing Supabase credentials. Ensure SUPABASE_URL and SUPABASE_KEY are set in .env")
+def get_backend():
+    global _backend, _backend_pid
+    if _backend is None or _backend_pid != os.getpid():
+        _backend = InstrumentedBackend(create_backend())
+        _backend_pid = os.getpid()
+    return _backend
 
-supabase: Client = create_client(url, key)
+def set_backend(backend):
+    """Swap the active backend, e.g. an in-memory SQLiteBackend for tests."""
+    global _backend, _backend_pid
+    _backend = backend if isinstance(backend, InstrumentedBackend) else InstrumentedBackend(backend)
+    _backend_pid = os.getpid()
+    query_cache.clear()
+
+# ------------- Current User -------------
+#
+# Every handler takes an optional user_id; when omitted it acts for the user of
+# the current request, which app_dash sets from the session. The value lives in
+# a contextvar, so fetch_concurrently's worker threads see it too.
+
+DEFAULT_USER_ID = 1
+_current_user = contextvars.ContextVar("current_user", default=DEFAULT_USER_ID)
+
+def set_current_user(user_id):
+    """Act for user_id in this context; returns a token for reset_current_user."""
+    return _current_user.set(user_id)
+
+def reset_current_user(token):
+    _current_user.reset(token)
+
+def current_user_id():
+    return _current_user.get()
+
+def _uid(user_id):
+    return current_user_id() if user_id is None else user_id
+
+query_cache.resolve_user = current_user_id
+
+# Shared, bounded pool for independent reads (e.g. the dashboard's four fetches).
+# Created on first use so it is never inherited across a gunicorn fork.
+FETCH_POOL_SIZE = int(os.getenv("DB_FETCH_POOL_SIZE", "8"))
+_fetch_pool = None
+
+def fetch_concurrently(fetches, timeout=5.0):
+    """
+    Run independent read handlers in parallel.
+    fetches: dict of name -> zero-argument callable.
+    Returns dict of name -> result, or the exception raised (TimeoutError if the
+    fetch did not finish within `timeout` seconds of the call), so one slow or
+    failing query never blocks the others.
+    """
+    global _fetch_pool
+    if _fetch_pool is None:
+        _fetch_pool = ThreadPoolExecutor(max_workers=FETCH_POOL_SIZE, thread_name_prefix="db-fetch")
+
+    # Each fetch runs in a copy of the caller's context, so per-request metrics follow it
+    futures = {name: _fetch_pool.submit(contextvars.copy_context().run, fn) for name, fn in fetches.items()}
+    deadline = time.monotonic() + timeout
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except Exception as e:
+            if not future.done():
+                future.cancel()
+                e = TimeoutError(f"{name} fetch timed out after {timeout}s")
+            print(f"Dashboard fetch '{name}' failed: {e}")
+            results[name] = e
+    return results
+
+def data_version(table):
+    """
+    Per-process counter bumped by every write to `table` for the current user
+    through this module. Other workers' writes are only seen once cached reads
+    expire, so caches keyed on it should share the query cache TTL.
+    """
+    return query_cache.version(table, current_user_id())
+
+def cache_stats():
+    """Per-table hit/miss/invalidation counters of the read-through cache."""
+    return query_cache.get_stats()
 
 # ------------- DB Handlers -------------
 
-def get_user_settings():
-    response = supabase.table("users").select("*").limit(1).execute()
-    if response.data:
-        return response.data[0]
+def _now():
+    # Fixed-width UTC timestamps compare correctly as text
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+def _mine(user_id):
+    # Leading filter of every per-user query; matches the (user_id, ...) indexes
+    return [("user_id", "eq", user_id)]
+
+@cached("users")
+def get_user_settings(user_id=None):
+    rows = get_backend().select("users", filters=[("id", "eq", user_id)], limit=1)
+    if rows:
+        return rows[0]
     return {"height_cm": 175.0, "maintenance_calories": 2500} # Default
 
-def update_user_settings(height_cm, maintenance_calories):
-    user = get_user_settings()
+def create_user(height_cm=175.0, maintenance_calories=2500):
+    rows = get_backend().insert("users", {
+        "height_cm": height_cm,
+        "maintenance_calories": maintenance_calories
+    })
+    return rows[0] if rows else None
+
+def update_user_settings(height_cm, maintenance_calories, user_id=None):
+    user_id = _uid(user_id)
+    user = get_user_settings(user_id)
     if "id" in user:
-        response = supabase.table("users").update({
+        response = get_backend().update("users", {
             "height_cm": height_cm,
             "maintenance_calories": maintenance_calories
-        }).eq("id", user["id"]).execute()
+        }, [("id", "eq", user["id"])])
     else:
-         response = supabase.table("users").insert({
+         response = get_backend().upsert("users", {
+            "id": user_id,
             "height_cm": height_cm,
             "maintenance_calories": maintenance_calories
-        }).execute()
+        })
+    query_cache.invalidate("users", user=user_id)
+    if height_cm != user.get('height_cm'):
+        recompute_bmi(height_cm, user_id)
     return response
 
-def log_daily_weight(date, weight_kg):
-    # Fetch user for BMI calculation
-    user = get_user_settings()
-    height_m = user.get('height_cm', 175.0) / 100.0 if user.get('height_cm') else None
-    bmi = (weight_kg / (height_m * height_m)) if height_m and height_m > 0 else None
-    
-    # Supabase upsert requires the primary key (date)
-    response = supabase.table("daily_logs").upsert({
+def token_hash(token):
+    """What is stored for a webhook token (users.webhook_token_hash)."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_webhook_token(user_id=None):
+    """
+    Create (or rotate) the user's webhook token. Only its hash is stored, so the
+    returned token has to be copied into the iOS Shortcut now.
+    Raises ValueError if there is no such user.
+    The old token stops working at once in this process and within the "tokens"
+    cache TTL (30 s) in other workers.
+    """
+    user_id = _uid(user_id)
+    token = secrets.token_urlsafe(32)
+    rows = get_backend().update("users", {"webhook_token_hash": token_hash(token)}, [("id", "eq", user_id)])
+    if len(rows) != 1:
+        raise ValueError(f"No user with id {user_id}")
+    query_cache.invalidate("users", user=user_id)
+    # Lookups are keyed by token, not user, so the old token's entry can't be singled out
+    query_cache.invalidate("tokens")
+    return token
+
+@cached("tokens")
+def get_user_id_for_token(token):
+    """The user a webhook token belongs to, or None."""
+    if not token:
+        return None
+    rows = get_backend().select("users", columns="id", filters=[("webhook_token_hash", "eq", token_hash(token))], limit=1)
+    return rows[0]['id'] if rows else None
+
+def log_daily_weight(date, weight_kg, user_id=None):
+    # One round trip: the settings come from the users cache. Reads derive BMI
+    # from the current height; the stored columns are kept for direct readers
+    user_id = _uid(user_id)
+    user = get_user_settings(user_id)
+    height_m = (user.get('height_cm') or 0) / 100.0
+    response = get_backend().upsert("daily_logs", {
+        "user_id": user_id,
         "date": date,
         "weight_kg": weight_kg,
         "maintenance_calories": user.get('maintenance_calories', 2500),
-        "bmi": bmi
-    }).execute()
+        "bmi": weight_kg / (height_m * height_m) if weight_kg and height_m > 0 else None,
+        "updated_at": _now()
+    })
+    query_cache.invalidate("daily_logs", date, user=user_id)
     return response
 
-def get_daily_logs_df():
-    response = supabase.table("daily_logs").select("*").order("date", desc=True).execute()
-    return pd.DataFrame(response.data)
+def _since(start_date):
+    # Date-range filter pushed down to the backend; dates are ISO strings
+    return [("date", "gte", start_date)] if start_date else []
 
-def log_food(date, meal_name, food_name, portion_size, calories, protein_g=0, carbs_g=0, fats_g=0):
-    response = supabase.table("food_logs").insert({
-        "date": date,
-        "meal_name": meal_name,
+# PostgREST's default max-rows; a full-table read has to page past it
+PAGE_SIZE = 1000
+
+def _select_all(table, columns, filters, key):
+    """
+    Every matching row, read in keyset pages ordered by key (a column or a
+    tuple of columns, which must be among columns), as backup.py exports.
+    """
+    key_columns = key if isinstance(key, tuple) else (key,)
+    rows, last = [], None
+    while True:
+        page = get_backend().select(table, columns=columns, filters=filters + ([(key, "gt", last)] if last is not None else []),
+                                    order=[(c, False) for c in key_columns], limit=PAGE_SIZE)
+        if not page:
+            return rows
+        rows.extend(page)
+        last = tuple(page[-1][c] for c in key) if isinstance(key, tuple) else page[-1][key]
+
+def bmi_series(weight_kg, height_cm):
+    """Vectorized BMI for a weight column or array; NaN when the height is unknown."""
+    import pandas as pd
+    weight_kg = pd.to_numeric(weight_kg, errors="coerce")
+    height_m = (height_cm or 0) / 100.0
+    if height_m <= 0:
+        return weight_kg * float("nan")
+    return weight_kg / (height_m * height_m)
+
+@cached("daily_logs")
+def _get_daily_logs_rows(start_date=None, user_id=None):
+    import pandas as pd
+    rows = get_backend().select("daily_logs", filters=_mine(user_id) + _since(start_date), order=[("date", True)])
+    return pd.DataFrame(rows)
+
+def get_daily_logs_df(start_date=None, user_id=None):
+    user_id = _uid(user_id)
+    df = _get_daily_logs_rows(start_date, user_id)
+    if not df.empty and 'weight_kg' in df.columns:
+        # Derived here so a height change applies to all history at once
+        df['bmi'] = bmi_series(df['weight_kg'], get_user_settings(user_id).get('height_cm'))
+    return df
+
+BMI_BATCH_SIZE = 500
+
+def recompute_bmi(height_cm=None, user_id=None):
+    """
+    Rewrite the user's stored daily_logs.bmi column in chunked upserts, for
+    consumers that read the table directly (reads here derive BMI already).
+    Returns the number of rows written.
+    """
+    import pandas as pd
+    user_id = _uid(user_id)
+    if height_cm is None:
+        height_cm = get_user_settings(user_id).get('height_cm')
+    df = pd.DataFrame(_select_all("daily_logs", ["date", "weight_kg"], _mine(user_id), "date"))
+    if df.empty:
+        return 0
+    bmi = bmi_series(df['weight_kg'], height_cm)
+    rows = [
+        {"user_id": user_id, "date": d, "bmi": None if pd.isna(b) else float(b)}
+        for d, b in zip(df['date'], bmi)
+    ]
+    for i in range(0, len(rows), BMI_BATCH_SIZE):
+        get_backend().upsert("daily_logs", rows[i:i + BMI_BATCH_SIZE])
+    query_cache.invalidate("daily_logs", user=user_id)
+    return len(rows)
+
+def log_food(date, meal_name, food_name, portion_size, calories, protein_g=0, carbs_g=0, fats_g=0, user_id=None):
+    return log_foods(date, meal_name, [{
         "food_name": food_name,
         "portion_size": portion_size,
         "calories": calories,
         "protein_g": protein_g,
         "carbs_g": carbs_g,
         "fats_g": fats_g
-    }).execute()
+    }], user_id)
+
+def log_foods(date, meal_name, items, user_id=None):
+    """
+    Log several foods for one meal with a single batched insert and one rollup refresh.
+    items: dicts with food_name, portion_size, calories, protein_g, carbs_g, fats_g.
+    """
+    user_id = _uid(user_id)
+    if not items:
+        return []
+    response = get_backend().insert("food_logs", [
+        {
+            "user_id": user_id,
+            "date": date,
+            "meal_name": meal_name,
+            "food_name": item["food_name"],
+            "portion_size": item.get("portion_size"),
+            **{c: item.get(c) or 0 for c in NUTRIENT_COLUMNS},
+        }
+        for item in items
+    ])
+    refresh_daily_nutrition(date, user_id)
+    query_cache.invalidate("food_logs", date, user=user_id)
     return response
 
-def get_food_logs_by_date(date):
-    response = supabase.table("food_logs").select("*").eq("date", date).execute()
-    return pd.DataFrame(response.data)
-
-def get_daily_calories_df():
-    # Since Supabase RPC (functions) are needed for group by, we will aggregate in Pandas for now
-    response = supabase.table("food_logs").select("date", "calories").execute()
-    df = pd.DataFrame(response.data)
-    if not df.empty:
-        agg_df = df.groupby('date')['calories'].sum().reset_index()
-        agg_df = agg_df.rename(columns={'calories': 'consumed'})
-        agg_df = agg_df.sort_values(by='date', ascending=False)
-        return agg_df
+def delete_food_log(food_log_id, user_id=None):
+    user_id = _uid(user_id)
+    # Scoped to the owner, so one user can never delete another's entry by id
+    rows = get_backend().delete("food_logs", [("id", "eq", food_log_id)] + _mine(user_id))
+    for date in {row['date'] for row in rows}:
+        refresh_daily_nutrition(date, user_id)
+        query_cache.invalidate("food_logs", date, user=user_id)
+    return rows
+
+@cached("food_logs", scope_arg="date")
+def get_food_logs_by_date(date, user_id=None):
+    import pandas as pd
+    rows = get_backend().select("food_logs", filters=_mine(user_id) + [("date", "eq", date)])
+    return pd.DataFrame(rows)
+
+# ------------- Daily Nutrition Rollup -------------
+
+NUTRIENT_COLUMNS = ['calories', 'protein_g', 'carbs_g', 'fats_g']
+ROLLUP_BATCH_SIZE = 500
+
+def _nutrition_rows(df):
+    grouped = df.groupby(['user_id', 'date'])
+    agg_df = grouped[NUTRIENT_COLUMNS].sum().astype(float)
+    agg_df['entry_count'] = grouped.size().astype(int)
+    return agg_df.reset_index().to_dict('records')
+
+def refresh_daily_nutrition(date, user_id=None):
+    """
+    Recompute the rollup row for a single day from that day's food_logs.
+    Every write path (insert, delete, edit) calls this for the dates it touched,
+    so the cost is bounded by one day's entries rather than the whole history.
+    """
+    import pandas as pd
+    user_id = _uid(user_id)
+    rows = get_backend().select("food_logs", columns=["user_id", "date"] + NUTRIENT_COLUMNS,
+                                filters=_mine(user_id) + [("date", "eq", date)])
+    if rows:
+        df = pd.DataFrame(rows).fillna({c: 0 for c in NUTRIENT_COLUMNS})
+        rollup = _nutrition_rows(df)[0]
+    else:
+        # Tombstone rather than delete, so delta sync sees the day disappear
+        rollup = {'user_id': user_id, 'date': date, **{c: 0.0 for c in NUTRIENT_COLUMNS}, 'entry_count': 0}
+    rollup['updated_at'] = _now()
+    get_backend().upsert("daily_nutrition", rollup)
+    return rollup
+
+def rebuild_daily_nutrition(user_id=None):
+    """
+    Recompute the rollup from food_logs, e.g. after a crash or migration.
+    Covers every user unless user_id is given. Returns the number of live days.
+    """
+    import pandas as pd
+    filters = _mine(user_id) if user_id is not None else []
+    rows = _select_all("food_logs", ["id", "user_id", "date"] + NUTRIENT_COLUMNS, filters, "id")
+    df = pd.DataFrame(rows, columns=["user_id", "date"] + NUTRIENT_COLUMNS).fillna({c: 0 for c in NUTRIENT_COLUMNS})
+    rollups = _nutrition_rows(df) if not df.empty else []
+
+    # Days that no longer have any food logged become tombstones
+    live_days = {(r['user_id'], r['date']) for r in rollups}
+    rollups += [
+        {'user_id': r['user_id'], 'date': r['date'], **{c: 0.0 for c in NUTRIENT_COLUMNS}, 'entry_count': 0}
+        for r in _select_all("daily_nutrition", ["user_id", "date"], filters, ("user_id", "date"))
+        if (r['user_id'], r['date']) not in live_days
+    ]
+    stamp = _now()
+    for r in rollups:
+        r['updated_at'] = stamp
+
+    for i in range(0, len(rollups), ROLLUP_BATCH_SIZE):
+        get_backend().upsert("daily_nutrition", rollups[i:i + ROLLUP_BATCH_SIZE])
+
+    query_cache.invalidate("food_logs", user=user_id)
+    return len(live_days)
+
+@cached("food_logs")
+def get_daily_calories_df(start_date=None, user_id=None):
+    import pandas as pd
+    rows = get_backend().select(
+        "daily_nutrition", columns=("date", "calories"),
+        filters=_mine(user_id) + _since(start_date) + [("entry_count", "gt", 0)], order=[("date", True)]
+    )
+    if rows:
+        return pd.DataFrame(rows).rename(columns={'calories': 'consumed'})
     return pd.DataFrame(columns=['date', 'consumed'])
 
-def save_workout(date, duration_minutes, notes, exercises):
+def save_workout(date, duration_minutes, notes, exercises, user_id=None):
     """
     exercises: list of dicts with keys: exercise_name, sets, reps, weight_kg, rpe
     """
+    user_id = _uid(user_id)
     # 1. Insert workout
-    workout_resp = supabase.table("workouts").insert({
+    workout_rows = get_backend().insert("workouts", {
+        "user_id": user_id,
         "date": date,
         "duration_minutes": duration_minutes,
         "notes": notes
-    }).execute()
+    })
     
-    if workout_resp.data:
-        workout_id = workout_resp.data[0]['id']
+    if workout_rows:
+        workout_id = workout_rows[0]['id']
         
         # 2. Insert exercises
         if exercises:
             for ex in exercises:
                 ex['workout_id'] = workout_id
+                ex['user_id'] = user_id
             
-            supabase.table("workout_exercises").insert(exercises).execute()
+            get_backend().insert("workout_exercises", exercises)
+    query_cache.invalidate("workouts", date, user=user_id)
 
-def get_recent_workouts(limit=10):
-    workouts_resp = supabase.table("workouts").select("*").order("date", desc=True).limit(limit).execute()
-    workouts = workouts_resp.data
-    
-    workout_data = []
-    for w in workouts:
-        exercises_resp = supabase.table("workout_exercises").select("*").eq("workout_id", w['id']).execute()
-        workout_data.append({
-            'workout': w,
-            'exercises': exercises_resp.data
-        })
-    return workout_data
+# Keep PostgREST `in.(...)` URLs well under typical length limits
+EXERCISE_BATCH_SIZE = 500
+
+def _fetch_exercises(workout_ids, user_id):
+    """All exercises for the given workouts in one query per batch, grouped by workout_id."""
+    grouped = {wid: [] for wid in workout_ids}
+    for i in range(0, len(workout_ids), EXERCISE_BATCH_SIZE):
+        batch = workout_ids[i:i + EXERCISE_BATCH_SIZE]
+        rows = get_backend().select(
+            "workout_exercises", filters=[("workout_id", "in", batch)] + _mine(user_id), order=[("id", False)]
+        )
+        for row in rows:
+            grouped[row['workout_id']].append(row)
+    return grouped
+
+@cached("workouts")
+def get_workouts_page(limit=10, cursor=None, user_id=None):
+    """
+    Keyset pagination over (date, id), newest first.
+    cursor: the 'next_cursor' string from the previous page, e.g. "2024-05-01|42".
+    Returns {'items': [{'workout': ..., 'exercises': [...]}], 'next_cursor': str or None}.
+    """
+    filters = _mine(user_id)
+    if cursor:
+        cursor_date, cursor_id = cursor.rsplit("|", 1)
+        filters.append((("date", "id"), "lt", (cursor_date, int(cursor_id))))
+
+    # Fetch one extra row to know whether another page exists
+    workouts = get_backend().select(
+        "workouts", filters=filters, order=[("date", True), ("id", True)], limit=limit + 1
+    )
+    has_more = len(workouts) > limit
+    workouts = workouts[:limit]
 
-def upsert_apple_watch_data(date, steps, active_calories, exercise_minutes, avg_heart_rate):
-    response = supabase.table("apple_watch_data").upsert({
+    exercises = _fetch_exercises([w['id'] for w in workouts], user_id) if workouts else {}
+    items = [{'workout': w, 'exercises': exercises.get(w['id'], [])} for w in workouts]
+
+    next_cursor = f"{workouts[-1]['date']}|{workouts[-1]['id']}" if has_more else None
+    return {'items': items, 'next_cursor': next_cursor}
+
+def get_recent_workouts(limit=10, user_id=None):
+    return get_workouts_page(limit, user_id=user_id)['items']
+
+def upsert_apple_watch_data(date, steps, active_calories, exercise_minutes, avg_heart_rate, user_id=None):
+    user_id = _uid(user_id)
+    response = get_backend().upsert("apple_watch_data", {
+        "user_id": user_id,
         "date": date,
         "steps": steps,
         "active_calories": active_calories,
         "exercise_minutes": exercise_minutes,
-        "avg_heart_rate": avg_heart_rate
-    }).execute()
+        "avg_heart_rate": avg_heart_rate,
+        "updated_at": _now()
+    })
+    query_cache.invalidate("apple_watch_data", date, user=user_id)
     return response
 
-def get_apple_watch_df():
-    response = supabase.table("apple_watch_data").select("*").order("date", desc=True).execute()
-    return pd.DataFrame(response.data)
+APPLE_WATCH_BATCH_SIZE = 1000
+
+def apple_watch_upsert_batches(records, user_id=None):
+    """
+    Rows for upsert_apple_watch_data_bulk, as lists to upsert one per backend call.
+    records: dicts with date and any of steps, active_calories, exercise_minutes,
+    avg_heart_rate (columns left out keep their stored values), and optionally
+    user_id (the ingest queue mixes users); otherwise user_id applies.
+    A later record's fields for the same user and date win, as they would with one upsert per day.
+    """
+    default_user = _uid(user_id)
+    stamp = _now()
+    by_day = {}
+    for r in records:
+        row = dict(r, user_id=r.get('user_id', default_user), updated_at=stamp)
+        by_day.setdefault((row['user_id'], row['date']), {}).update(row)
+    # Records may carry only their changed fields (see ingest_queue); each upsert
+    # gets rows with one set of columns so PostgREST never nulls the missing ones
+    by_columns = {}
+    for row in by_day.values():
+        by_columns.setdefault(tuple(sorted(row)), []).append(row)
+    return [group[i:i + APPLE_WATCH_BATCH_SIZE]
+            for group in by_columns.values() for i in range(0, len(group), APPLE_WATCH_BATCH_SIZE)]
+
+def upsert_apple_watch_data_bulk(records, user_id=None):
+    """Upsert many Apple Watch day records (see apple_watch_upsert_batches) with one backend call per batch."""
+    written, users = [], set()
+    for batch in apple_watch_upsert_batches(records, user_id):
+        written.extend(get_backend().upsert("apple_watch_data", batch))
+        users.update(row['user_id'] for row in batch)
+    for user in users:
+        query_cache.invalidate("apple_watch_data", user=user)
+    return written
+
+@cached("apple_watch_data")
+def get_apple_watch_df(start_date=None, user_id=None):
+    import pandas as pd
+    rows = get_backend().select("apple_watch_data", filters=_mine(user_id) + _since(start_date), order=[("date", True)])
+    return pd.DataFrame(rows)
+
+# ------------- Meals & Recipes -------------
+#
+# Saved lists of foods with gram weights (see database.sql). get_meals
+# aggregates each one with utils.meal_nutrition when the user's meals are
+# first read and caches the result, so logging a meal costs one batched
+# food_logs insert plus the day's rollup refresh, however many items it has.
+
+MEAL_ITEM_COLUMNS = ["food_name", "weight_g", "calories_100g", "protein_100g", "carbs_100g", "fats_100g"]
+MEAL_BATCH_SIZE = 500
+
+def save_meal(name, items, kind="meal", servings=1, user_id=None):
+    """
+    items: dicts with food_name, weight_g and the per-100g macros of a search result
+    (calories_100g, protein_100g, carbs_100g, fats_100g). kind is 'meal' or 'recipe'.
+    Returns the new meal id.
+    """
+    user_id = _uid(user_id)
+    meal_rows = get_backend().insert("meals", {
+        "user_id": user_id,
+        "name": name,
+        "kind": kind,
+        "servings": servings,
+        "updated_at": _now()
+    })
+    meal_id = meal_rows[0]['id'] if meal_rows else None
+    if meal_id is not None and items:
+        get_backend().insert("meal_items", [
+            dict({c: item.get(c) for c in MEAL_ITEM_COLUMNS}, meal_id=meal_id, user_id=user_id) for item in items
+        ])
+    query_cache.invalidate("meals", user=user_id)
+    return meal_id
+
+def delete_meal(meal_id, user_id=None):
+    user_id = _uid(user_id)
+    # Items go with it (ON DELETE CASCADE); scoped to the owner like delete_food_log
+    rows = get_backend().delete("meals", [("id", "eq", meal_id)] + _mine(user_id))
+    query_cache.invalidate("meals", user=user_id)
+    return rows
+
+@cached("meals")
+def get_meals(user_id=None):
+    """
+    The user's saved meals and recipes, by name. Each carries its items and
+    utils.meal_nutrition's aggregation: 'items' (food_logs-ready rows),
+    'total' and 'per_100g'.
+    """
+    from utils import meal_nutrition
+    meals = get_backend().select("meals", filters=_mine(user_id), order=[("name", True)])
+    items = {m['id']: [] for m in meals}
+    ids = list(items)
+    for i in range(0, len(ids), MEAL_BATCH_SIZE):
+        rows = get_backend().select("meal_items", filters=[("meal_id", "in", ids[i:i + MEAL_BATCH_SIZE])] + _mine(user_id),
+                                    order=[("id", True)])
+        for row in rows:
+            items[row['meal_id']].append(row)
+    return [dict(m, **meal_nutrition(items[m['id']], m['name'])) for m in meals]
+
+def log_meal(meal_id, date, meal_name, portion_g=None, user_id=None):
+    """
+    Log a saved meal (every item) or recipe (one row for portion_g grams, by
+    default one serving) in a single batched insert. Returns the inserted rows.
+    """
+    from utils import scale_nutrients
+    user_id = _uid(user_id)
+    meal = next((m for m in get_meals(user_id) if m['id'] == meal_id), None)
+    if meal is None:
+        raise ValueError(f"Meal {meal_id} not found")
+    if meal['kind'] != 'recipe':
+        return log_foods(date, meal_name, meal['items'], user_id)
+    portion_g = portion_g or meal['total']['weight_g'] / (meal.get('servings') or 1)
+    scaled = scale_nutrients(meal['per_100g'], portion_g)
+    return log_foods(date, meal_name, [{
+        "food_name": scaled['name'],
+        "portion_size": f"{portion_g:g}g",
+        **{c: scaled[c] for c in NUTRIENT_COLUMNS}
+    }], user_id)
+
+# ------------- Columnar Reads -------------
+#
+# One plotted column per table as (datetime64[D] days, typed values) arrays for
+# series.DailySeries. Cached under the same tables as the DataFrame readers, so
+# the same writes invalidate them; a cache hit copies two flat arrays.
+
+def _day_arrays(table, column, dtype, filters):
+    import numpy as np
+    rows = get_backend().select(table, columns=["date", column], filters=filters, order=[("date", True)])
+    values = np.array([r[column] for r in rows], dtype=float)
+    keep = ~np.isnan(values)
+    days = np.array([r["date"] for r in rows], dtype="datetime64[D]")[keep]
+    values = values[keep]
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        values = np.rint(values)
+    return days, values.astype(dtype)
+
+@cached("daily_logs")
+def get_weight_arrays(start_date=None, user_id=None):
+    return _day_arrays("daily_logs", "weight_kg", "float32", _mine(user_id) + _since(start_date))
+
+@cached("food_logs")
+def get_calorie_arrays(start_date=None, user_id=None):
+    filters = _mine(user_id) + _since(start_date) + [("entry_count", "gt", 0)]
+    return _day_arrays("daily_nutrition", "calories", "int32", filters)
+
+@cached("apple_watch_data")
+def get_steps_arrays(start_date=None, user_id=None):
+    return _day_arrays("apple_watch_data", "steps", "int32", _mine(user_id) + _since(start_date))
+
+# ------------- Intraday Samples -------------
+#
+# Per-day sample blocks and their minute/hour/day rollups (see intraday.py).
+# An ingest reads the affected blocks in one select, merges the new samples
+# in memory and writes blocks and rollups back with batched upserts, so a
+# day of per-second samples is a handful of round trips.
+
+INTRADAY_BATCH_SIZE = 1000
+
+def ingest_samples(samples, user_id=None):
+    """
+    samples: {metric: (timestamps, values)}, timestamps as accepted by
+    intraday.parse_timestamps; metrics must be in intraday.METRICS.
+    Returns {"samples": stored sample count, "days": blocks written, "rollups": rows written}.
+    """
+    import intraday
+    user_id = _uid(user_id)
+    unknown = set(samples) - set(intraday.METRICS)
+    if unknown:
+        raise ValueError(f"Unknown metric(s): {', '.join(sorted(unknown))}")
+    batches = {}
+    for metric, (timestamps, values) in samples.items():
+        times = intraday.parse_timestamps(timestamps)
+        if len(times) != len(values):
+            raise ValueError(f"{metric}: {len(times)} timestamps but {len(values)} values")
+        for day, seconds, day_values in intraday.split_days(times, values):
+            batches[(metric, day)] = (seconds, day_values)
+    if not batches:
+        return {"samples": 0, "days": 0, "rollups": 0}
+
+    metrics = sorted({m for m, _ in batches})
+    days = sorted({d for _, d in batches})
+    stored = {}
+    for i in range(0, len(days), INTRADAY_BATCH_SIZE):
+        for row in get_backend().select("intraday_blocks", columns=["date", "metric", "samples", "data"],
+                                        filters=_mine(user_id) + [("metric", "in", metrics),
+                                                                  ("date", "in", days[i:i + INTRADAY_BATCH_SIZE])]):
+            stored[(row['metric'], row['date'][:10])] = row
+
+    stamp = _now()
+    blocks, rollup_rows, total = [], [], 0
+    for (metric, day), (seconds, values) in batches.items():
+        row = stored.get((metric, day)) or {}
+        merged_seconds, merged_values = intraday.merge(*intraday.unpack(row.get('data'), row.get('samples')),
+                                                       seconds, values)
+        blocks.append({"user_id": user_id, "date": day, "metric": metric, "samples": int(len(merged_seconds)),
+                       "data": intraday.pack(merged_seconds, merged_values), "updated_at": stamp})
+        rollup_rows.extend(dict(r, user_id=user_id, metric=metric, updated_at=stamp)
+                           for r in intraday.rollups(day, merged_seconds, merged_values, seconds))
+        total += len(seconds)
+    for i in range(0, len(blocks), INTRADAY_BATCH_SIZE):
+        get_backend().upsert("intraday_blocks", blocks[i:i + INTRADAY_BATCH_SIZE])
+    for i in range(0, len(rollup_rows), INTRADAY_BATCH_SIZE):
+        get_backend().upsert("intraday_rollups", rollup_rows[i:i + INTRADAY_BATCH_SIZE])
+    query_cache.invalidate("intraday_rollups", user=user_id)
+    return {"samples": total, "days": len(blocks), "rollups": len(rollup_rows)}
+
+@cached("intraday_rollups")
+def get_intraday_rollups(metric, start, end, resolution=None, user_id=None):
+    """
+    Rollup rows for start <= bucket < end (ISO dates or times), oldest first,
+    each with bucket, n, total, min_value, max_value and mean. resolution
+    ('minute', 'hour' or 'day') defaults to intraday.pick_resolution's choice.
+    Only reads the rollup table, never the sample blocks.
+    """
+    import intraday
+    resolution = resolution or intraday.pick_resolution(start, end)
+    if resolution not in intraday.RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    rows = get_backend().select("intraday_rollups", columns=["bucket", "n", "total", "min_value", "max_value"],
+                                filters=_mine(user_id) + [("metric", "eq", metric), ("resolution", "eq", resolution),
+                                                          ("bucket", "gte", start), ("bucket", "lt", end)],
+                                order=[("bucket", False)])
+    for row in rows:
+        row['mean'] = round(row['total'] / row['n'], 3) if row['n'] else None
+    return rows
+
+# ------------- Delta Sync -------------
+
+# Table -> value column the dashboard plots from it
+SERIES_TABLES = {
+    "daily_logs": "weight_kg",
+    "daily_nutrition": "calories",
+    "apple_watch_data": "steps",
+}
+
+@cached("series")
+def get_series_cursor(user_id=None):
+    """
+    Latest updated_at across the user's plotted tables; a client holding it is up to date.
+    Cached until a local write to one of the tables (or the short "series" TTL, for
+    writes in other workers), so an unchanged warm dashboard render makes no round trips.
+    """
+    user_id = _uid(user_id)
+    def latest(table):
+        rows = get_backend().select(table, columns="updated_at", filters=_mine(user_id) + [("updated_at", "gt", "")],
+                                    order=[("updated_at", True)], limit=1)
+        return rows[0]['updated_at'] if rows else ""
+    return max(latest(table) for table in SERIES_TABLES)
+
+@cached("series")
+def get_series_changes(since, start_date=None, user_id=None):
+    """
+    Rows of the user's plotted tables written after the `since` cursor, restricted
+    to dates from start_date on. Returns ({table: [{date, value, updated_at}]}, new_cursor).
+    Tables that changed have their cached reads dropped so follow-up reads are fresh,
+    even when the write happened in another worker. Cached like the cursor, so the
+    dashboard probe and get_derived_metrics share one read of the feed.
+    """
+    user_id = _uid(user_id)
+    if since and since >= get_series_cursor(user_id):
+        # Nothing written since; answered from the cached cursor without a query
+        return {table: [] for table in SERIES_TABLES}, since
+    changes, cursor = {}, since
+    for table, column in SERIES_TABLES.items():
+        columns = ["date", column, "updated_at"] + (["entry_count"] if table == "daily_nutrition" else [])
+        rows = get_backend().select(table, columns=columns,
+                                    filters=_mine(user_id) + [("updated_at", "gt", since)] + _since(start_date),
+                                    order=[("date", False)])
+        changes[table] = rows
+        if rows:
+            cursor = max(cursor, max(r['updated_at'] for r in rows))
+            # The cursor cached by get_series_cursor above already includes these rows
+            query_cache.invalidate("food_logs" if table == "daily_nutrition" else table, user=user_id, dependents=False)
+    return changes, cursor
+
+# ------------- Derived Metrics State -------------
+
+@cached("metrics_state")
+def get_metrics_state(name="default", user_id=None):
+    """Saved derived-metrics state (see metrics.py), or None."""
+    rows = get_backend().select("metrics_state", filters=_mine(_uid(user_id)) + [("name", "eq", name)], limit=1)
+    return json.loads(rows[0]['state']) if rows and rows[0].get('state') else None
+
+def save_metrics_state(state, name="default", user_id=None):
+    user_id = _uid(user_id)
+    response = get_backend().upsert("metrics_state", {
+        "user_id": user_id,
+        "name": name,
+        "state": json.dumps(state),
+        "updated_at": _now()
+    })
+    query_cache.invalidate("metrics_state", user=user_id)
+    return response
 
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ["rebuild-nutrition"]:
+        print(f"Rebuilt daily_nutrition for {rebuild_daily_nutrition()} days.")
+        sys.exit(0)
+    if sys.argv[1:] == ["recompute-bmi"]:
+        print(f"Recomputed BMI for {recompute_bmi()} days.")
+        sys.exit(0)
+    if sys.argv[1:] == ["create-user"]:
+        user = create_user()
+        print(f"Created user {user['id']}. Webhook token: {issue_webhook_token(user['id'])}")
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == "issue-token":
+        try:
+            print(f"Webhook token for user {sys.argv[2]}: {issue_webhook_token(int(sys.argv[2]))}")
+        except ValueError as e:
+            print(f"Could not issue token: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
     # Test connection
-    print("Testing Supabase connection...")
+    print("Testing database connection...")
     try:
         user = get_user_settings()
-        print(f"Connected successfully! Default user settings: {user}")
+        print(f"Connected successfully to the {get_backend().name} backend! Default user settings: {user}")
     except Exception as e:
         print(f"Connection failed: {e}")
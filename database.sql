@@ -1,29 +1,45 @@
 -- Run these commands in the Supabase SQL Editor to initialize the tables
 
+-- Every table carries user_id. Per-day tables are keyed (user_id, date) and the
+-- other indexes lead with user_id, so each user's reads stay index-bounded no
+-- matter how many users share the database.
+-- Existing single-user projects: add user_id INTEGER NOT NULL DEFAULT 1 to each
+-- table, then recreate the primary keys and indexes below (or export with
+-- `python backup.py export`, recreate the schema and import; rows without a
+-- user_id land on user 1).
+
 CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
     height_cm REAL,
-    maintenance_calories INTEGER
+    maintenance_calories INTEGER,
+    webhook_token_hash TEXT
 );
 
 CREATE TABLE IF NOT EXISTS daily_logs (
-    date TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    date TEXT NOT NULL,
     weight_kg REAL,
     maintenance_calories INTEGER,
     deficit_surplus INTEGER,
-    bmi REAL
+    bmi REAL, -- rewritten by database.recompute_bmi on height change; reads derive it
+    updated_at TEXT,
+    PRIMARY KEY (user_id, date)
 );
 
 CREATE TABLE IF NOT EXISTS apple_watch_data (
-    date TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    date TEXT NOT NULL,
     steps INTEGER,
     active_calories INTEGER,
     exercise_minutes INTEGER,
-    avg_heart_rate REAL
+    avg_heart_rate REAL,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, date)
 );
 
 CREATE TABLE IF NOT EXISTS workouts (
     id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
     date TEXT,
     duration_minutes INTEGER,
     notes TEXT
@@ -31,6 +47,7 @@ CREATE TABLE IF NOT EXISTS workouts (
 
 CREATE TABLE IF NOT EXISTS workout_exercises (
     id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
     workout_id INTEGER REFERENCES workouts(id) ON DELETE CASCADE,
     exercise_name TEXT,
     sets INTEGER,
@@ -41,6 +58,7 @@ CREATE TABLE IF NOT EXISTS workout_exercises (
 
 CREATE TABLE IF NOT EXISTS food_logs (
     id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
     date TEXT,
     meal_name TEXT,
     food_name TEXT,
@@ -51,7 +69,110 @@ CREATE TABLE IF NOT EXISTS food_logs (
     fats_g REAL
 );
 
+-- Per-day nutrition rollup maintained by database.log_food, so the dashboard
+-- reads one row per day instead of scanning every food_logs row.
+-- Rebuild with: python database.py rebuild-nutrition
+CREATE TABLE IF NOT EXISTS daily_nutrition (
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    date TEXT NOT NULL,
+    calories REAL,
+    protein_g REAL,
+    carbs_g REAL,
+    fats_g REAL,
+    entry_count INTEGER,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, date)
+);
+
+-- Webhook tokens are stored as SHA-256 hashes (see database.issue_webhook_token)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_webhook_token_hash ON users (webhook_token_hash);
+
+CREATE INDEX IF NOT EXISTS idx_food_logs_user_date ON food_logs (user_id, date);
+
+-- updated_at (UTC ISO-8601, set by database.py on every write) is the cursor the
+-- dashboard uses to fetch only rows changed since its last sync. Days whose
+-- food logs were all deleted stay in daily_nutrition with entry_count = 0.
+CREATE INDEX IF NOT EXISTS idx_daily_logs_updated_at ON daily_logs (user_id, updated_at);
+CREATE INDEX IF NOT EXISTS idx_apple_watch_data_updated_at ON apple_watch_data (user_id, updated_at);
+CREATE INDEX IF NOT EXISTS idx_daily_nutrition_updated_at ON daily_nutrition (user_id, updated_at);
+
+-- Persisted state of the derived-metrics engine (metrics.py): the trailing
+-- windows it needs to fold in the next day without rereading history.
+CREATE TABLE IF NOT EXISTS metrics_state (
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    state TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, name)
+);
+
+-- Saved meals and recipes: a named list of foods with gram weights. Items keep
+-- the per-100g macros of the search result they came from, so logging a meal
+-- never repeats the food search. A 'meal' logs one food_logs row per item; a
+-- 'recipe' logs one row for the portion eaten, scaled from its per-100g totals.
+CREATE TABLE IF NOT EXISTS meals (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'meal',
+    servings REAL DEFAULT 1,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meal_items (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    meal_id INTEGER NOT NULL REFERENCES meals(id) ON DELETE CASCADE,
+    food_name TEXT,
+    weight_g REAL,
+    calories_100g REAL,
+    protein_100g REAL,
+    carbs_100g REAL,
+    fats_100g REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_meals_user_name ON meals (user_id, name);
+CREATE INDEX IF NOT EXISTS idx_meal_items_meal_id ON meal_items (meal_id);
+
+-- Intraday samples (heart rate, steps, active energy): one block per user, day
+-- and metric. data is the zlib-compressed, base64 encoding of the samples'
+-- delta-encoded second-of-day offsets (uint32) then their values (float32);
+-- samples is how many it holds. See intraday.py.
+CREATE TABLE IF NOT EXISTS intraday_blocks (
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    date TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    samples INTEGER,
+    data TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, date, metric)
+);
+
+-- Minute, hour and day rollups of the blocks, rewritten for the buckets each
+-- ingest touches, so charts never decode samples. bucket is the ISO start time
+-- ('2026-10-17T08:01:00'); the primary key serves range reads per resolution.
+CREATE TABLE IF NOT EXISTS intraday_rollups (
+    user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    n INTEGER,
+    total REAL,
+    min_value REAL,
+    max_value REAL,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, metric, resolution, bucket)
+);
+
+-- Keyset pagination over the journal and batched exercise lookups
+CREATE INDEX IF NOT EXISTS idx_workouts_user_date_id ON workouts (user_id, date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_workout_exercises_workout_id ON workout_exercises (workout_id);
+
 -- Insert a default user record if starting fresh
 INSERT INTO users (id, height_cm, maintenance_calories) 
 VALUES (1, 175.0, 2500)
 ON CONFLICT DO NOTHING;
+
+-- The seed sets id explicitly, so move the sequence past it; otherwise the
+-- next create_user() would be handed id 1 again and fail.
+SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT max(id) FROM users));
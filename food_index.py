@@ -0,0 +1,272 @@
+import csv
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+import unicodedata
+
+# ------------- Local Food Catalogue -------------
+#
+# Builds a compact SQLite file from an Open Food Facts dump (the gzipped
+# tab-separated CSV export or the JSONL export) and answers ranked prefix and
+# fuzzy searches without touching the network.
+#
+# Products are stored in descending popularity order, so FTS5 returns the most
+# scanned products first and a query only ever reads a small candidate window.
+# Query words are first resolved against a vocabulary table (prefix completion,
+# or trigram similarity for typos) into exact terms, which keeps FTS5 on its
+# lazy doclist path instead of materializing huge prefix expansions.
+# The file is opened read-only and memory-mapped: every gunicorn worker shares
+# the same OS page cache instead of holding its own copy.
+
+INDEX_SCHEMA = """
+CREATE TABLE foods (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    calories_100g REAL,
+    protein_100g REAL,
+    carbs_100g REAL,
+    fats_100g REAL,
+    popularity INTEGER
+);
+CREATE VIRTUAL TABLE foods_fts USING fts5(
+    name, content='foods', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TABLE terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT UNIQUE NOT NULL,
+    docs INTEGER
+);
+CREATE VIRTUAL TABLE terms_trigram USING fts5(
+    term, content='terms', content_rowid='id', tokenize='trigram'
+);
+"""
+
+NUTRIENT_FIELDS = {
+    'calories_100g': 'energy-kcal_100g',
+    'protein_100g': 'proteins_100g',
+    'carbs_100g': 'carbohydrates_100g',
+    'fats_100g': 'fat_100g',
+}
+
+# Candidate window read from FTS before re-ranking in Python
+CANDIDATES = 100
+# Vocabulary terms a single query word may expand to
+PREFIX_EXPANSIONS = 8
+PREFIX_SCAN = 2000
+FUZZY_EXPANSIONS = 3
+FUZZY_SCAN = 200
+FUZZY_MIN_SIMILARITY = 0.3
+MMAP_SIZE = 1 << 30
+
+
+def _to_float(value):
+    try:
+        return float(value) if value not in (None, '') else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _iter_dump(path):
+    """Yield (product_name, brands, nutriments, unique_scans_n) from an OFF dump."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace', newline='') as f:
+        if '.jsonl' in path or '.json' in path:
+            rows = (json.loads(line) for line in f if line.strip())
+            for product in rows:
+                nutriments = product.get('nutriments') or {}
+                yield product.get('product_name'), product.get('brands'), nutriments, product.get('unique_scans_n')
+        else:
+            csv.field_size_limit(sys.maxsize)
+            for row in csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                yield row.get('product_name'), row.get('brands'), row, row.get('unique_scans_n')
+
+
+def build_food_index(dump_path, index_path, batch_size=10000, progress=None):
+    """
+    Stream an Open Food Facts dump into a fresh index file at index_path.
+    Products without a name or calorie value are skipped. Returns the product count.
+    """
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(
+        "CREATE TABLE staging (name TEXT, calories_100g REAL, protein_100g REAL, carbs_100g REAL, fats_100g REAL, popularity INTEGER)"
+    )
+
+    batch, seen = [], 0
+    for name, brand, nutriments, scans in _iter_dump(dump_path):
+        name = (name or '').strip()
+        kcal = nutriments.get(NUTRIENT_FIELDS['calories_100g'])
+        if not name or kcal in (None, ''):
+            continue
+        brand = (brand or '').split(',')[0].strip()
+        batch.append((
+            f"{brand} - {name}" if brand else name,
+            *(_to_float(nutriments.get(field)) for field in NUTRIENT_FIELDS.values()),
+            int(_to_float(scans)),
+        ))
+        if len(batch) >= batch_size:
+            conn.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?)", batch)
+            seen += len(batch)
+            batch = []
+            if progress:
+                progress(seen)
+    if batch:
+        conn.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?)", batch)
+        seen += len(batch)
+
+    # Rowid order == popularity order, which is what makes candidate windows work
+    conn.executescript(INDEX_SCHEMA)
+    conn.execute(
+        "INSERT INTO foods (name, calories_100g, protein_100g, carbs_100g, fats_100g, popularity) "
+        "SELECT name, calories_100g, protein_100g, carbs_100g, fats_100g, popularity FROM staging "
+        "ORDER BY popularity DESC, length(name)"
+    )
+    conn.execute("DROP TABLE staging")
+    conn.execute("INSERT INTO foods_fts(foods_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO foods_fts(foods_fts) VALUES ('optimize')")
+
+    # Vocabulary with document counts, plus a trigram index over it for typo matching
+    conn.execute("CREATE VIRTUAL TABLE temp.vocab USING fts5vocab(main, 'foods_fts', 'row')")
+    conn.execute("INSERT INTO terms (term, docs) SELECT term, doc FROM temp.vocab ORDER BY term")
+    conn.execute("INSERT INTO terms_trigram(terms_trigram) VALUES ('rebuild')")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(tmp_path, index_path)
+    if progress:
+        progress(seen)
+    return seen
+
+
+def _trigrams(text, padded=False):
+    if padded:
+        # Word-boundary grams make short typos ("chiken") score closer to their word
+        text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _normalize(text):
+    # Match the unicode61 tokenizer: lower case, diacritics removed
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class FoodIndex:
+    def __init__(self, path):
+        self.path = path
+        # immutable=1 skips locking entirely. A rebuild replaces the file atomically
+        # (a new inode), which get_food_index notices and reopens
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        self.conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+
+    def _expand(self, word):
+        """Resolve a query word to exact vocabulary terms: prefix completions, else typo matches."""
+        rows = self.conn.execute(
+            "SELECT term, docs FROM (SELECT term, docs FROM terms WHERE term >= ? AND term < ? LIMIT ?) "
+            "ORDER BY term = ? DESC, docs DESC LIMIT ?",
+            (word, word + '\uffff', PREFIX_SCAN, word, PREFIX_EXPANSIONS)
+        ).fetchall()
+        if rows:
+            return [term for term, _ in rows]
+
+        grams = _trigrams(word)
+        if not grams:
+            return []
+        padded = _trigrams(word, padded=True)
+        match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+        candidates = self.conn.execute(
+            "SELECT t.term, t.docs FROM (SELECT rowid FROM terms_trigram WHERE terms_trigram MATCH ? LIMIT ?) m "
+            "JOIN terms t ON t.id = m.rowid",
+            (match, FUZZY_SCAN)
+        ).fetchall()
+        scored = []
+        for term, docs in candidates:
+            other = _trigrams(term, padded=True)
+            similarity = len(padded & other) / len(padded | other)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                scored.append((-similarity, -docs, term))
+        return [term for _, _, term in sorted(scored)[:FUZZY_EXPANSIONS]]
+
+    @staticmethod
+    def _result(row):
+        return {
+            'name': row[1],
+            'calories_100g': row[2],
+            'protein_100g': row[3],
+            'carbs_100g': row[4],
+            'fats_100g': row[5],
+        }
+
+    def search(self, query, limit=20):
+        """
+        Ranked prefix/fuzzy search. Every query word must match (by prefix, or by
+        trigram similarity when nothing starts with it). Names that start with
+        the query come first, then products in popularity order.
+        """
+        q = _normalize(query).strip()
+        words = re.findall(r"\w+", q)
+        if not words:
+            return []
+
+        groups = []
+        for word in words:
+            terms = self._expand(word)
+            if not terms:
+                return []
+            groups.append("(" + " OR ".join('"' + t.replace('"', '""') + '"' for t in terms) + ")")
+
+        rows = self.conn.execute(
+            "SELECT f.id, f.name, f.calories_100g, f.protein_100g, f.carbs_100g, f.fats_100g "
+            "FROM (SELECT rowid FROM foods_fts WHERE foods_fts MATCH ? LIMIT ?) m JOIN foods f ON f.id = m.rowid",
+            (" AND ".join(groups), CANDIDATES)
+        ).fetchall()
+
+        # Stable sort keeps popularity (rowid) order within each tier
+        plain = query.lower().strip()
+        rows.sort(key=lambda r: (0 if r[1].lower().startswith(plain) or f" - {plain}" in r[1].lower() else 1, r[0]))
+        return [self._result(r) for r in rows[:limit]]
+
+
+_index = None
+_index_pid = None
+_index_stamp = None
+
+def get_food_index():
+    """
+    Per-process read-only handle, or None when no index has been built.
+    Reopened when the file is rebuilt; searches already running finish on the old one.
+    """
+    global _index, _index_pid, _index_stamp
+    path = os.getenv("FOOD_INDEX_PATH", "food_index.db")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stamp = (st.st_ino, st.st_mtime_ns)
+    if _index is not None and _index_pid == os.getpid() and _index_stamp == stamp:
+        return _index
+    _index = FoodIndex(path)
+    _index_pid = os.getpid()
+    _index_stamp = stamp
+    return _index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'build':
+        out = sys.argv[3] if len(sys.argv) == 4 else os.getenv("FOOD_INDEX_PATH", "food_index.db")
+        count = build_food_index(sys.argv[2], out, progress=lambda n: print(f"Loaded {n} products...", flush=True))
+        print(f"Indexed {count} products into {out}.")
+    elif len(sys.argv) == 3 and sys.argv[1] == 'search':
+        index = get_food_index()
+        for item in (index.search(sys.argv[2]) if index else []):
+            print(f"{item['name']}: {item['calories_100g']} kcal/100g")
+    else:
+        print("Usage: python food_index.py build <openfoodfacts dump .csv.gz|.jsonl.gz> [index path]")
+        print("       python food_index.py search <query>")
@@ -0,0 +1,518 @@
+import asyncio
+import json
+import os
+import time
+from urllib.parse import parse_qs
+from cachetools import TTLCache
+from cache import TABLE_TTL
+import database as db
+import telemetry
+import utils
+from ingest_queue import KEY_FIELDS, get_queue
+
+# ------------- Async Ingestion Service -------------
+#
+# The Apple Health webhooks as a standalone ASGI app, so a device sync never
+# holds a gunicorn thread while the database answers. Validation and
+# fingerprinting are the same as app_dash's apple_health_sync, but the
+# writes are different:
+#   - concurrent requests are coalesced into one bulk upsert per batch
+#     (at most WRITE_BATCH_SIZE records or WRITE_MAX_WAIT seconds);
+#   - at most MAX_IN_FLIGHT batches are written at once, over a pooled
+#     httpx.AsyncClient to PostgREST (or the local SQLite file in a
+#     worker thread);
+#   - beyond MAX_PENDING unanswered records, new requests get a 503 with
+#     Retry-After instead of queueing without bound.
+# The response is sent once the batch is written, so there is no 202 here.
+#
+#   uvicorn ingest_asgi:app --port 8001                        # webhooks only
+#   uvicorn ingest_asgi:create_combined_app --factory --port 8000  # webhooks + Dash
+
+WRITE_BATCH_SIZE = int(os.getenv("INGEST_WRITE_BATCH_SIZE", "500"))
+WRITE_MAX_WAIT = float(os.getenv("INGEST_WRITE_MAX_WAIT", "0.005"))
+MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "8"))
+MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "5000"))
+# PostgREST connections per process; writes use at most MAX_IN_FLIGHT of them
+DB_POOL_SIZE = int(os.getenv("INGEST_DB_POOL_SIZE", "16"))
+DB_TIMEOUT = 10.0
+MAX_BODY_BYTES = 5 * 1024 * 1024
+TOKEN_TTL = TABLE_TTL["tokens"]
+
+
+class Overloaded(Exception):
+    pass
+
+
+class PostgrestBackend:
+    """Async select/upsert against Supabase's REST API over one pooled httpx.AsyncClient."""
+    name = "supabase"
+
+    def __init__(self, url, key, pool_size=DB_POOL_SIZE):
+        import httpx
+        self.client = httpx.AsyncClient(
+            base_url=f"{url.rstrip('/')}/rest/v1",
+            headers={"apikey": key, "Authorization": f"Bearer {key}"},
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=DB_TIMEOUT,
+        )
+
+    async def _call(self, op, table, method, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, f"/{table}", **kwargs)
+            response.raise_for_status()
+        except Exception:
+            telemetry.DB_CALLS.observe(time.perf_counter() - start, op, table, "error")
+            raise
+        telemetry.DB_CALLS.observe(time.perf_counter() - start, op, table, "ok")
+        return response.json() if response.content else []
+
+    async def select(self, table, columns="*", filters=None, limit=None):
+        params = {"select": columns if isinstance(columns, str) else ",".join(columns)}
+        for column, op, value in filters or []:
+            params[column] = f"in.({','.join(map(str, value))})" if op == "in" else f"{op}.{value}"
+        if limit is not None:
+            params["limit"] = limit
+        return await self._call("select", table, "GET", params=params)
+
+    async def upsert(self, table, rows):
+        return await self._call("upsert", table, "POST", json=rows,
+                                headers={"Prefer": "resolution=merge-duplicates,return=minimal"})
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ThreadedBackend:
+    """A synchronous backend (the local SQLite file) called from worker threads."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.name = inner.name
+
+    async def select(self, table, columns="*", filters=None, limit=None):
+        return await asyncio.to_thread(self.inner.select, table, columns, filters, None, limit)
+
+    async def upsert(self, table, rows):
+        return await asyncio.to_thread(self.inner.upsert, table, rows)
+
+    async def aclose(self):
+        pass
+
+
+def create_async_backend():
+    """Same configuration as backends.create_backend (DB_BACKEND, SUPABASE_URL/KEY, SQLITE_PATH)."""
+    kind = (os.getenv("DB_BACKEND") or ("supabase" if os.getenv("SUPABASE_URL") else "sqlite")).lower()
+    if kind == "supabase":
+        url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+        if not url or not key:
+            raise ValueError("Missing Supabase credentials. Ensure SUPABASE_URL and SUPABASE_KEY are set in .env")
+        return PostgrestBackend(url, key)
+    return ThreadedBackend(db.get_backend())
+
+
+class BatchWriter:
+    """Coalesces Apple Watch day records from concurrent requests into bounded, batched upserts."""
+
+    def __init__(self, backend, batch_size=WRITE_BATCH_SIZE, max_wait=WRITE_MAX_WAIT,
+                 max_in_flight=MAX_IN_FLIGHT, max_pending=MAX_PENDING):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.batch = []
+        self.batch_records = 0
+        self.timer = None
+        self.tasks = set()
+        self.outstanding = 0
+        self.stats = {"requests": 0, "records": 0, "written": 0, "skipped": 0, "batches": 0, "upserts": 0,
+                      "rejected": 0, "errors": 0}
+
+    async def submit(self, records):
+        """
+        Write records with the next batch. Resolves to each record's change
+        as ingest_queue.changes reports it (None when unchanged), once written.
+        Raises Overloaded when MAX_PENDING records are already waiting.
+        """
+        if self.outstanding + len(records) > self.max_pending:
+            self.stats["rejected"] += 1
+            raise Overloaded(f"{self.outstanding} records pending")
+        future = asyncio.get_running_loop().create_future()
+        self.batch.append((records, future))
+        self.batch_records += len(records)
+        self.outstanding += len(records)
+        self.stats["requests"] += 1
+        if self.batch_records >= self.batch_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.batch, self.batch_records = self.batch, [], 0
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _write(self, batch):
+        records = [record for records, _ in batch for record in records]
+        try:
+            async with self.slots:
+                queue = get_queue()
+                changes = await asyncio.to_thread(queue.changes, records)
+                changed = [c for c in changes if c is not None]
+                for rows in db.apple_watch_upsert_batches(changed):
+                    await self.backend.upsert("apple_watch_data", rows)
+                    self.stats["upserts"] += 1
+                # Dash reads in this process (create_combined_app) must not serve the old rows
+                for user in {record['user_id'] for record in changed}:
+                    db.query_cache.invalidate("apple_watch_data", user=user)
+                await asyncio.to_thread(queue.remember, changed, len(records) - len(changed))
+        except Exception as e:
+            print(f"Async ingest write failed for {len(records)} records: {e}")
+            self.stats["errors"] += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.outstanding -= len(records)
+        self.stats["batches"] += 1
+        self.stats["records"] += len(records)
+        self.stats["written"] += len(changed)
+        self.stats["skipped"] += len(records) - len(changed)
+        i = 0
+        for records, future in batch:
+            if not future.done():
+                future.set_result(changes[i:i + len(records)])
+            i += len(records)
+
+    async def drain(self):
+        """Write whatever is batched and wait for every write in flight."""
+        self._flush()
+        while self.tasks:
+            tasks = list(self.tasks)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Awaiting finished tasks doesn't yield, so their discard callbacks may not have run yet
+            self.tasks.difference_update(tasks)
+
+
+class IngestService:
+    def __init__(self, backend=None):
+        self.backend = backend or create_async_backend()
+        self.writer = BatchWriter(self.backend)
+        self.tokens = TTLCache(maxsize=4096, ttl=TOKEN_TTL)
+
+    async def user_for_token(self, token):
+        """Like database.get_user_id_for_token, cached per process; None if invalid."""
+        if not token:
+            return None
+        digest = db.token_hash(token)
+        if digest not in self.tokens:
+            rows = await self.backend.select("users", columns="id", filters=[("webhook_token_hash", "eq", digest)],
+                                             limit=1)
+            if not rows:
+                return None
+            self.tokens[digest] = rows[0]['id']
+        return self.tokens[digest]
+
+    async def aclose(self):
+        await self.writer.drain()
+        await self.backend.aclose()
+
+
+_service = None
+_service_pid = None
+
+def get_service():
+    """Per-process service, created inside the event loop on first use."""
+    global _service, _service_pid
+    if _service is None or _service_pid != os.getpid():
+        _service = IngestService()
+        _service_pid = os.getpid()
+    return _service
+
+telemetry.register_collector(
+    "async_ingest_total", "counter", "Async ingest requests, records, batches, upserts and rejections.", ("event",),
+    lambda: {(event,): value for event, value in (_service.writer.stats.items() if _service else ())}
+)
+
+# ------------- ASGI Plumbing -------------
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get("more_body"):
+            return body
+
+async def _send(send, status, body, content_type, headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]
+                + list(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+async def _send_json(send, status, payload, headers=()):
+    await _send(send, status, json.dumps(payload).encode(), b"application/json", headers)
+
+def _header(scope, name):
+    return next((v.decode() for k, v in scope["headers"] if k == name), "")
+
+def _token(scope):
+    auth = _header(scope, b"authorization")
+    if auth.startswith("Bearer "):
+        return auth[7:].strip()
+    return parse_qs(scope.get("query_string", b"").decode()).get("token", [""])[0]
+
+async def _submit(send, records):
+    """Write records; returns their changes, or None after answering 503 / 500 itself."""
+    try:
+        return await get_service().writer.submit(records)
+    except Overloaded as e:
+        await _send_json(send, 503, {"status": "error", "message": f"Busy: {e}"}, [(b"retry-after", b"1")])
+    except Exception as e:
+        await _send_json(send, 500, {"status": "error", "message": str(e)})
+    return None
+
+# ------------- Routes -------------
+
+async def apple_health_sync(scope, body, send, user_id):
+    """Same payload and validation as app_dash's /api/apple-health-sync; 200 once written."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not all(k in data for k in utils.APPLE_WATCH_REQUIRED):
+        return await _send_json(send, 400, {"status": "error", "message": "Missing required fields"})
+    rows, errors = utils.validate_apple_watch_records([data])
+    if errors:
+        return await _send_json(send, 400, {"status": "error", "message": errors[0]})
+    record = dict(rows[0][1], user_id=user_id)
+    changes = await _submit(send, [record])
+    if changes is None:
+        return
+    if changes[0] is None:
+        return await _send_json(send, 200, {"status": "unchanged", "message": f"No changes for {record['date']}",
+                                            "written": 0, "skipped": 1})
+    await _send_json(send, 200, {"status": "success", "message": f"Saved data for {record['date']}", "written": 1,
+                                 "skipped": 0, "fields": sorted(k for k in changes[0] if k not in KEY_FIELDS)})
+
+async def apple_health_sync_bulk(scope, body, send, user_id):
+    """Same as app_dash's /api/apple-health-sync/bulk (JSON array or NDJSON, per-record results)."""
+    if _header(scope, b"content-type").startswith("application/x-ndjson"):
+        records = []
+        for line in body.decode().splitlines():
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    records.append(None)
+    else:
+        try:
+            records = json.loads(body)
+        except ValueError:
+            records = None
+    if not isinstance(records, list):
+        return await _send_json(send, 400, {"status": "error", "message": "Expected a JSON array or NDJSON body"})
+    # Large batches are validated with pandas; keep that off the event loop
+    rows, errors = await asyncio.to_thread(utils.validate_apple_watch_records, records)
+    changes = await _submit(send, [dict(row, user_id=user_id) for _, row in rows]) if rows else []
+    if changes is None:
+        return
+    results = [
+        {"index": i, "date": row['date'], "status": "success" if change is not None else "unchanged"}
+        for (i, row), change in zip(rows, changes)
+    ]
+    results += [{"index": i, "status": "error", "message": msg} for i, msg in errors.items()]
+    results.sort(key=lambda r: r["index"])
+    written = sum(c is not None for c in changes)
+    await _send_json(send, 200, {
+        "status": "success" if not errors else "partial",
+        "written": written,
+        "skipped": len(rows) - written,
+        "failed": len(errors),
+        "results": results
+    })
+
+async def ingest_status(scope, body, send, user_id):
+    """Batching and backpressure counters of this process's writer."""
+    writer = get_service().writer
+    batches = writer.stats["batches"]
+    await _send_json(send, 200, dict(writer.stats, outstanding=writer.outstanding,
+                                     mean_batch=round(writer.stats["records"] / batches, 1) if batches else 0.0))
+
+async def metrics(scope, body, send, user_id):
+    """Prometheus scrape endpoint, as app_dash's (per process)."""
+    await _send(send, 200, telemetry.render().encode(), b"text/plain; version=0.0.4; charset=utf-8")
+
+# (method, path) -> (handler, needs a webhook token)
+ROUTES = {
+    ("POST", "/api/apple-health-sync"): (apple_health_sync, True),
+    ("POST", "/api/apple-health-sync/bulk"): (apple_health_sync_bulk, True),
+    ("GET", "/api/ingest-status"): (ingest_status, False),
+    ("GET", "/metrics"): (metrics, False),
+}
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_service()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _service is not None:
+                await _service.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    """The ingestion routes alone; anything else is a 404."""
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    route = ROUTES.get((scope["method"], scope["path"]))
+    if route is None:
+        return await _send_json(send, 404, {"status": "error", "message": "Not found"})
+    handler, needs_token = route
+    start = time.perf_counter()
+    status = {}
+
+    async def send_and_record(message):
+        if message["type"] == "http.response.start":
+            status["code"] = message["status"]
+        await send(message)
+
+    try:
+        body = await _read_body(receive)
+        if body is None:
+            return await _send_json(send_and_record, 413, {"status": "error", "message": "Payload too large"})
+        user_id = None
+        if needs_token:
+            user_id = await get_service().user_for_token(_token(scope))
+            if user_id is None:
+                return await _send_json(send_and_record, 401,
+                                        {"status": "error", "message": "Missing or invalid webhook token"})
+        await handler(scope, body, send_and_record, user_id)
+    finally:
+        telemetry.HTTP_REQUESTS.observe(time.perf_counter() - start, scope["path"], scope["method"],
+                                        str(status.get("code", 500)))
+
+# ------------- Mounting next to Dash -------------
+
+def mount(fallback):
+    """ASGI app serving the ingestion routes itself and every other request with fallback (an ASGI app)."""
+    async def combined(scope, receive, send):
+        if scope["type"] == "http" and (scope["method"], scope["path"]) not in ROUTES:
+            return await fallback(scope, receive, send)
+        return await app(scope, receive, send)
+    return combined
+
+def from_wsgi(wsgi_app):
+    """
+    Minimal ASGI adapter for a WSGI app (the Dash/Flask server): buffers the
+    request and response and runs the app in a worker thread.
+    """
+    import io
+    import sys
+
+    async def asgi(scope, receive, send):
+        body = await _read_body(receive)
+        if body is None:
+            return await _send_json(send, 413, {"status": "error", "message": "Payload too large"})
+        host, port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"],
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": host,
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            key = name.decode("latin-1").upper().replace("-", "_")
+            if key == "CONTENT_LENGTH":
+                # The buffered body's length (set above) is authoritative
+                continue
+            if key != "CONTENT_TYPE":
+                key = "HTTP_" + key
+            environ[key] = f"{environ[key]},{value.decode('latin-1')}" if key in environ else value.decode("latin-1")
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+        def run():
+            result = wsgi_app(environ, start_response)
+            try:
+                return b"".join(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+        content = await asyncio.to_thread(run)
+        await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+        await send({"type": "http.response.body", "body": content})
+
+    return asgi
+
+def create_combined_app():
+    """The webhooks served async, everything else by the Dash server (for uvicorn --factory)."""
+    from app_dash import server
+    return mount(from_wsgi(server))
+
+def check_wsgi_bridge():
+    """Round-trip a POSTed body through from_wsgi to a Flask echo app; returns True if it arrives intact."""
+    from flask import Flask, request
+    echo = Flask("wsgi_bridge_check")
+
+    @echo.route("/echo", methods=["POST"])
+    def echo_body():
+        return {"body": request.get_data(as_text=True), "content_type": request.content_type,
+                "form": request.form.to_dict()}
+
+    body = b"a=1&b=two"
+    scope = {"type": "http", "method": "POST", "path": "/echo", "query_string": b"", "http_version": "1.1",
+             "headers": [(b"content-type", b"application/x-www-form-urlencoded"),
+                         (b"content-length", str(len(body)).encode())]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(from_wsgi(echo.wsgi_app)(scope, receive, send))
+    result = json.loads(sent[1]["body"])
+    ok = sent[0]["status"] == 200 and result["body"] == body.decode() and result["form"] == {"a": "1", "b": "two"}
+    print(f"WSGI bridge: {'ok' if ok else 'FAILED'} {result}")
+    return ok
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ["check-wsgi-bridge"]:
+        sys.exit(0 if check_wsgi_bridge() else 1)
+    print("Usage: python ingest_asgi.py check-wsgi-bridge")
+    sys.exit(2)
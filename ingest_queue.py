@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# ------------- Durable Write-behind Ingestion Queue -------------
+#
+# The webhook appends validated Apple Watch day records to a local SQLite
+# journal (WAL mode) and answers 202 straight away. A background worker drains
+# the journal: payloads for the same user and date are coalesced, written with one bulk
+# upsert, and retried with exponential backoff if the backend is unavailable.
+#
+# Rows are claimed with a short lease, so several gunicorn workers can share
+# one journal file without writing the same batch twice at the same time.
+#
+# The same file keeps a fingerprint of the fields last sent for each user and
+# date. Shortcuts resend identical totals many times a day; those are
+# acknowledged without being queued, and changed days only carry the fields
+# that differ. Fingerprints expire after FINGERPRINT_TTL, which bounds how long
+# a write made some other way (another host, a restore) can mask a resend.
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    lease_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_ready ON ingest_queue (next_attempt_at, id);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    user_id INTEGER,
+    date TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (user_id, date)
+);
+CREATE INDEX IF NOT EXISTS idx_fingerprints_seen_at ON fingerprints (seen_at);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+BATCH_SIZE = 500
+LEASE_SECONDS = 30.0
+POLL_INTERVAL = 0.5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+# After this many failed writes a payload moves to dead_letters instead of retrying forever
+MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "8"))
+FINGERPRINT_TTL = float(os.getenv("INGEST_FINGERPRINT_TTL", 6 * 3600))
+PRUNE_INTERVAL = 600.0
+# Identify a record rather than describe it, so never part of a fingerprint
+KEY_FIELDS = ("user_id", "date")
+
+
+def fingerprint(fields):
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+class IngestQueue:
+    def __init__(self, path="ingest_queue.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(QUEUE_SCHEMA)
+        self.wake = threading.Event()
+        self.worker = None
+        self.change_counts = {"written": 0, "skipped": 0}
+        self.pruned_at = 0.0
+
+    def _changes(self, records, now):
+        """Per record: a copy holding its key fields plus only the changed fields, or None if nothing changed."""
+        out = []
+        for record in records:
+            fields = {k: v for k, v in record.items() if k not in KEY_FIELDS}
+            row = self.conn.execute(
+                "SELECT digest, fields FROM fingerprints WHERE user_id IS ? AND date = ? AND seen_at > ?",
+                (record.get('user_id'), record['date'], now - FINGERPRINT_TTL)
+            ).fetchone()
+            if row is None:
+                out.append(dict(record))
+                continue
+            if row['digest'] == fingerprint(fields):
+                out.append(None)
+                continue
+            previous = json.loads(row['fields'])
+            changed = {k: v for k, v in fields.items() if k not in previous or previous[k] != v}
+            out.append(dict({k: record[k] for k in KEY_FIELDS if k in record}, **changed) if changed else None)
+        return out
+
+    def _remember(self, records, now):
+        """Merge written fields into each user and date's fingerprint."""
+        for record in records:
+            key = (record.get('user_id'), record['date'])
+            row = self.conn.execute(
+                "SELECT fields FROM fingerprints WHERE user_id IS ? AND date = ? AND seen_at > ?",
+                key + (now - FINGERPRINT_TTL,)
+            ).fetchone()
+            fields = json.loads(row['fields']) if row else {}
+            fields.update((k, v) for k, v in record.items() if k not in KEY_FIELDS)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (user_id, date, digest, fields, seen_at) VALUES (?, ?, ?, ?, ?)",
+                key + (fingerprint(fields), json.dumps(fields), now)
+            )
+        if now - self.pruned_at > PRUNE_INTERVAL:
+            self.conn.execute("DELETE FROM fingerprints WHERE seen_at <= ?", (now - FINGERPRINT_TTL,))
+            self.pruned_at = now
+
+    def changes(self, records):
+        """
+        What would be written for each record: None when it matches the fields
+        already sent for its user and date, else the record trimmed to its key
+        fields and the fields that changed. Call remember() once they are written.
+        """
+        with self.lock:
+            return self._changes(records, time.time())
+
+    def remember(self, records, skipped=0):
+        """Fingerprint records that were written directly (not queued); skipped counts the unchanged ones."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._remember(records, time.time())
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.change_counts["written"] += len(records)
+            self.change_counts["skipped"] += skipped
+
+    def forget(self, user_id=None):
+        """Drop fingerprints (one user's, or all), e.g. after the database was restored."""
+        with self.lock:
+            if user_id is None:
+                self.conn.execute("DELETE FROM fingerprints")
+            else:
+                self.conn.execute("DELETE FROM fingerprints WHERE user_id = ?", (user_id,))
+
+    def forget_days(self, keys):
+        """Drop the fingerprints of these (user_id, date) pairs, e.g. days a restore overwrote."""
+        with self.lock:
+            self.conn.executemany("DELETE FROM fingerprints WHERE user_id IS ? AND date = ?", list(keys))
+
+    def enqueue_changes(self, records):
+        """
+        Queue only what changed (see changes()), fingerprinting it in the same
+        transaction; the journal is durable, so what is queued will be written.
+        Returns (queued records, number skipped as unchanged).
+        """
+        now = time.time()
+        with self.lock:
+            # IMMEDIATE so two workers sharing the file can't both see a day as changed
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                changed = [c for c in self._changes(records, now) if c is not None]
+                self.conn.executemany(
+                    "INSERT INTO ingest_queue (date, payload, received_at) VALUES (?, ?, ?)",
+                    [(r['date'], json.dumps(r), now) for r in changed]
+                )
+                self._remember(changed, now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.change_counts["written"] += len(changed)
+            self.change_counts["skipped"] += len(records) - len(changed)
+        if changed:
+            self.wake.set()
+        return changed, len(records) - len(changed)
+
+    def _claim(self, batch_size):
+        now = time.time()
+        with self.lock:
+            return self.conn.execute(
+                """UPDATE ingest_queue SET lease_until = ?
+                   WHERE id IN (SELECT id FROM ingest_queue
+                                WHERE next_attempt_at <= ? AND lease_until <= ?
+                                ORDER BY id LIMIT ?)
+                   RETURNING *""",
+                (now + LEASE_SECONDS, now, now, batch_size)
+            ).fetchall()
+
+    def drain_once(self, upsert, batch_size=BATCH_SIZE):
+        """
+        Claim one batch, coalesce it per (user_id, date) and write it with upsert(records).
+        If the bulk write fails, each day is written on its own; days that still
+        fail back off (or are dead-lettered) without holding up the others.
+        Returns the number of journal rows consumed (0 when nothing was ready).
+        """
+        rows = self._claim(batch_size)
+        if not rows:
+            return 0
+
+        # Later payloads for a user's day overwrite earlier fields, in arrival order
+        coalesced = {}
+        for row in sorted(rows, key=lambda r: r['id']):
+            payload = json.loads(row['payload'])
+            record, day_rows = coalesced.setdefault((payload.get('user_id'), row['date']), ({}, []))
+            record.update(payload)
+            day_rows.append(row)
+
+        try:
+            upsert([record for record, _ in coalesced.values()])
+            self._done([row for _, day_rows in coalesced.values() for row in day_rows])
+            return len(rows)
+        except Exception as e:
+            if len(coalesced) == 1:
+                self._failed(rows, e)
+                return 0
+            print(f"Ingest queue batch of {len(coalesced)} days failed, retrying each day: {e}")
+
+        consumed = 0
+        for record, day_rows in coalesced.values():
+            try:
+                upsert([record])
+            except Exception as e:
+                self._failed(day_rows, e)
+                continue
+            self._done(day_rows)
+            consumed += len(day_rows)
+        return consumed
+
+    def _done(self, rows):
+        ids = [row['id'] for row in rows]
+        with self.lock:
+            self.conn.execute(f"DELETE FROM ingest_queue WHERE id IN ({', '.join('?' * len(ids))})", ids)
+
+    def _failed(self, rows, error):
+        """Back off one day's journal rows, or dead-letter them once they reach MAX_ATTEMPTS."""
+        ids = [row['id'] for row in rows]
+        marks = ", ".join("?" * len(ids))
+        attempts = max(row['attempts'] for row in rows) + 1
+        now = time.time()
+        with self.lock:
+            if attempts >= MAX_ATTEMPTS:
+                print(f"Ingest queue gave up on {rows[0]['date']} after {attempts} attempts: {error}")
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self.conn.execute(
+                        f"""INSERT INTO dead_letters (id, date, payload, received_at, attempts, last_error, failed_at)
+                            SELECT id, date, payload, received_at, ?, ?, ? FROM ingest_queue WHERE id IN ({marks})""",
+                        [attempts, str(error), now] + ids
+                    )
+                    self.conn.execute(f"DELETE FROM ingest_queue WHERE id IN ({marks})", ids)
+                    # The day was never written, so a resend of it must not be skipped as unchanged
+                    self.conn.execute("DELETE FROM fingerprints WHERE user_id IS ? AND date = ?",
+                                      (json.loads(rows[0]['payload']).get('user_id'), rows[0]['date']))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                return
+            delay = min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+            print(f"Ingest queue write failed for {rows[0]['date']} (attempt {attempts}), retrying in {delay:.0f}s: {error}")
+            self.conn.execute(
+                f"UPDATE ingest_queue SET attempts = ?, next_attempt_at = ?, lease_until = 0, last_error = ? WHERE id IN ({marks})",
+                [attempts, now + delay, str(error)] + ids
+            )
+
+    def stats(self):
+        """Queue depth, age of the oldest pending payload, retry state and dead-lettered payloads."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT COUNT(*) AS depth, MIN(received_at) AS oldest, MAX(attempts) AS max_attempts FROM ingest_queue"
+            ).fetchone()
+            dead = self.conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        return {
+            "depth": row['depth'],
+            "lag_seconds": round(time.time() - row['oldest'], 3) if row['oldest'] else 0.0,
+            "max_attempts": row['max_attempts'] or 0,
+            "dead_letters": dead,
+        }
+
+    def start_worker(self, upsert):
+        """Start the background drain thread once per process."""
+        if self.worker and self.worker.is_alive():
+            return self.worker
+
+        def run():
+            while True:
+                self.wake.clear()
+                try:
+                    consumed = self.drain_once(upsert)
+                except Exception as e:
+                    print(f"Ingest worker error: {e}")
+                    consumed = 0
+                if not consumed:
+                    self.wake.wait(POLL_INTERVAL)
+
+        self.worker = threading.Thread(target=run, name="ingest-worker", daemon=True)
+        self.worker.start()
+        return self.worker
+
+
+_queue = None
+_queue_pid = None
+
+def get_queue():
+    """Per-process queue handle, opened lazily so it is never shared across a fork."""
+    global _queue, _queue_pid
+    if _queue is None or _queue_pid != os.getpid():
+        _queue = IngestQueue(os.getenv("INGEST_QUEUE_PATH", "ingest_queue.db"))
+        _queue_pid = os.getpid()
+    return _queue
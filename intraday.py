@@ -0,0 +1,129 @@
+import base64
+import zlib
+import numpy as np
+
+# ------------- Intraday Samples -------------
+#
+# Timestamped samples (heart rate every few seconds, step and energy counts)
+# are stored as one block per user, day and metric rather than one row per
+# sample: the wall-clock second of the day of each sample, delta-encoded as
+# uint32, followed by the float32 values, zlib-compressed and base64'd into a
+# TEXT column. A day of per-second heart rate (86,400 samples) is one ~60 KB
+# row instead of 86,400 rows (~690 KB of raw arrays).
+#
+# Charts never decode blocks. Every ingest recomputes the minute, hour and
+# day rollups (count, sum, min, max) of just the buckets the new samples fall
+# in, from the merged block already in memory, and upserts those rows.
+
+METRICS = ("heart_rate", "steps", "active_energy")
+# Bucket width in seconds per rollup resolution
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+SECONDS_PER_DAY = 86400
+# Sample times outside this window are rejected as malformed
+EARLIEST, LATEST = np.datetime64("2000-01-01", "s"), np.datetime64("2100-01-01", "s")
+
+
+def parse_timestamps(ts):
+    """
+    Sample times as datetime64[s] wall-clock times. ISO strings keep the local
+    time they were written in (any UTC offset is dropped, so a sample lands on
+    the same date as the daily records); numbers are Unix seconds, read as UTC.
+    One batch uses one form. Raises ValueError for unparseable or implausible times.
+    """
+    ts = list(ts)
+    if ts and isinstance(ts[0], (int, float)):
+        times = np.asarray(ts, dtype=np.float64).astype(np.int64).astype("datetime64[s]")
+    else:
+        times = np.array([str(t)[:19] for t in ts], dtype="datetime64[s]")
+    if len(times) and (times.min() < EARLIEST or times.max() >= LATEST):
+        raise ValueError(f"Timestamps must fall between {EARLIEST} and {LATEST}")
+    return times
+
+
+def split_days(times, values):
+    """Yield (day as 'YYYY-MM-DD', second-of-day uint32 array, float32 values) per day in the batch."""
+    times = np.asarray(times, dtype="datetime64[s]")
+    values = np.asarray(values, dtype=np.float64)
+    # Drops NaN (nulls), ±inf and values too large to store as float32
+    keep = np.isfinite(values) & (np.abs(values) <= np.finfo(np.float32).max)
+    times, values = times[keep], values[keep].astype(np.float32)
+    if not len(times):
+        return
+    days = times.astype("datetime64[D]")
+    first = days.min()
+    offsets = (days - first).astype(np.int64)
+    # bincount instead of np.unique: no sort, and a batch rarely spans more than a day or two
+    for offset in np.flatnonzero(np.bincount(offsets)):
+        day = first + np.timedelta64(offset, "D")
+        mask = offsets == offset
+        seconds = (times[mask] - day).astype(np.int64).astype(np.uint32)
+        yield str(day), seconds, values[mask]
+
+
+def pack(seconds, values):
+    """Encode sorted, unique second-of-day offsets and their values as block text."""
+    deltas = np.diff(seconds, prepend=np.uint32(0)).astype(np.uint32)
+    return base64.b64encode(zlib.compress(deltas.tobytes() + values.astype(np.float32).tobytes(), 6)).decode()
+
+
+def unpack(data, n):
+    """Inverse of pack: (seconds uint32, values float32) for a block of n samples."""
+    if not data or not n:
+        return np.array([], dtype=np.uint32), np.array([], dtype=np.float32)
+    raw = zlib.decompress(base64.b64decode(data))
+    seconds = np.cumsum(np.frombuffer(raw, dtype=np.uint32, count=n), dtype=np.uint32)
+    return seconds, np.frombuffer(raw, dtype=np.float32, count=n, offset=4 * n).copy()
+
+
+def merge(seconds, values, new_seconds, new_values):
+    """Union of two sample sets, sorted by second; for a repeated second the newer value wins."""
+    seconds = np.concatenate([seconds, new_seconds])
+    values = np.concatenate([values, new_values])
+    # Stable, so for equal seconds the new samples stay after the stored ones
+    order = np.argsort(seconds, kind="stable")
+    seconds, values = seconds[order], values[order]
+    last = np.r_[seconds[1:] != seconds[:-1], True]
+    return seconds[last], values[last]
+
+
+def rollups(day, seconds, values, touched):
+    """
+    Rollup rows for one day's merged samples: every minute, hour and day
+    bucket that contains one of the touched seconds. Rows hold resolution,
+    bucket (ISO start time), n, total, min_value and max_value.
+    """
+    start = np.datetime64(day, "s")
+    wide = values.astype(np.float64)
+    rows = []
+    for resolution, width in RESOLUTIONS.items():
+        keys = seconds // width
+        # Seconds are sorted, so each bucket is a contiguous run
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        bucket_keys = keys[starts]
+        hit = np.zeros(SECONDS_PER_DAY // width + 1, dtype=bool)
+        hit[np.asarray(touched) // width] = True
+        keep = hit[bucket_keys]
+        counts = np.diff(np.r_[starts, len(keys)])[keep]
+        totals = np.add.reduceat(wide, starts)[keep]
+        lows = np.minimum.reduceat(values, starts)[keep]
+        highs = np.maximum.reduceat(values, starts)[keep]
+        buckets = np.datetime_as_string(start + (bucket_keys[keep].astype(np.int64) * width).astype("timedelta64[s]"))
+        rows.extend({
+            "resolution": resolution,
+            "bucket": bucket,
+            "n": int(n),
+            "total": round(float(total), 3),
+            "min_value": float(low),
+            "max_value": float(high),
+        } for bucket, n, total, low, high in zip(buckets.tolist(), counts, totals, lows, highs))
+    return rows
+
+
+def pick_resolution(start, end):
+    """Finest resolution that keeps a chart of start..end (ISO dates or times) to a few thousand points."""
+    span = (np.datetime64(end, "s") - np.datetime64(start, "s")).astype(np.int64)
+    if span <= 2 * SECONDS_PER_DAY:
+        return "minute"
+    if span <= 92 * SECONDS_PER_DAY:
+        return "hour"
+    return "day"
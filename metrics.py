@@ -0,0 +1,247 @@
+import copy
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import database as db
+
+# ------------- Derived Metrics -------------
+#
+# Trend weight (an exponentially weighted moving average of weigh-ins), 7/28-day
+# average intake and steps, and an adaptive TDEE estimate:
+#
+#     TDEE = mean intake over 28 days - KCAL_PER_KG * (trend change over 28 days) / 28
+#
+# A full history pass is vectorized over a continuous daily grid. Its output also
+# seeds a small persisted state (the trailing windows plus the last trend value),
+# so each new day is folded in with a constant amount of work instead of a full
+# recompute on every render. The state covers closed days only (before today);
+# today's partial data is applied to a copy. Editing a closed day, changing the
+# engine (STATE_VERSION) or losing the state triggers one full recompute.
+
+TREND_ALPHA = 0.1
+KCAL_PER_KG = 7700
+SHORT_WINDOW = 7
+LONG_WINDOW = 28
+# Logged intake days a 28-day window needs before the TDEE estimate is trusted
+MIN_TDEE_DAYS = 14
+STATE_VERSION = 1
+
+# merged column -> state buffer
+SERIES = {"weight_kg": "weight", "consumed": "intake", "steps": "steps"}
+
+
+def _rolling(values, window):
+    """Trailing mean and count of non-NaN values over `window` days, via cumulative sums."""
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0.0))
+    counts = np.cumsum(valid).astype(float)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means, counts
+
+
+def _shift(values, days):
+    out = np.full(len(values), np.nan)
+    if days < len(values):
+        out[days:] = values[:len(values) - days]
+    return out
+
+
+def _daily_frame(start_date=None, end_date=None):
+    """Weight, intake and steps merged on date, one row per day that has any of them."""
+    frames = [
+        (db.get_daily_logs_df(start_date), "weight_kg"),
+        (db.get_daily_calories_df(start_date), "consumed"),
+        (db.get_apple_watch_df(start_date), "steps"),
+    ]
+    merged = pd.DataFrame(columns=["date"])
+    for df, column in frames:
+        if df.empty or column not in df.columns:
+            continue
+        merged = pd.merge(merged, df[["date", column]], on="date", how="outer")
+    for column in SERIES:
+        if column not in merged.columns:
+            merged[column] = np.nan
+    if end_date:
+        merged = merged[merged["date"] <= end_date]
+    return merged.sort_values("date")
+
+
+def compute_daily_metrics(df):
+    """
+    Vectorized metrics for every day from the first to the last date in df
+    (columns: date, weight_kg, consumed, steps). Days without data are carried
+    as gaps. Returns a DataFrame indexed by date.
+    """
+    if df.empty:
+        return pd.DataFrame()
+    df = df.assign(date=pd.to_datetime(df["date"])).groupby("date").last()
+    grid = pd.date_range(df.index.min(), df.index.max(), freq="D")
+    df = df.reindex(grid)
+
+    weight = df["weight_kg"].astype(float)
+    # The average only moves on days with a weigh-in and holds its value over gaps
+    observed = weight.dropna()
+    trend = observed.ewm(alpha=TREND_ALPHA, adjust=False).mean().reindex(grid).ffill().to_numpy()
+    intake = df["consumed"].to_numpy(dtype=float)
+    steps = df["steps"].to_numpy(dtype=float)
+
+    intake_7, _ = _rolling(intake, SHORT_WINDOW)
+    intake_28, intake_days = _rolling(intake, LONG_WINDOW)
+    steps_7, _ = _rolling(steps, SHORT_WINDOW)
+    steps_28, _ = _rolling(steps, LONG_WINDOW)
+    trend_change = trend - _shift(trend, LONG_WINDOW)
+    tdee = intake_28 - KCAL_PER_KG * trend_change / LONG_WINDOW
+    tdee[intake_days < MIN_TDEE_DAYS] = np.nan
+
+    return pd.DataFrame({
+        "weight_kg": weight.to_numpy(),
+        "trend_weight": trend,
+        "weekly_change": trend - _shift(trend, SHORT_WINDOW),
+        "intake": intake,
+        "intake_7d": intake_7,
+        "intake_28d": intake_28,
+        "steps": steps,
+        "steps_7d": steps_7,
+        "steps_28d": steps_28,
+        "tdee": tdee,
+        "tdee_days": intake_days,
+    }, index=grid)
+
+
+def _none(value):
+    return None if value is None or np.isnan(value) else float(value)
+
+
+def _state_from_metrics(metrics, cursor):
+    """Seed the incremental state from the tail of a full pass."""
+    def tail(values, n):
+        values = [_none(v) for v in values[-n:]]
+        return [None] * (n - len(values)) + values
+    return {
+        "version": STATE_VERSION,
+        "cursor": cursor,
+        "last_date": metrics.index[-1].strftime("%Y-%m-%d") if not metrics.empty else None,
+        "trend": tail(metrics["trend_weight"].to_numpy(), LONG_WINDOW + 1) if not metrics.empty else [None] * (LONG_WINDOW + 1),
+        "intake": tail(metrics["intake"].to_numpy(), LONG_WINDOW) if not metrics.empty else [None] * LONG_WINDOW,
+        "steps": tail(metrics["steps"].to_numpy(), LONG_WINDOW) if not metrics.empty else [None] * LONG_WINDOW,
+    }
+
+
+def _push(buffer, value):
+    buffer.append(value)
+    del buffer[0]
+
+
+def advance(state, day, row):
+    """Fold one day (dict of weight_kg/consumed/steps, possibly empty) into the state."""
+    trend = state["trend"][-1]
+    weight = _none(row.get("weight_kg"))
+    if weight is not None:
+        trend = weight if trend is None else trend + TREND_ALPHA * (weight - trend)
+    _push(state["trend"], trend)
+    _push(state["intake"], _none(row.get("consumed")))
+    _push(state["steps"], _none(row.get("steps")))
+    state["last_date"] = day
+
+
+def advance_to(state, rows, end_date):
+    """Fold every day after state['last_date'] up to end_date, filling gaps with empty days."""
+    if state["last_date"] is None:
+        if not rows:
+            return state
+        day = date.fromisoformat(min(rows))
+    else:
+        day = date.fromisoformat(state["last_date"]) + timedelta(days=1)
+    end = date.fromisoformat(end_date)
+    while day <= end:
+        key = day.isoformat()
+        advance(state, key, rows.get(key, {}))
+        day += timedelta(days=1)
+    return state
+
+
+def summarize(state):
+    """Current metrics from the trailing windows; None where there is not enough data."""
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return sum(values) / len(values) if values else None
+
+    trend, trend_28 = state["trend"][-1], state["trend"][0]
+    trend_7 = state["trend"][-SHORT_WINDOW - 1]
+    intake_28 = mean(state["intake"])
+    intake_days = sum(v is not None for v in state["intake"])
+    tdee = None
+    if trend is not None and trend_28 is not None and intake_days >= MIN_TDEE_DAYS:
+        tdee = intake_28 - KCAL_PER_KG * (trend - trend_28) / LONG_WINDOW
+    return {
+        "date": state["last_date"],
+        "trend_weight": trend,
+        "weekly_change": trend - trend_7 if trend is not None and trend_7 is not None else None,
+        "intake_7d": mean(state["intake"][-SHORT_WINDOW:]),
+        "intake_28d": intake_28,
+        "steps_7d": mean(state["steps"][-SHORT_WINDOW:]),
+        "steps_28d": mean(state["steps"]),
+        "tdee": tdee,
+        "tdee_days": intake_days,
+    }
+
+
+def _rows_by_date(df):
+    return {
+        pd.Timestamp(d).strftime("%Y-%m-%d"): row
+        for d, row in zip(df["date"], df[list(SERIES)].to_dict("records"))
+    }
+
+
+def rebuild_state():
+    """Full vectorized pass over closed days; persists and returns the new state."""
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    # Take the cursor first so writes racing the read are picked up next time
+    cursor = db.get_series_cursor()
+    metrics = compute_daily_metrics(_daily_frame(end_date=yesterday))
+    state = _state_from_metrics(metrics, cursor)
+    if state["last_date"] is not None:
+        # Carry the windows through empty days up to yesterday
+        advance_to(state, {}, yesterday)
+    db.save_metrics_state(state)
+    return state
+
+
+def get_derived_metrics():
+    """
+    Metrics as of today. Reuses the persisted state when no closed day has been
+    edited since it was saved, folding in any newly closed days.
+    """
+    today = date.today().isoformat()
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+
+    state = db.get_metrics_state()
+    if not state or state.get("version") != STATE_VERSION:
+        state = rebuild_state()
+    else:
+        changes, cursor = db.get_series_changes(state["cursor"])
+        edited = any(
+            r["date"] <= (state["last_date"] or "") for rows in changes.values() for r in rows
+        )
+        if edited:
+            state = rebuild_state()
+        else:
+            start = (date.fromisoformat(state["last_date"]) + timedelta(days=1)).isoformat() if state["last_date"] else None
+            pending = _rows_by_date(_daily_frame(start, yesterday)) if (state["last_date"] or "") < yesterday else {}
+            previous = (state["cursor"], state["last_date"])
+            state["cursor"] = cursor
+            advance_to(state, pending, yesterday)
+            if (state["cursor"], state["last_date"]) != previous:
+                db.save_metrics_state(state)
+
+    current = copy.deepcopy(state)
+    advance_to(current, _rows_by_date(_daily_frame(today, today)), today)
+    return summarize(current)
+
+
+if __name__ == '__main__':
+    for key, value in get_derived_metrics().items():
+        print(f"{key}: {value}")
@@ -1,175 +1,424 @@
 import dash
-from dash import dcc, html
+from dash import dcc, html, callback, clientside_callback, Input, Output, State, Patch
 import dash_bootstrap_components as dbc
-import plotly.express as px
-import plotly.graph_objects as go
-import pandas as pd
-from database import get_daily_logs_df, get_daily_calories_df, get_apple_watch_df, get_user_settings
+import base64
+import json
+import threading
+from cachetools import TTLCache
+from datetime import date, timedelta
+from database import (
+    get_weight_arrays, get_calorie_arrays, get_steps_arrays, get_user_settings, bmi_series,
+    fetch_concurrently, data_version, get_series_cursor, get_series_changes, SERIES_TABLES,
+    current_user_id
+)
+from utils import lttb_indices, bucket_days
 
 dash.register_page(__name__, path='/', name="Dashboard")
 
-def layout():
-    daily_df = get_daily_logs_df()
-    food_df = get_daily_calories_df()
-    apple_df = get_apple_watch_df()
-    user = get_user_settings()
+# Date-range options; None means all history
+RANGE_DAYS = {"30d": 30, "90d": 90, "1y": 365, "all": None}
+DEFAULT_RANGE = "90d"
 
-    if daily_df.empty and food_df.empty and apple_df.empty:
-        return html.Div(
-            [
-                html.H3("Welcome to FitnessTracker!", className="text-center mt-5 mb-3"),
-                html.P("Your database is connected but empty. Tap Journal below to log your first weight entry, or sync your Apple Watch data.", className="text-center text-muted"),
-            ],
-            className="p-4"
-        )
+# Upper bound on points sent to the phone per chart, regardless of history length
+MAX_CHART_POINTS = 120
 
-    # Helper to merge everything on 'date'
-    master_df = daily_df.copy() if not daily_df.empty else pd.DataFrame(columns=['date', 'weight_kg', 'bmi'])
+# Per-render budget for the parallel data fetches (seconds)
+FETCH_TIMEOUT = 5.0
 
-    if not food_df.empty:
-        if master_df.empty:
-            master_df = food_df
-        else:
-            master_df = pd.merge(master_df, food_df, on='date', how='outer')
+# Bump when the shape of the client-side stores changes, forcing a full resync
+SYNC_VERSION = 2
 
-    if not apple_df.empty:
-        if master_df.empty:
-            master_df = apple_df
-        else:
-            master_df = pd.merge(master_df, apple_df, on='date', how='outer')
+# Serialized figures keyed by (user, chart, range, day, data versions). The TTL matches
+# the query cache so writes made by other workers show up on the same schedule.
+_figure_cache = TTLCache(maxsize=512, ttl=60)
+_figure_lock = threading.Lock()
 
-    master_df['date'] = pd.to_datetime(master_df['date'])
-    master_df = master_df.sort_values('date')
+def cached_figure(chart, range_key, tables, build):
+    """Return the figure JSON for a chart, building and serializing it only when its data changed."""
+    import numpy as np
+    key = (current_user_id(), chart, range_key, date.today().isoformat(), tuple(data_version(t) for t in tables))
+    with _figure_lock:
+        fig_json = _figure_cache.get(key)
+    if fig_json is None:
+        # Plain dicts/lists re-encode far faster than a go.Figure with numpy arrays
+        fig_json = json.loads(build().to_json())
+        # Plotly packs numeric arrays as base64 typed arrays; extendData and store
+        # patches need plain lists to append to
+        for trace in fig_json["data"]:
+            for axis in ("x", "y"):
+                values = trace.get(axis)
+                if isinstance(values, dict) and "bdata" in values:
+                    trace[axis] = np.frombuffer(base64.b64decode(values["bdata"]), dtype=values["dtype"]).tolist()
+        with _figure_lock:
+            _figure_cache[key] = fig_json
+    return fig_json
 
-    maint_cals = user.get('maintenance_calories', 2500)
+def range_start(range_key):
+    days = RANGE_DAYS.get(range_key, RANGE_DAYS[DEFAULT_RANGE])
+    return (date.today() - timedelta(days=days)).isoformat() if days else None
+
+range_selector = dbc.RadioItems(
+    id="dashboard-range",
+    options=[{"label": label, "value": value} for value, label in
+             [("30d", "30D"), ("90d", "90D"), ("1y", "1Y"), ("all", "All")]],
+    value=DEFAULT_RANGE,
+    inline=True,
+    className="btn-group mb-3",
+    inputClassName="btn-check",
+    labelClassName="btn btn-outline-secondary btn-sm",
+    labelCheckedClassName="active",
+    persistence=True,
+    persistence_type="local",
+)
+
+# ----------------- DATA -----------------
+
+def load_dashboard_data(range_key):
+    """Fetch the daily series for a range. Returns (DailySeries, user, derived metrics, failed fetch names)."""
+    import numpy as np
+    from metrics import get_derived_metrics
+    from series import DailySeries
+    start_date = range_start(range_key)
+    # The reads are independent, so the page waits for the slowest one, not their sum
+    results = fetch_concurrently({
+        "daily": lambda: get_weight_arrays(start_date),
+        "food": lambda: get_calorie_arrays(start_date),
+        "apple": lambda: get_steps_arrays(start_date),
+        "user": get_user_settings,
+        "metrics": get_derived_metrics,
+    }, timeout=FETCH_TIMEOUT)
+    failed = {name for name, value in results.items() if isinstance(value, Exception)}
+    user = {"height_cm": 175.0, "maintenance_calories": 2500} if "user" in failed else results["user"]
+    derived = {} if "metrics" in failed else results["metrics"]
+
+    # Aligned on one day axis by day number; a failed fetch is just a missing column
+    data = DailySeries.from_columns({
+        chart["column"]: results[chart["fetch"]] for chart in CHARTS if chart["fetch"] not in failed
+    })
+    days, weights = data.column("weight_kg")
+    data.add("bmi", days, bmi_series(weights, user.get("height_cm")).astype(np.float32))
+    return data, user, derived, failed
+
+# ----------------- TOP METRICS ROW -----------------
+
+def get_bmi_category(bmi_val):
+    if bmi_val == "N/A": return ""
+    b = float(bmi_val)
+    if b < 18.5: return "Underweight"
+    if 18.5 <= b <= 24.9: return "Normal"
+    if 25.0 <= b <= 29.9: return "Overweight"
+    return "Obese"
+
+def make_card(title, value, sub="", positive=None):
+    sub_class = "metric-sub"
+    if positive is True:
+        sub_class += " metric-positive"
+    elif positive is False:
+        sub_class += " metric-negative"
+
+    return html.Div(
+        [
+            html.Div(title, className="metric-title"),
+            html.Div(str(value), className="metric-value"),
+            html.Div(sub, className=sub_class)
+        ],
+        className="metric-card"
+    )
+
+def build_cards(data, maint_cals, derived=None):
+    derived = derived or {}
+    latest = {name: data.last(name) for name in ("weight_kg", "bmi", "consumed")}
+    latest_weight = latest["weight_kg"] if latest["weight_kg"] is not None else "N/A"
+    latest_bmi = latest["bmi"] if latest["bmi"] is not None and latest["bmi"] == latest["bmi"] else "N/A"
+    latest_cals = latest["consumed"] if latest["consumed"] is not None else "N/A"
+
+    # Adaptive TDEE once enough intake/weight history exists, else the configured maintenance
+    trend = derived.get('trend_weight')
+    weekly = derived.get('weekly_change')
+    tdee = derived.get('tdee')
+    target = tdee if tdee is not None else maint_cals
 
-    # ----------------- TOP METRICS ROW -----------------
-    latest_weight = master_df['weight_kg'].dropna().iloc[-1] if 'weight_kg' in master_df.columns and not master_df['weight_kg'].dropna().empty else "N/A"
-    latest_bmi = master_df['bmi'].dropna().iloc[-1] if 'bmi' in master_df.columns and not master_df['bmi'].dropna().empty else "N/A"
-    latest_cals = master_df['consumed'].dropna().iloc[-1] if 'consumed' in master_df.columns and not master_df['consumed'].dropna().empty else "N/A"
-    
     # Safely calculate deficit
     latest_deficit = "N/A"
     if latest_cals != "N/A":
         try:
-           latest_deficit = maint_cals - float(latest_cals)
+           latest_deficit = target - float(latest_cals)
         except (ValueError, TypeError):
            latest_deficit = "N/A"
 
-    def get_bmi_category(bmi_val):
-        if bmi_val == "N/A": return ""
-        b = float(bmi_val)
-        if b < 18.5: return "Underweight"
-        if 18.5 <= b <= 24.9: return "Normal"
-        if 25.0 <= b <= 29.9: return "Overweight"
-        return "Obese"
-
-    def make_card(title, value, sub="", positive=None):
-        sub_class = "metric-sub"
-        if positive is True:
-            sub_class += " metric-positive"
-        elif positive is False:
-            sub_class += " metric-negative"
-        
-        return html.Div(
-            [
-                html.Div(title, className="metric-title"),
-                html.Div(str(value), className="metric-value"),
-                html.Div(sub, className=sub_class)
-            ],
-            className="metric-card"
-        )
-
-    # Mobile optimized cards (2x2 grid instead of 4x1)
-    cards = dbc.Row(
+    # Mobile optimized cards (two per row instead of one wide row)
+    return dbc.Row(
         [
-            dbc.Col(make_card("Weight", f"{latest_weight} kg" if latest_weight != "N/A" else "--"), width=6, className="mb-3"),
             dbc.Col(make_card(
-                "BMI", 
+                "Weight",
+                f"{latest_weight:g} kg" if latest_weight != "N/A" else "--",
+                sub=f"trend {trend:.1f} ({weekly:+.1f}/wk)" if trend is not None and weekly is not None else ""
+            ), width=6, className="mb-3"),
+            dbc.Col(make_card(
+                "BMI",
                 f"{latest_bmi:.1f}" if latest_bmi != "N/A" else "--",
                 sub=get_bmi_category(latest_bmi),
                 positive=True if (latest_bmi != "N/A" and 18.5 <= float(latest_bmi) <= 24.9) else False if latest_bmi != "N/A" else None
             ), width=6, className="mb-3"),
-            dbc.Col(make_card("Intake", f"{latest_cals:.0f}" if latest_cals != "N/A" else "--", sub="kcal today"), width=6),
+            dbc.Col(make_card("Intake", f"{latest_cals:.0f}" if latest_cals != "N/A" else "--", sub="kcal today"), width=6, className="mb-3"),
             dbc.Col(make_card(
-                "Deficit", 
+                "Deficit",
                 f"{latest_deficit:.0f}" if latest_deficit != "N/A" else "--",
-                sub="kcal target",
+                sub="kcal vs TDEE" if tdee is not None else "kcal target",
                 positive=True if (latest_deficit != "N/A" and float(latest_deficit) > 0) else False if latest_deficit != "N/A" else None
+            ), width=6, className="mb-3"),
+            dbc.Col(make_card(
+                "Avg Intake",
+                f"{derived['intake_7d']:.0f}" if derived.get('intake_7d') is not None else "--",
+                sub=f"7d · 28d {derived['intake_28d']:.0f}" if derived.get('intake_28d') is not None else "7d"
+            ), width=6),
+            dbc.Col(make_card(
+                "TDEE",
+                f"{target:.0f}",
+                sub=f"adaptive · {derived.get('tdee_days', 0)}d" if tdee is not None else "from settings"
             ), width=6),
         ],
         className="mb-4 gx-3" # gx-3 reduces gutter width on mobile
     )
 
-    # ----------------- CHARTS (Mobile Optimized) -----------------
-    
-    # Trend line styling
-    chart_margins = dict(l=0, r=0, t=20, b=0)
-    bg_color = "rgba(0,0,0,0)"
-
-    # 1. Weight Progress (Line Chart)
-    if 'weight_kg' in master_df.columns and not master_df['weight_kg'].dropna().empty:
-        w_df = master_df.dropna(subset=['weight_kg'])
-        fig1 = px.line(w_df, x='date', y='weight_kg', template="plotly_dark")
-        fig1.update_traces(line_color='#4ECDC4', line_width=3, mode='lines+markers', marker=dict(size=6, color='#FF6B6B'))
-        fig1.update_layout(
-            margin=chart_margins, paper_bgcolor=bg_color, plot_bgcolor=bg_color,
-            xaxis=dict(showgrid=False, title="", tickformat="%b %d"),
-            yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)', title=""),
-            height=250 # Smaller height for mobile
-        )
-        chart1 = dcc.Graph(figure=fig1, config={'displayModeBar': False})
-    else:
-        chart1 = html.Div("No weight logs yet.", className="text-muted p-3 text-center")
-
-    # 2. Calories
-    if 'consumed' in master_df.columns and not master_df['consumed'].dropna().empty:
-        c_df = master_df.dropna(subset=['consumed'])
-        fig2 = go.Figure()
-        fig2.add_trace(go.Bar(x=c_df['date'], y=c_df['consumed'], name="Consumed", marker_color='rgba(255, 107, 107, 0.8)', marker_line_color='#FF6B6B', marker_line_width=1.5))
-        fig2.add_hline(y=maint_cals, line_dash="dash", line_color="#4ECDC4", annotation_text="Goal")
-        fig2.update_layout(
-            template="plotly_dark", margin=chart_margins, barmode='group', paper_bgcolor=bg_color, plot_bgcolor=bg_color,
-            xaxis=dict(showgrid=False, title="", tickformat="%b %d"),
-            yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)', title=""),
-            height=200, showlegend=False
-        )
-        chart2 = dcc.Graph(figure=fig2, config={'displayModeBar': False})
-    else:
-        chart2 = html.Div("No food logged yet.", className="text-muted p-3 text-center")
-        
-    # 3. Apple Watch Activity (Steps / Active Cals)
-    if 'steps' in master_df.columns and not master_df['steps'].dropna().empty:
-        a_df = master_df.dropna(subset=['steps'])
-        fig3 = go.Figure()
-        fig3.add_trace(go.Bar(x=a_df['date'], y=a_df['steps'], name="Steps", marker_color='#4ECDC4'))
-        fig3.update_layout(
-            template="plotly_dark", margin=chart_margins, paper_bgcolor=bg_color, plot_bgcolor=bg_color,
-            xaxis=dict(showgrid=False, title="", tickformat="%b %d"),
-            yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)', title=""),
-            height=200, showlegend=False
-        )
-        chart3 = dcc.Graph(figure=fig3, config={'displayModeBar': False})
-    else:
-        chart3 = html.Div("Sync Apple Watch data via iOS Shortcuts.", className="text-muted p-3 text-center")
+# ----------------- CHARTS (Mobile Optimized) -----------------
+
+# Trend line styling
+chart_margins = dict(l=0, r=0, t=20, b=0)
+bg_color = "rgba(0,0,0,0)"
+
+def _chart_axis(days):
+    # ISO day strings, the same form delta syncs append through extendData
+    import numpy as np
+    return np.datetime_as_string(days, unit='D')
+
+# 1. Weight Progress (Line Chart)
+def build_weight_fig(data, maint_cals):
+    import numpy as np
+    import plotly.graph_objects as go
+    days, weights = data.column('weight_kg')
+    keep = lttb_indices(days, weights, MAX_CHART_POINTS)
+    fig1 = go.Figure()
+    # float32 weights widened and rounded so hover labels read 81.4, not 81.40000152
+    fig1.add_trace(go.Scatter(x=_chart_axis(days[keep]), y=np.round(weights[keep].astype(float), 2), mode='lines+markers',
+                              line=dict(color='#4ECDC4', width=3), marker=dict(size=6, color='#FF6B6B')))
+    fig1.update_layout(
+        template="plotly_dark", margin=chart_margins, paper_bgcolor=bg_color, plot_bgcolor=bg_color,
+        xaxis=dict(showgrid=False, title="", tickformat="%b %d"),
+        yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)', title=""),
+        height=250, showlegend=False # Smaller height for mobile
+    )
+    return fig1
+
+# 2. Calories
+def build_calories_fig(data, maint_cals):
+    import numpy as np
+    import plotly.graph_objects as go
+    days, consumed = bucket_days(*data.column('consumed'), MAX_CHART_POINTS)
+    fig2 = go.Figure()
+    fig2.add_trace(go.Bar(x=_chart_axis(days), y=np.round(consumed, 1), name="Consumed", marker_color='rgba(255, 107, 107, 0.8)', marker_line_color='#FF6B6B', marker_line_width=1.5))
+    fig2.add_hline(y=maint_cals, line_dash="dash", line_color="#4ECDC4", annotation_text="Goal")
+    fig2.update_layout(
+        template="plotly_dark", margin=chart_margins, barmode='group', paper_bgcolor=bg_color, plot_bgcolor=bg_color,
+        xaxis=dict(showgrid=False, title="", tickformat="%b %d"),
+        yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)', title=""),
+        height=200, showlegend=False
+    )
+    return fig2
+
+# 3. Apple Watch Activity (Steps / Active Cals)
+def build_steps_fig(data, maint_cals):
+    import numpy as np
+    import plotly.graph_objects as go
+    days, steps = bucket_days(*data.column('steps'), MAX_CHART_POINTS)
+    fig3 = go.Figure()
+    fig3.add_trace(go.Bar(x=_chart_axis(days), y=np.round(steps, 1), name="Steps", marker_color='#4ECDC4'))
+    fig3.update_layout(
+        template="plotly_dark", margin=chart_margins, paper_bgcolor=bg_color, plot_bgcolor=bg_color,
+        xaxis=dict(showgrid=False, title="", tickformat="%b %d"),
+        yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)', title=""),
+        height=200, showlegend=False
+    )
+    return fig3
 
+# Each chart: the DailySeries column it plots, the table (and fetch) it comes from,
+# which data versions its cached figure depends on, and its placeholder texts.
+CHARTS = [
+    {"name": "weight", "title": "Weight Progress", "column": "weight_kg", "table": "daily_logs",
+     "fetch": "daily", "versions": ["daily_logs"], "build": build_weight_fig,
+     "empty": "No weight logs yet.", "label": "Weight data"},
+    {"name": "calories", "title": "Calorie Intake", "column": "consumed", "table": "daily_nutrition",
+     "fetch": "food", "versions": ["food_logs", "users"], "build": build_calories_fig,
+     "empty": "No food logged yet.", "label": "Calorie data"},
+    {"name": "steps", "title": "Daily Steps", "column": "steps", "table": "apple_watch_data",
+     "fetch": "apple", "versions": ["apple_watch_data"], "build": build_steps_fig,
+     "empty": "Sync Apple Watch data via iOS Shortcuts.", "label": "Activity data"},
+]
+
+def degraded_panel(what):
+    return html.Div(
+        [html.I(className="bi bi-exclamation-triangle pe-2"), f"{what} is temporarily unavailable. Pull to refresh."],
+        className="text-warning p-3 text-center"
+    )
+
+def chart_block(chart, class_name="graph-container"):
+    return html.Div([
+        html.Div(chart["title"], className="metric-title mb-2"),
+        html.Div(id=f"chart-{chart['name']}-msg"),
+        dcc.Graph(id=f"chart-{chart['name']}", config={'displayModeBar': False}, style={"display": "none"})
+    ], className=class_name)
+
+# ----------------- LAYOUT -----------------
+#
+# The layout itself carries no data. Chart series live in the browser's local
+# storage ("dashboard-figures"), so navigating back to "/" redraws from the
+# phone; the server is only asked for rows written after the cursor held in
+# "dashboard-sync", and new trailing days are sent as extendData patches.
+# Both stores record the user they were built for; on a shared browser
+# another user's figures are never redrawn and their cursor is not reused.
+
+def layout():
     return html.Div([
         html.H3("Overview", className="mb-4 premium-title", style={"textAlign": "left"}),
-        cards,
-        
-        # Stack charts vertically to fit phone screens better instead of side-by-side
-        html.Div([
-            html.Div("Weight Progress", className="metric-title mb-2"), 
-            chart1
-        ], className="graph-container"),
-        
-        html.Div([
-            html.Div("Calorie Intake", className="metric-title mb-2"), 
-            chart2
-        ], className="graph-container"),
-        
+        range_selector,
+        dcc.Store(id="dashboard-sync", storage_type="local"),
+        dcc.Store(id="dashboard-figures", storage_type="local"),
+        dcc.Store(id="dashboard-user", data=current_user_id()),
+        html.Div(
+            [
+                html.H3("Welcome to FitnessTracker!", className="text-center mt-5 mb-3"),
+                html.P("Your database is connected but empty. Tap Journal below to log your first weight entry, or sync your Apple Watch data.", className="text-center text-muted"),
+            ],
+            id="dashboard-welcome",
+            className="p-4",
+            style={"display": "none"}
+        ),
         html.Div([
-             html.Div("Daily Steps", className="metric-title mb-2"), 
-             chart3
-        ], className="graph-container mb-5") # Extra mb-5 so bottom nav doesn't cover it
+            html.Div(id="dashboard-cards"),
+
+            # Stack charts vertically to fit phone screens better instead of side-by-side
+            chart_block(CHARTS[0]),
+            chart_block(CHARTS[1]),
+            chart_block(CHARTS[2], "graph-container mb-5") # Extra mb-5 so bottom nav doesn't cover it
+        ], id="dashboard-body")
     ])
+
+# Redraw from local storage as soon as the page mounts, before the server answers
+clientside_callback(
+    """
+    function(rangeKey, figs, user) {
+        const skip = window.dash_clientside.no_update;
+        if (!figs || figs.range !== rangeKey || figs.user !== user) { return [skip, skip, skip]; }
+        return ["weight", "calories", "steps"].map(name => figs[name] || skip);
+    }
+    """,
+    [Output(f"chart-{c['name']}", "figure") for c in CHARTS],
+    Input("dashboard-range", "value"),
+    State("dashboard-figures", "data"),
+    State("dashboard-user", "data"),
+)
+
+def _appendable(state, rows, value_key):
+    """True when the changed rows are all new trailing days of a chart that is not downsampled."""
+    if not state or state["sampled"] or not rows:
+        return False
+    if any(r.get(value_key) is None or r.get("entry_count", 1) == 0 for r in rows):
+        return False
+    return all(r["date"] > state["last"] for r in rows) and state["points"] + len(rows) <= MAX_CHART_POINTS
+
+@callback(
+    Output("dashboard-cards", "children"),
+    Output("dashboard-welcome", "style"),
+    Output("dashboard-body", "style"),
+    Output("dashboard-sync", "data"),
+    Output("dashboard-figures", "data"),
+    [Output(f"chart-{c['name']}", "figure", allow_duplicate=True) for c in CHARTS],
+    [Output(f"chart-{c['name']}", "extendData") for c in CHARTS],
+    [Output(f"chart-{c['name']}-msg", "children") for c in CHARTS],
+    [Output(f"chart-{c['name']}", "style") for c in CHARTS],
+    Input("dashboard-range", "value"),
+    State("dashboard-sync", "data"),
+    prevent_initial_call='initial_duplicate'
+)
+def sync_dashboard_cb(range_key, sync):
+    sync = sync or {}
+    today = date.today().isoformat()
+    incremental = (
+        sync.get("version") == SYNC_VERSION and sync.get("user") == current_user_id() and sync.get("range") == range_key
+        and sync.get("day") == today and bool(sync.get("cursor"))
+    )
+
+    # 1. Work out what the client is missing (this also drops stale cached reads)
+    changes = {}
+    try:
+        if incremental:
+            changes, cursor = get_series_changes(sync["cursor"], range_start(range_key))
+        else:
+            cursor = get_series_cursor()
+    except Exception as e:
+        print(f"Dashboard delta sync failed: {e}")
+        incremental, cursor = False, ""
+
+    # 2. Current series for the range (served from the query cache when warm)
+    data, user, derived, failed = load_dashboard_data(range_key)
+    maint_cals = user.get('maintenance_calories', 2500)
+    n = len(CHARTS)
+
+    if all(data.count(c["column"]) == 0 for c in CHARTS) and not failed:
+        hidden = {"display": "none"}
+        new_sync = {"version": SYNC_VERSION, "user": current_user_id(), "range": range_key, "day": today, "cursor": cursor}
+        return ([], {"display": "block"}, hidden, new_sync, {"range": range_key, "user": current_user_id()},
+                *[dash.no_update] * n, *[dash.no_update] * n, *[""] * n, *[hidden] * n)
+
+    figs = Patch() if incremental else {"range": range_key, "user": current_user_id()}
+    new_states = {}
+    figures, extends, messages, styles = [], [], [], []
+    for chart in CHARTS:
+        name, column = chart["name"], chart["column"]
+        value_key = SERIES_TABLES[chart["table"]]
+        state = sync.get("charts", {}).get(name) if incremental else None
+        rows = changes.get(chart["table"], [])
+        days, _ = data.column(column)
+
+        if chart["fetch"] in failed:
+            figures.append(dash.no_update); extends.append(dash.no_update)
+            messages.append(degraded_panel(chart["label"])); styles.append({"display": "none"})
+            continue
+        if not len(days):
+            figures.append(dash.no_update); extends.append(dash.no_update)
+            messages.append(html.Div(chart["empty"], className="text-muted p-3 text-center"))
+            styles.append({"display": "none"})
+            figs[name] = None
+            continue
+
+        messages.append(""); styles.append({"display": "block"})
+        goal_changed = name == "calories" and sync.get("maint") != maint_cals
+        if state and not rows and not goal_changed:
+            # Nothing new for this chart
+            figures.append(dash.no_update); extends.append(dash.no_update)
+            new_states[name] = state
+        elif not goal_changed and _appendable(state, rows, value_key):
+            new = sorted(rows, key=lambda r: r["date"])
+            x = [r["date"] for r in new]
+            y = [r[value_key] for r in new]
+            figures.append(dash.no_update)
+            extends.append([{"x": [x], "y": [y]}, [0]])
+            figs[name]["data"][0]["x"].extend(x)
+            figs[name]["data"][0]["y"].extend(y)
+            new_states[name] = {"last": x[-1], "points": state["points"] + len(x), "sampled": False}
+        else:
+            fig = cached_figure(name, range_key, chart["versions"], lambda: chart["build"](data, maint_cals))
+            figures.append(fig); extends.append(dash.no_update)
+            figs[name] = fig
+            new_states[name] = {
+                "last": str(days[-1]),
+                "points": len(fig["data"][0]["x"]),
+                "sampled": len(days) > MAX_CHART_POINTS,
+            }
+
+    new_sync = {
+        "version": SYNC_VERSION, "user": current_user_id(), "range": range_key, "day": today,
+        "cursor": cursor, "maint": maint_cals, "charts": new_states,
+    }
+    return (build_cards(data, maint_cals, derived), {"display": "none"}, {"display": "block"}, new_sync, figs,
+            *figures, *extends, *messages, *styles)
@@ -1,9 +1,9 @@
 import dash
-from dash import dcc, html, callback, Input, Output, State, ALL, ctx
+from dash import dcc, html, callback, Input, Output, State, ALL, ctx, Patch
 import dash_bootstrap_components as dbc
 from datetime import date
-from database import log_daily_weight, log_food, save_workout, upsert_apple_watch_data
-from utils import search_food_openfoodfacts, scale_nutrients
+from database import log_daily_weight, log_food, save_workout, upsert_apple_watch_data, save_meal, get_meals, log_meal, log_foods, delete_meal, get_workouts_page
+from utils import search_food_openfoodfacts, scale_nutrients, meal_nutrition
 import json
 
 dash.register_page(__name__, path='/logs', name="Log Data")
@@ -53,11 +53,64 @@ food_card = dbc.Card(
             className="mb-4"
         ),
         dbc.Button("Log Food", id="btn-log-food", color="primary", className="w-100 btn-primary", n_clicks=0),
+        dbc.Button([html.I(className="bi bi-plus-lg pe-2"), "Add to Meal"], id="btn-add-to-meal", color="secondary", className="w-100 mt-2", n_clicks=0),
         html.Div(id="food-msg", className="mt-3 text-center fw-bold")
     ]),
     className="mb-4 metric-card"
 )
 
+def saved_meal_options():
+    try:
+        meals = get_meals()
+    except Exception as e:
+        print(f"Loading saved meals failed: {e}")
+        return []
+    return [
+        {"label": f"{m['name']} · {m['total']['calories']:.0f} kcal" + (f" / {m['servings']:g} servings" if m['kind'] == 'recipe' else ""),
+         "value": str(m['id'])}
+        for m in meals
+    ]
+
+# Builds a meal from the food card's selections; logs it in one go or saves it for reuse.
+# Logging uses the date and meal chosen on the food card.
+def meals_card():
+    return dbc.Card(
+        dbc.CardBody([
+            html.H5([html.I(className="bi bi-basket pe-2"), "Meals & Recipes"], className="card-title premium-title mb-4", style={"textAlign": "left"}),
+            dcc.Store(id="meal-items-store", data=[]),
+            html.Div(id="meal-builder", className="mb-3"),
+            dbc.Row([
+                dbc.Col(dbc.Button("Log Meal", id="btn-log-meal", color="primary", className="w-100 btn-primary", n_clicks=0), width=8),
+                dbc.Col(dbc.Button("Clear", id="btn-clear-meal", color="secondary", className="w-100", n_clicks=0), width=4),
+            ], className="mb-3 gx-2"),
+            dbc.Input(id="meal-save-name", placeholder="Save as... (e.g. Usual breakfast)", type="text", className="mb-2"),
+            dbc.InputGroup([
+                dbc.Select(id="meal-save-kind", options=[
+                    {"label": "Meal (logs each item)", "value": "meal"},
+                    {"label": "Recipe (logs a portion)", "value": "recipe"},
+                ], value="meal"),
+                dbc.Input(id="meal-save-servings", type="number", value=1, min=1, step=1),
+                dbc.InputGroupText("servings", style={"backgroundColor": "#2D313A", "border": "none", "color": "#A0AABF"}),
+            ], className="mb-2"),
+            dbc.Button("Save", id="btn-save-meal", color="secondary", className="w-100 mb-4", n_clicks=0),
+
+            dbc.Select(id="saved-meal-select", options=saved_meal_options(), placeholder="Saved meals & recipes", className="mb-3"),
+            dbc.InputGroup(
+                [
+                    dbc.Input(id="saved-meal-portion", type="number", placeholder="Recipe portion (default 1 serving)", step=10),
+                    dbc.InputGroupText("g", style={"backgroundColor": "#2D313A", "border": "none", "color": "#A0AABF"})
+                ],
+                className="mb-3"
+            ),
+            dbc.Row([
+                dbc.Col(dbc.Button("Log Saved", id="btn-log-saved", color="primary", className="w-100 btn-primary", n_clicks=0), width=8),
+                dbc.Col(dbc.Button("Delete", id="btn-delete-saved", color="secondary", className="w-100", n_clicks=0), width=4),
+            ]),
+            html.Div(id="meal-msg", className="mt-3 text-center fw-bold")
+        ]),
+        className="mb-4 metric-card"
+    )
+
 journal_card = dbc.Card(
     dbc.CardBody([
         html.H5([html.I(className="bi bi-journal-richtext pe-2"), "Daily Journal"], className="card-title premium-title mb-4", style={"textAlign": "left"}),
@@ -71,7 +124,14 @@ journal_card = dbc.Card(
         ),
         dbc.Textarea(id="workout-notes", placeholder="How are you feeling today? Any workout notes?", style={"minHeight": "120px"}, className="mb-4"),
         dbc.Button("Save Journal Entry", id="btn-save-workout", color="primary", className="w-100 btn-primary", n_clicks=0),
-        html.Div(id="workout-msg", className="mt-3 text-center fw-bold")
+        html.Div(id="workout-msg", className="mt-3 text-center fw-bold"),
+
+        # Past entries, newest first, one keyset page at a time
+        html.Div("Past entries", className="metric-title mt-4 mb-2"),
+        dcc.Store(id="workout-cursor"),
+        html.Div(id="workout-history"),
+        dbc.Button("Load more", id="btn-more-workouts", color="secondary", className="w-100 mt-2", n_clicks=0,
+                   style={"display": "none"})
     ]),
     className="mb-5 metric-card" # mb-5 to prevent cutoff from bottom nav
 )
@@ -83,6 +143,9 @@ def layout():
             dbc.Col(weight_card, width=12, md=6),
             dbc.Col(food_card, width=12, md=6),
         ]),
+        dbc.Row([
+            dbc.Col(meals_card(), width=12),
+        ]),
         dbc.Row([
             dbc.Col(journal_card, width=12),
         ])
@@ -153,6 +216,83 @@ def log_food_cb(n_clicks, date_val, meal_val, portion_val, food_data):
     except Exception as e:
         return f"Error: {e}", "mt-3 text-center fw-bold text-danger"
 
+@callback(
+    Output("meal-items-store", "data"),
+    Input("btn-add-to-meal", "n_clicks"),
+    Input("btn-clear-meal", "n_clicks"),
+    State("selected-food-store", "data"),
+    State("food-portion", "value"),
+    State("meal-items-store", "data"),
+    prevent_initial_call=True
+)
+def edit_meal_items_cb(add_clicks, clear_clicks, food_data, portion_val, items):
+    if ctx.triggered_id == "btn-clear-meal":
+        return []
+    if not food_data or not portion_val:
+        return dash.no_update
+    # Same shape as a meal_items row, so the list can be saved as is
+    return (items or []) + [{
+        "food_name": food_data['name'], "weight_g": float(portion_val),
+        **{k: food_data[k] for k in ("calories_100g", "protein_100g", "carbs_100g", "fats_100g")}
+    }]
+
+@callback(
+    Output("meal-builder", "children"),
+    Input("meal-items-store", "data")
+)
+def render_meal_builder_cb(items):
+    if not items:
+        return html.Div("Search a food, set its portion and tap Add to Meal.", className="text-muted small")
+    summary = meal_nutrition(items)
+    total = summary['total']
+    return html.Div([
+        *[html.Div(f"{row['food_name']} · {row['portion_size']} · {row['calories']:.0f} kcal", className="small") for row in summary['items']],
+        html.Div(f"Total {total['calories']:.0f} kcal · P {total['protein_g']:.0f}g · C {total['carbs_g']:.0f}g · F {total['fats_g']:.0f}g",
+                 className="fw-bold mt-2")
+    ])
+
+@callback(
+    Output("meal-msg", "children"),
+    Output("meal-msg", "className"),
+    Output("saved-meal-select", "options"),
+    Input("btn-log-meal", "n_clicks"),
+    Input("btn-save-meal", "n_clicks"),
+    Input("btn-log-saved", "n_clicks"),
+    Input("btn-delete-saved", "n_clicks"),
+    State("food-date", "value"),
+    State("food-meal", "value"),
+    State("meal-items-store", "data"),
+    State("meal-save-name", "value"),
+    State("meal-save-kind", "value"),
+    State("meal-save-servings", "value"),
+    State("saved-meal-select", "value"),
+    State("saved-meal-portion", "value"),
+    prevent_initial_call=True
+)
+def meal_action_cb(log_clicks, save_clicks, saved_clicks, delete_clicks, date_val, meal_val, items, name, kind, servings, meal_id, portion_val):
+    error, success = "mt-3 text-center fw-bold text-danger", "mt-3 text-center fw-bold text-success"
+    try:
+        if ctx.triggered_id in ("btn-log-saved", "btn-delete-saved") and not meal_id:
+            return "Please choose a saved meal.", error, dash.no_update
+        if ctx.triggered_id == "btn-delete-saved":
+            delete_meal(int(meal_id))
+            return "Deleted saved meal.", success, saved_meal_options()
+        if ctx.triggered_id == "btn-log-saved":
+            rows = log_meal(int(meal_id), date_val, meal_val, portion_val)
+            kcal = sum(r.get('calories') or 0 for r in rows)
+            return f"Logged {len(rows)} item(s) ({kcal:.0f} kcal)!", success, dash.no_update
+        if not items:
+            return "Add foods to the meal first.", error, dash.no_update
+        if ctx.triggered_id == "btn-save-meal":
+            if not name:
+                return "Please name the meal.", error, dash.no_update
+            save_meal(name, items, kind or "meal", servings or 1)
+            return f"Saved {name}!", success, saved_meal_options()
+        rows = log_foods(date_val, meal_val, meal_nutrition(items)['items'])
+        return f"Logged {len(rows)} foods in one go!", success, dash.no_update
+    except Exception as e:
+        return f"Error: {e}", error, dash.no_update
+
 @callback(
     Output("workout-msg", "children"),
     Output("workout-msg", "className"),
@@ -172,3 +312,39 @@ def save_workout_cb(n_clicks, date_val, duration_val, notes_val):
         return "Journal entry saved!", "mt-3 text-center fw-bold text-success"
     except Exception as e:
         return f"Error: {e}", "mt-3 text-center fw-bold text-danger"
+
+WORKOUT_PAGE_SIZE = 10
+
+def workout_row(item):
+    w = item['workout']
+    duration = f" · {w['duration_minutes']} min" if w.get('duration_minutes') else ""
+    return html.Div([
+        html.Div(f"{w['date']}{duration}", className="fw-bold"),
+        html.Div(w.get('notes') or "", className="text-muted small"),
+    ], className="py-2 border-bottom border-secondary")
+
+@callback(
+    Output("workout-history", "children"),
+    Output("workout-cursor", "data"),
+    Output("btn-more-workouts", "style"),
+    Input("btn-more-workouts", "n_clicks"),
+    # Fires once a save has finished, so the list is re-read after the write
+    Input("workout-msg", "children"),
+    State("workout-cursor", "data"),
+)
+def workout_history_cb(more_clicks, saved_msg, cursor):
+    more = ctx.triggered_id == "btn-more-workouts"
+    try:
+        page = get_workouts_page(WORKOUT_PAGE_SIZE, cursor if more else None)
+    except Exception as e:
+        print(f"Loading journal entries failed: {e}")
+        return dash.no_update, dash.no_update, dash.no_update
+    rows = [workout_row(item) for item in page['items']]
+    if more:
+        # Append on the client instead of resending the rows already shown
+        children = Patch()
+        children.extend(rows)
+    else:
+        children = rows or html.Div("No entries yet.", className="text-muted")
+    style = {"display": "block"} if page['next_cursor'] else {"display": "none"}
+    return children, page['next_cursor'], style
@@ -0,0 +1,69 @@
+import numpy as np
+
+# ------------- Columnar Daily Series -------------
+#
+# The dashboard's daily metrics on one shared day axis: day i is start + i
+# (datetime64[D]), and each metric is a typed NumPy array over that axis with
+# a mask of the days that have a value. Aligning weight, intake and steps is
+# index arithmetic on the day numbers instead of outer merges of DataFrames
+# with string dates, and a year of one metric is ~1.5 KB instead of a frame of
+# Python objects.
+
+
+class DailySeries:
+    """Daily metrics over the contiguous days start .. start + n_days - 1."""
+
+    def __init__(self, start, n_days):
+        self.start = np.datetime64(start, "D")
+        self.n_days = n_days
+        self.values = {}
+        self.present = {}
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        columns: {name: (days, values)} with days as datetime64[D] arrays, e.g.
+        from database.get_weight_arrays. The axis spans the first to the last
+        day of any column; missing columns or days are simply absent.
+        """
+        spans = [(days.min(), days.max()) for days, _ in columns.values() if len(days)]
+        if not spans:
+            series = cls(np.datetime64("today", "D"), 0)
+        else:
+            start = min(first for first, _ in spans)
+            series = cls(start, int((max(last for _, last in spans) - start).astype(np.int64)) + 1)
+        for name, (days, values) in columns.items():
+            series.add(name, days, values)
+        return series
+
+    def add(self, name, days, values):
+        """Place values (any dtype, kept as is) at their day numbers on the axis."""
+        index = (np.asarray(days, dtype="datetime64[D]") - self.start).astype(np.int32)
+        column = np.zeros(self.n_days, dtype=np.asarray(values).dtype)
+        present = np.zeros(self.n_days, dtype=bool)
+        column[index] = values
+        present[index] = True
+        self.values[name] = column
+        self.present[name] = present
+
+    def days(self):
+        return self.start + np.arange(self.n_days).astype("timedelta64[D]")
+
+    def column(self, name):
+        """(days, values) for the days that have a value, in date order."""
+        if name not in self.values:
+            return np.array([], dtype="datetime64[D]"), np.array([])
+        mask = self.present[name]
+        return self.days()[mask], self.values[name][mask]
+
+    def count(self, name):
+        return int(self.present[name].sum()) if name in self.present else 0
+
+    def last(self, name):
+        """Most recent value as a Python number, or None."""
+        if not self.count(name):
+            return None
+        return self.values[name][np.flatnonzero(self.present[name])[-1]].item()
+
+    def nbytes(self):
+        return sum(v.nbytes for v in self.values.values()) + sum(p.nbytes for p in self.present.values())
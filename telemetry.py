@@ -0,0 +1,160 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from backends import Backend
+
+# ------------- Request / DB Instrumentation -------------
+#
+# Minimal in-process Prometheus histograms, rendered in the text exposition
+# format by app_dash's /metrics route. Every backend call made by database.py
+# goes through InstrumentedBackend, which records latency and row counts per
+# (op, table) and counts round trips against the current request, so /metrics
+# shows how many queries a dashboard render or a webhook call costs.
+#
+# Values are per process: under gunicorn each worker reports its own series.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self.series.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+HTTP_REQUESTS = Histogram("http_request_duration_seconds", "Flask request latency by route.",
+                          ("route", "method", "status"))
+DASH_CALLBACKS = Histogram("dash_callback_duration_seconds", "Dash callback latency by output.",
+                           ("callback",))
+REQUEST_ROUND_TRIPS = Histogram("request_db_round_trips", "Backend calls made while serving one request.",
+                                ("route",), ROUND_TRIP_BUCKETS)
+DB_CALLS = Histogram("db_call_duration_seconds", "Backend call latency by operation and table.",
+                     ("op", "table", "status"))
+DB_ROWS = Histogram("db_call_rows", "Rows returned by backend calls.", ("op", "table"), ROW_BUCKETS)
+OFF_REQUESTS = Histogram("openfoodfacts_request_duration_seconds", "Open Food Facts search latency.",
+                         ("status",))
+OFF_ROWS = Histogram("openfoodfacts_results", "Products returned per Open Food Facts search.", (), ROW_BUCKETS)
+
+HISTOGRAMS = [HTTP_REQUESTS, DASH_CALLBACKS, REQUEST_ROUND_TRIPS, DB_CALLS, DB_ROWS, OFF_REQUESTS, OFF_ROWS]
+
+# name -> (type, help, labelnames, collect() -> {label values tuple: value})
+_collectors = {}
+
+def register_collector(name, kind, help, labelnames, collect):
+    """Expose values computed at scrape time (e.g. cache counters, queue depth)."""
+    _collectors[name] = (kind, help, tuple(labelnames), collect)
+
+
+# ------------- Per-request round trips -------------
+
+# A list rather than an int: fetch_concurrently copies the context into its
+# worker threads, and appends from those threads land on the same list.
+_round_trips = contextvars.ContextVar("round_trips", default=None)
+
+def begin_request():
+    return _round_trips.set([])
+
+def end_request(token):
+    """Stop counting for the current request; returns its backend round trips."""
+    trips = _round_trips.get()
+    _round_trips.reset(token)
+    return len(trips) if trips is not None else 0
+
+
+class InstrumentedBackend(Backend):
+    """Wraps a Backend, timing every call and counting it against the current request."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.name = inner.name
+
+    def __getattr__(self, attr):
+        return getattr(self.inner, attr)
+
+    def _call(self, op, table, *args, **kwargs):
+        trips = _round_trips.get()
+        if trips is not None:
+            trips.append(op)
+        start = time.perf_counter()
+        try:
+            rows = getattr(self.inner, op)(table, *args, **kwargs)
+        except Exception:
+            DB_CALLS.observe(time.perf_counter() - start, op, table, "error")
+            raise
+        DB_CALLS.observe(time.perf_counter() - start, op, table, "ok")
+        DB_ROWS.observe(len(rows) if rows else 0, op, table)
+        return rows
+
+    def select(self, table, *args, **kwargs):
+        return self._call("select", table, *args, **kwargs)
+
+    def insert(self, table, rows):
+        return self._call("insert", table, rows)
+
+    def upsert(self, table, rows, on_conflict=None):
+        return self._call("upsert", table, rows, on_conflict=on_conflict)
+
+    def update(self, table, values, filters):
+        return self._call("update", table, values, filters)
+
+    def delete(self, table, filters):
+        return self._call("delete", table, filters)
+
+
+def render():
+    """All series in the Prometheus text exposition format."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for name, (kind, help, labelnames, collect) in _collectors.items():
+        try:
+            values = collect()
+        except Exception as e:
+            print(f"Metrics collector '{name}' failed: {e}")
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(values.items()):
+            lines.append(f"{name}{_labels(labelnames, labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,85 +1,192 @@
-import requests
-import json
-import pandas as pd
+import os
+import math
+import threading
+import time
+import zipfile
+from datetime import datetime
+import xml.etree.ElementTree as ET
+from cachetools import TTLCache
+from food_index import get_food_index
+import telemetry
 
-def search_food_openfoodfacts(query):
+# Local fallback database of common foods
+FALLBACK_FOODS = [
+        {"name": "Apple", "calories_100g": 52.0, "protein_100g": 0.3, "carbs_100g": 14.0, "fats_100g": 0.2},
+        {"name": "Banana", "calories_100g": 89.0, "protein_100g": 1.1, "carbs_100g": 23.0, "fats_100g": 0.3},
+        {"name": "Chicken Breast", "calories_100g": 165.0, "protein_100g": 31.0, "carbs_100g": 0.0, "fats_100g": 3.6},
+        {"name": "White Rice (Cooked)", "calories_100g": 130.0, "protein_100g": 2.7, "carbs_100g": 28.0, "fats_100g": 0.3},
+        {"name": "Oatmeal", "calories_100g": 68.0, "protein_100g": 2.4, "carbs_100g": 12.0, "fats_100g": 1.4},
+        {"name": "Egg (Boiled)", "calories_100g": 155.0, "protein_100g": 13.0, "carbs_100g": 1.1, "fats_100g": 11.0},
+        {"name": "Broccoli", "calories_100g": 34.0, "protein_100g": 2.8, "carbs_100g": 6.6, "fats_100g": 0.4},
+        {"name": "Salmon", "calories_100g": 208.0, "protein_100g": 20.0, "carbs_100g": 0.0, "fats_100g": 13.0},
+        {"name": "Almonds", "calories_100g": 579.0, "protein_100g": 21.0, "carbs_100g": 22.0, "fats_100g": 50.0},
+        {"name": "Greek Yogurt", "calories_100g": 59.0, "protein_100g": 10.0, "carbs_100g": 3.6, "fats_100g": 0.4},
+        {"name": "Sweet Potato", "calories_100g": 86.0, "protein_100g": 1.6, "carbs_100g": 20.0, "fats_100g": 0.1},
+        {"name": "Avocado", "calories_100g": 160.0, "protein_100g": 2.0, "carbs_100g": 8.5, "fats_100g": 15.0},
+        {"name": "Whey Protein Powder", "calories_100g": 359.0, "protein_100g": 80.0, "carbs_100g": 5.0, "fats_100g": 2.0},
+        {"name": "Peanut Butter", "calories_100g": 588.0, "protein_100g": 25.0, "carbs_100g": 20.0, "fats_100g": 50.0},
+        {"name": "Milk (Whole)", "calories_100g": 61.0, "protein_100g": 3.2, "carbs_100g": 4.8, "fats_100g": 3.3},
+        {"name": "Steak", "calories_100g": 271.0, "protein_100g": 25.0, "carbs_100g": 0.0, "fats_100g": 19.0},
+        {"name": "Dal (Cooked Lentils)", "calories_100g": 116.0, "protein_100g": 9.0, "carbs_100g": 20.0, "fats_100g": 0.4},
+        {"name": "Paneer", "calories_100g": 321.0, "protein_100g": 25.0, "carbs_100g": 3.6, "fats_100g": 25.0},
+        {"name": "Chapati / Roti", "calories_100g": 297.0, "protein_100g": 9.0, "carbs_100g": 46.0, "fats_100g": 8.0}
+]
+
+OFF_SEARCH_URL = "https://world.openfoodfacts.org/cgi/search.pl"
+
+# Query result cache: LRU bounded, with a shorter TTL for empty/failed lookups
+FOOD_CACHE_SIZE = 1024
+FOOD_CACHE_TTL = 24 * 3600
+FOOD_NEGATIVE_TTL = 300
+
+_food_cache = TTLCache(maxsize=FOOD_CACHE_SIZE, ttl=FOOD_CACHE_TTL)
+_food_negative_cache = TTLCache(maxsize=FOOD_CACHE_SIZE, ttl=FOOD_NEGATIVE_TTL)
+_food_inflight = {}
+_food_lock = threading.Lock()
+_food_stats = {"hits": 0, "negative_hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+_session = None
+_session_pid = None
+
+def get_http_session():
+    """Keep-alive session with a connection pool, created once per process."""
+    import requests
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+        _session_pid = os.getpid()
+    return _session
+
+def normalize_food_query(query):
+    return " ".join(str(query).lower().split())
+
+def food_search_stats():
+    with _food_lock:
+        return dict(_food_stats, size=len(_food_cache), negative_size=len(_food_negative_cache))
+
+def _fetch_openfoodfacts(query):
+    start = time.perf_counter()
+    try:
+        response = get_http_session().get(OFF_SEARCH_URL, params={
+            "search_terms": query, "search_simple": 1, "action": "process", "json": 1, "page_size": 20
+        }, timeout=2)
+        data = response.json()
+    except Exception:
+        telemetry.OFF_REQUESTS.observe(time.perf_counter() - start, "error")
+        raise
+    telemetry.OFF_REQUESTS.observe(time.perf_counter() - start, str(response.status_code))
+
+    results = []
+    if 'products' in data:
+        for product in data['products']:
+            name = product.get('product_name', 'Unknown')
+            brand = product.get('brands', '')
+            if brand:
+                name = f"{brand} - {name}"
+
+            nutriments = product.get('nutriments', {})
+
+            # Default to per 100g if serving not available, but user can scale it
+            cals = nutriments.get('energy-kcal_100g', 0)
+            protein = nutriments.get('proteins_100g', 0)
+            carbs = nutriments.get('carbohydrates_100g', 0)
+            fats = nutriments.get('fat_100g', 0)
+
+            # Only add if it has some calorie data to avoid clutter
+            if cals is not None and name != 'Unknown':
+                results.append({
+                    'name': name,
+                    'calories_100g': float(cals) if cals else 0.0,
+                    'protein_100g': float(protein) if protein else 0.0,
+                    'carbs_100g': float(carbs) if carbs else 0.0,
+                    'fats_100g': float(fats) if fats else 0.0
+                })
+    telemetry.OFF_ROWS.observe(len(results))
+    return results
+
+def _fallback_foods(query):
+    fallback_results = []
+    q_lower = query.lower()
+    for item in FALLBACK_FOODS:
+        if q_lower in str(item.get("name", "")).lower():
+            fallback_results.append(dict(item))
+
+    # If still empty, return a generic item matching the query to ensure *something* logs
+    if not fallback_results:
+        fallback_results.append({
+            "name": query.capitalize() + " (Generic Estimate)",
+            "calories_100g": 130.0,
+            "protein_100g": 5.0,
+            "carbs_100g": 20.0,
+            "fats_100g": 5.0
+        })
+
+    return fallback_results
+
+def _lookup_openfoodfacts(key):
     """
-    Search for food using Open Food Facts API
-    Returns a list of dicts with food name and macroscopic info per 100g or serving.
+    Cached, coalesced API lookup. Returns a result list, or None if the API failed.
+    Concurrent callers for the same normalized query share one in-flight request.
     """
-    url = f"https://world.openfoodfacts.org/cgi/search.pl?search_terms={query}&search_simple=1&action=process&json=1&page_size=20"
+    with _food_lock:
+        if key in _food_cache:
+            _food_stats["hits"] += 1
+            return _food_cache[key]
+        if key in _food_negative_cache:
+            _food_stats["negative_hits"] += 1
+            return _food_negative_cache[key]
+        waiter = _food_inflight.get(key)
+        if waiter is None:
+            waiter = _food_inflight[key] = {"event": threading.Event(), "result": None}
+            leader = True
+            _food_stats["misses"] += 1
+        else:
+            leader = False
+            _food_stats["coalesced"] += 1
+
+    if not leader:
+        waiter["event"].wait(5)
+        return waiter["result"]
+
     try:
-        response = requests.get(url, timeout=2)
-        data = response.json()
-        
-        results = []
-        if 'products' in data:
-            for product in data['products']:
-                name = product.get('product_name', 'Unknown')
-                brand = product.get('brands', '')
-                if brand:
-                    name = f"{brand} - {name}"
-                
-                nutriments = product.get('nutriments', {})
-                
-                # Default to per 100g if serving not available, but user can scale it
-                cals = nutriments.get('energy-kcal_100g', 0)
-                protein = nutriments.get('proteins_100g', 0)
-                carbs = nutriments.get('carbohydrates_100g', 0)
-                fats = nutriments.get('fat_100g', 0)
-                
-                # Only add if it has some calorie data to avoid clutter
-                if cals is not None and name != 'Unknown':
-                    results.append({
-                        'name': name,
-                        'calories_100g': float(cals) if cals else 0.0,
-                        'protein_100g': float(protein) if protein else 0.0,
-                        'carbs_100g': float(carbs) if carbs else 0.0,
-                        'fats_100g': float(fats) if fats else 0.0
-                    })
-        return results
+        result = _fetch_openfoodfacts(key)
     except Exception as e:
         print(f"Error fetching from Open Food Facts: {e}. Using local fallback data.")
-        # Local fallback database of common foods
-        mock_db = [
-            {"name": "Apple", "calories_100g": 52.0, "protein_100g": 0.3, "carbs_100g": 14.0, "fats_100g": 0.2},
-            {"name": "Banana", "calories_100g": 89.0, "protein_100g": 1.1, "carbs_100g": 23.0, "fats_100g": 0.3},
-            {"name": "Chicken Breast", "calories_100g": 165.0, "protein_100g": 31.0, "carbs_100g": 0.0, "fats_100g": 3.6},
-            {"name": "White Rice (Cooked)", "calories_100g": 130.0, "protein_100g": 2.7, "carbs_100g": 28.0, "fats_100g": 0.3},
-            {"name": "Oatmeal", "calories_100g": 68.0, "protein_100g": 2.4, "carbs_100g": 12.0, "fats_100g": 1.4},
-            {"name": "Egg (Boiled)", "calories_100g": 155.0, "protein_100g": 13.0, "carbs_100g": 1.1, "fats_100g": 11.0},
-            {"name": "Broccoli", "calories_100g": 34.0, "protein_100g": 2.8, "carbs_100g": 6.6, "fats_100g": 0.4},
-            {"name": "Salmon", "calories_100g": 208.0, "protein_100g": 20.0, "carbs_100g": 0.0, "fats_100g": 13.0},
-            {"name": "Almonds", "calories_100g": 579.0, "protein_100g": 21.0, "carbs_100g": 22.0, "fats_100g": 50.0},
-            {"name": "Greek Yogurt", "calories_100g": 59.0, "protein_100g": 10.0, "carbs_100g": 3.6, "fats_100g": 0.4},
-            {"name": "Sweet Potato", "calories_100g": 86.0, "protein_100g": 1.6, "carbs_100g": 20.0, "fats_100g": 0.1},
-            {"name": "Avocado", "calories_100g": 160.0, "protein_100g": 2.0, "carbs_100g": 8.5, "fats_100g": 15.0},
-            {"name": "Whey Protein Powder", "calories_100g": 359.0, "protein_100g": 80.0, "carbs_100g": 5.0, "fats_100g": 2.0},
-            {"name": "Peanut Butter", "calories_100g": 588.0, "protein_100g": 25.0, "carbs_100g": 20.0, "fats_100g": 50.0},
-            {"name": "Milk (Whole)", "calories_100g": 61.0, "protein_100g": 3.2, "carbs_100g": 4.8, "fats_100g": 3.3},
-            {"name": "Steak", "calories_100g": 271.0, "protein_100g": 25.0, "carbs_100g": 0.0, "fats_100g": 19.0},
-            {"name": "Dal (Cooked Lentils)", "calories_100g": 116.0, "protein_100g": 9.0, "carbs_100g": 20.0, "fats_100g": 0.4},
-            {"name": "Paneer", "calories_100g": 321.0, "protein_100g": 25.0, "carbs_100g": 3.6, "fats_100g": 25.0},
-            {"name": "Chapati / Roti", "calories_100g": 297.0, "protein_100g": 9.0, "carbs_100g": 46.0, "fats_100g": 8.0}
-        ]
-        
-        fallback_results = []
-        q_lower = query.lower()
-        for item in mock_db:
-            if q_lower in str(item.get("name", "")).lower():
-                fallback_results.append(item)
-                
-        # If still empty, return a generic item matching the query to ensure *something* logs
-        if not fallback_results:
-            fallback_results.append({
-                "name": query.capitalize() + " (Generic Estimate)",
-                "calories_100g": 130.0,
-                "protein_100g": 5.0,
-                "carbs_100g": 20.0,
-                "fats_100g": 5.0
-            })
-            
-        return fallback_results
+        result = None
+    with _food_lock:
+        if result:
+            _food_cache[key] = result
+        else:
+            if result is None:
+                _food_stats["errors"] += 1
+            _food_negative_cache[key] = result
+        waiter["result"] = result
+        del _food_inflight[key]
+    waiter["event"].set()
+    return result
+
+def search_food_openfoodfacts(query):
+    """
+    Search for food using Open Food Facts API
+    Returns a list of dicts with food name and macroscopic info per 100g or serving.
+    The local food index (food_index.py) is tried first; the API is only called
+    when no index is built or it has no match. API results are cached per
+    normalized query, and empty or failed lookups are negatively cached briefly.
+    """
+    index = get_food_index()
+    if index is not None:
+        local_results = index.search(query)
+        if local_results:
+            return local_results
+
+    results = _lookup_openfoodfacts(normalize_food_query(query))
+    if results is None:
+        return _fallback_foods(query)
+    # Callers may mutate the list, so never hand out the cached one
+    return [dict(r) for r in results]
 
 def scale_nutrients(food_item, weight_g):
     """
@@ -94,28 +201,330 @@ def scale_nutrients(food_item, weight_g):
         'fats_g': round(food_item['fats_100g'] * ratio, 1)
     }
 
-def process_apple_watch_export(file_content):
+# scale_nutrients output key -> per-100g input key
+PER_100G_KEYS = {'calories': 'calories_100g', 'protein_g': 'protein_100g', 'carbs_g': 'carbs_100g', 'fats_g': 'fats_100g'}
+
+def meal_nutrition(items, name="Meal"):
+    """
+    Aggregate a meal or recipe: items are foods with gram weights and per-100g
+    macros (meal_items rows). Returns each item scaled with scale_nutrients as a
+    food_logs-ready row, the totals, and the totals per 100g as a food item, so
+    a recipe can be scaled to any portion like a search result.
+    """
+    rows = []
+    for item in items:
+        scaled = scale_nutrients(dict(item, name=item['food_name']), item['weight_g'])
+        rows.append({
+            'food_name': scaled['name'], 'portion_size': f"{item['weight_g']:g}g",
+            **{k: scaled[k] for k in PER_100G_KEYS},
+        })
+    total = {k: round(sum(r[k] for r in rows), 1) for k in PER_100G_KEYS}
+    weight_g = sum(item['weight_g'] for item in items)
+    per_100g = {'name': name, **{v: round(total[k] * 100.0 / weight_g, 2) if weight_g else 0.0 for k, v in PER_100G_KEYS.items()}}
+    return {'items': rows, 'total': dict(total, weight_g=weight_g), 'per_100g': per_100g}
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling for line charts; returns the
+    indices of the points to keep. Keeps the first and last point and, per
+    bucket, the point forming the largest triangle with its neighbours, so
+    peaks and the overall shape survive.
+    """
+    import numpy as np
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = x.astype('datetime64[D]').astype(np.int64).astype(float) if np.issubdtype(x.dtype, np.datetime64) else x.astype(float)
+    y = np.asarray(y, dtype=float)
+
+    # Bucket edges over the interior points (first and last are always kept)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = [0]
+    prev = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        nxt_start, nxt_end = edges[i + 1], (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[nxt_start:nxt_end].mean()
+        avg_y = y[nxt_start:nxt_end].mean()
+        area = np.abs((x[prev] - avg_x) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (avg_y - y[prev]))
+        prev = start + int(area.argmax())
+        selected.append(prev)
+    selected.append(n - 1)
+    return np.array(selected)
+
+def bucket_days(days, values, max_points):
     """
-    Process Apple Watch JSON export.
-    Expects JSON structure (array of objects with date, steps, active_calories...)
-    Or a CSV. For MVP, assuming user uploads a simple daily aggregation JSON.
+    Average a daily series (sorted datetime64[D] days) into weeks ending Sunday,
+    or calendar months when weeks would still be too many, so a bar chart never
+    exceeds max_points bars. Returns (bucket days, means), or the input if it fits.
     """
+    import numpy as np
+    if len(days) <= max_points:
+        return days, values
+    span_days = int((days[-1] - days[0]).astype(np.int64)) + 1
+    if span_days / 7 <= max_points:
+        # Day 0 (1970-01-01) is a Thursday, so (day + 3) % 7 counts from Monday
+        labels = days + (6 - (days.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+    else:
+        labels = days.astype('datetime64[M]').astype('datetime64[D]')
+    buckets, inverse = np.unique(labels, return_inverse=True)
+    return buckets, np.bincount(inverse, weights=values.astype(float)) / np.bincount(inverse)
+
+APPLE_WATCH_REQUIRED = ['date', 'steps', 'active_calories', 'exercise_minutes']
+APPLE_WATCH_INT_COLS = ['steps', 'active_calories', 'exercise_minutes']
+# Below this many records a plain loop beats building DataFrames (webhook posts are 1 record)
+APPLE_WATCH_VECTORIZE_MIN = 64
+# Plausible (min, max) per day; anything else, including Infinity, is rejected before it reaches the database
+APPLE_WATCH_LIMITS = {
+    'steps': (0, 200_000),
+    'active_calories': (0, 20_000),
+    'exercise_minutes': (0, 1440),
+    'avg_heart_rate': (0, 300),
+}
+
+def _to_number(value):
     try:
-        # If it's pure json text
-        if isinstance(file_content, str):
-            data = json.loads(file_content)
-        else:
-            # Assume it's a file byte stream
-            data = json.load(file_content)
-            
-        df = pd.DataFrame(data)
-        # We expect columns like: date, steps, active_calories, exercise_minutes, avg_heart_rate
-        # For simplicity return the dataframe if it matches
-        required_cols = ['date', 'steps', 'active_calories', 'exercise_minutes', 'avg_heart_rate']
-        if all(col in df.columns for col in required_cols):
-            return df
-        else:
-            return None
-    except Exception as e:
-        print(f"Error parsing file: {e}")
+        number = float(value)
+    except (TypeError, ValueError):
         return None
+    return None if number != number else number
+
+def _validate_apple_watch_record(record):
+    """Single-record twin of validate_apple_watch_records; returns (clean_record, error)."""
+    if not isinstance(record, dict):
+        return None, "Record must be a JSON object"
+    # None, absent and NaN all count as missing, as with DataFrame.isna()
+    missing = [c for c in APPLE_WATCH_REQUIRED if record.get(c) is None or record.get(c) != record.get(c)]
+    if missing:
+        return None, "Missing required fields: " + ", ".join(missing)
+    try:
+        day = datetime.strptime(str(record['date']), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None, "Invalid date, expected YYYY-MM-DD"
+    numbers = {c: _to_number(record.get(c)) for c in APPLE_WATCH_INT_COLS + ['avg_heart_rate']}
+    bad = [c for c in APPLE_WATCH_INT_COLS if numbers[c] is None]
+    if record.get('avg_heart_rate') is not None and numbers['avg_heart_rate'] is None:
+        bad.append('avg_heart_rate')
+    if bad:
+        return None, "Non-numeric values in: " + ", ".join(bad)
+    out = [c for c, (low, high) in APPLE_WATCH_LIMITS.items()
+           if numbers[c] is not None and not (math.isfinite(numbers[c]) and low <= numbers[c] <= high)]
+    if out:
+        return None, "Out-of-range values in: " + ", ".join(out)
+    clean = {'date': day, **{c: int(numbers[c]) for c in APPLE_WATCH_INT_COLS}}
+    clean['avg_heart_rate'] = numbers['avg_heart_rate'] if numbers['avg_heart_rate'] is not None else 0.0
+    return clean, None
+
+def validate_apple_watch_records(records):
+    """
+    Validate a batch of Apple Watch day records in one vectorized pass.
+    Returns (rows, errors): rows is a list of (index, clean_record) ready to upsert,
+    errors maps the input index to a message for every rejected record.
+    """
+    if len(records) < APPLE_WATCH_VECTORIZE_MIN:
+        rows, errors = [], {}
+        for i, record in enumerate(records):
+            clean, error = _validate_apple_watch_record(record)
+            if error:
+                errors[i] = error
+            else:
+                rows.append((i, clean))
+        return rows, errors
+
+    # Only the vectorized path pays for pandas; small webhooks never import it
+    import numpy as np
+    import pandas as pd
+    errors = {i: "Record must be a JSON object" for i, r in enumerate(records) if not isinstance(r, dict)}
+    df = pd.DataFrame.from_records(
+        [r if isinstance(r, dict) else {} for r in records],
+        columns=APPLE_WATCH_REQUIRED + ['avg_heart_rate']
+    )
+
+    missing = df[APPLE_WATCH_REQUIRED].isna()
+    for i in missing.index[missing.any(axis=1)]:
+        errors.setdefault(int(i), "Missing required fields: " + ", ".join(missing.columns[missing.loc[i]]))
+
+    dates = pd.to_datetime(df['date'].astype(str), format='%Y-%m-%d', errors='coerce')
+    for i in dates.index[dates.isna()]:
+        errors.setdefault(int(i), "Invalid date, expected YYYY-MM-DD")
+
+    numeric = df[APPLE_WATCH_INT_COLS + ['avg_heart_rate']].apply(pd.to_numeric, errors='coerce')
+    bad_numbers = numeric[APPLE_WATCH_INT_COLS].isna() & ~missing[APPLE_WATCH_INT_COLS]
+    bad_numbers['avg_heart_rate'] = numeric['avg_heart_rate'].isna() & df['avg_heart_rate'].notna()
+    for i in bad_numbers.index[bad_numbers.any(axis=1)]:
+        errors.setdefault(int(i), "Non-numeric values in: " + ", ".join(bad_numbers.columns[bad_numbers.loc[i]]))
+
+    out_of_range = pd.DataFrame({
+        c: numeric[c].notna() & ~(np.isfinite(numeric[c]) & numeric[c].between(low, high))
+        for c, (low, high) in APPLE_WATCH_LIMITS.items()
+    })
+    for i in out_of_range.index[out_of_range.any(axis=1)]:
+        errors.setdefault(int(i), "Out-of-range values in: " + ", ".join(out_of_range.columns[out_of_range.loc[i]]))
+
+    ok = ~df.index.isin(list(errors))
+    clean = pd.DataFrame({
+        'date': dates[ok].dt.strftime('%Y-%m-%d'),
+        **{c: numeric.loc[ok, c].astype(int) for c in APPLE_WATCH_INT_COLS},
+        'avg_heart_rate': numeric.loc[ok, 'avg_heart_rate'].fillna(0.0).astype(float),
+    })
+    rows = list(zip(clean.index.tolist(), clean.to_dict('records')))
+    return rows, errors
+
+def parse_sample_batches(data):
+    """
+    Normalize an intraday samples payload to {metric: (timestamps, values)}.
+    Accepts one series {"metric", "timestamps": [...], "values": [...]}, a list
+    of them, or {"samples": [{"metric", "timestamp", "value"}, ...]}.
+    Returns (samples, error).
+    """
+    if isinstance(data, dict) and isinstance(data.get('samples'), list):
+        samples = {}
+        for row in data['samples']:
+            if (not isinstance(row, dict) or not all(k in row for k in ('metric', 'timestamp', 'value'))
+                    or not isinstance(row['metric'], str)):
+                return None, "Each sample needs metric, timestamp and value"
+            timestamps, values = samples.setdefault(row['metric'], ([], []))
+            timestamps.append(row['timestamp'])
+            values.append(row['value'])
+        return samples, None
+    series = [data] if isinstance(data, dict) else data
+    if not isinstance(series, list) or not series:
+        return None, "Expected a series object, a list of series or {\"samples\": [...]}"
+    samples = {}
+    for s in series:
+        if (not isinstance(s, dict) or not isinstance(s.get('metric'), str)
+                or not isinstance(s.get('timestamps'), list) or not isinstance(s.get('values'), list)):
+            return None, "Each series needs metric, timestamps and values"
+        timestamps, values = samples.setdefault(s.get('metric'), ([], []))
+        timestamps.extend(s['timestamps'])
+        values.extend(s['values'])
+    return samples, None
+
+# ------------- Apple Health export.xml streaming import -------------
+
+HEALTH_SUM_TYPES = {
+    'HKQuantityTypeIdentifierStepCount': 'steps',
+    'HKQuantityTypeIdentifierActiveEnergyBurned': 'active_calories',
+    'HKQuantityTypeIdentifierAppleExerciseTime': 'exercise_minutes',
+}
+HEALTH_HEART_RATE = 'HKQuantityTypeIdentifierHeartRate'
+HEALTH_UNIT_SCALE = {'kJ': 1 / 4.184, 'Cal': 1.0, 'kcal': 1.0, 'hr': 60.0, 's': 1 / 60.0}
+
+class _CountingReader:
+    """File wrapper that counts bytes read, for progress reporting."""
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+def _open_health_export(source):
+    """Return (file object, uncompressed size, closer) for export.zip or export.xml."""
+    if zipfile.is_zipfile(source):
+        archive = zipfile.ZipFile(source)
+        member = next(i for i in archive.infolist() if i.filename.endswith('export.xml'))
+        f = archive.open(member)
+        return f, member.file_size, lambda: (f.close(), archive.close())
+    if hasattr(source, 'read'):
+        return source, None, lambda: None
+    f = open(source, 'rb')
+    return f, os.path.getsize(source), f.close
+
+def iter_apple_health_days(source, progress=None, progress_every=100000):
+    """
+    Stream an Apple Health export (export.zip path/file or export.xml) and yield
+    daily rows shaped for upsert_apple_watch_data_bulk, in date order.
+
+    Records are parsed with iterparse and cleared as soon as they are read, so
+    memory is bounded by the number of days (a few MB for decades of history),
+    not the size of the export. Rows are only yielded once the whole file has
+    been read: the export groups records by type, not by date, so a day's totals
+    are not final until the last type has gone past.
+    Additive metrics are summed per source and the largest source total is kept,
+    which avoids double counting when both the iPhone and the Watch record steps.
+    progress(bytes_read, total_bytes, records) is called every progress_every records.
+    """
+    f, total, close = _open_health_export(source)
+    reader = _CountingReader(f)
+    sums = {}   # (date, column) -> {source: total}
+    heart = {}  # date -> [sum, count]
+    records = 0
+    try:
+        context = ET.iterparse(reader, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag != 'Record':
+                continue
+            kind = elem.get('type')
+            column = HEALTH_SUM_TYPES.get(kind)
+            if column or kind == HEALTH_HEART_RATE:
+                try:
+                    value = float(elem.get('value'))
+                except (TypeError, ValueError):
+                    value = None
+                day = (elem.get('startDate') or '')[:10]
+                if value is not None and day:
+                    if column:
+                        value *= HEALTH_UNIT_SCALE.get(elem.get('unit'), 1.0)
+                        per_source = sums.setdefault((day, column), {})
+                        src = elem.get('sourceName', '')
+                        per_source[src] = per_source.get(src, 0.0) + value
+                    else:
+                        acc = heart.setdefault(day, [0.0, 0])
+                        acc[0] += value
+                        acc[1] += 1
+            records += 1
+            # Drop parsed records so the tree never grows
+            elem.clear()
+            root.clear()
+            if progress and records % progress_every == 0:
+                progress(reader.bytes_read, total, records)
+    finally:
+        close()
+    if progress:
+        progress(reader.bytes_read, total, records)
+
+    days = sorted({day for day, _ in sums} | set(heart))
+    for day in days:
+        row = {'date': day}
+        for column in HEALTH_SUM_TYPES.values():
+            per_source = sums.get((day, column))
+            row[column] = int(round(max(per_source.values()))) if per_source else 0
+        hr = heart.get(day)
+        row['avg_heart_rate'] = round(hr[0] / hr[1], 1) if hr else 0.0
+        yield row
+
+def import_apple_health_export(source, upsert=None, chunk_size=1000, progress=None):
+    """
+    Import a full Apple Health export. After the parse (see iter_apple_health_days),
+    days are written in bulk upserts of chunk_size. Returns the number of days written.
+    """
+    if upsert is None:
+        from database import upsert_apple_watch_data_bulk as upsert
+    written = 0
+    chunk = []
+    for row in iter_apple_health_days(source, progress=progress):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            upsert(chunk)
+            written += len(chunk)
+            chunk = []
+    if chunk:
+        upsert(chunk)
+        written += len(chunk)
+    return written
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == 'import-health':
+        def report(done, total, records):
+            pct = f" ({done / total:.0%})" if total else ""
+            print(f"Parsed {records} records, {done / 1e6:.1f} MB{pct}", flush=True)
+        days = import_apple_health_export(sys.argv[2], progress=report)
+        print(f"Imported {days} days of Apple Health data.")
+    else:
+        print("Usage: python utils.py import-health <export.zip|export.xml>")